@@ -0,0 +1,287 @@
+"""Purging deleted accounts in the background.
+
+Deleting a user through the ORM loads every message, like and follow
+before deleting any of them, which for a big account takes longer than a
+request may. Instead, delete_user() just marks the account deleted
+(User.mark_deleted(); every query then skips it and its messages) and
+queues an AccountPurge. `flask purge-accounts` works through the queue.
+
+Each purge runs through STEPS in order. A step deletes up to `chunk_size`
+rows at a time with set-based statements, fixing the counters of the
+users on the other side in the same transaction, and commits after every
+chunk with its progress. A purge that's interrupted picks up where it left
+off the next time.
+"""
+
+import time
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from models import (db, User, Message, Follows, Likes, MessageTerm,
+                    TimelineEntry)
+from timelines import restore_fanout
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+class AccountPurge(db.Model):
+    """A deleted account being purged, and how far along that is."""
+
+    __tablename__ = 'account_purges'
+
+    # Not a foreign key: this outlives the user row
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    step = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    def __repr__(self):
+        return (f"<AccountPurge {self.user_id}: {self.step}, "
+                f"{self.rows_deleted} rows>")
+
+
+def _release(counter, user_counts):
+    """Take `user_counts` ({user id: n}) off each user's `counter`."""
+
+    by_amount = {}
+    for user_id, n in user_counts.items():
+        by_amount.setdefault(n, []).append(user_id)
+
+    for n, user_ids in by_amount.items():
+        User.adjust_counts(user_ids, **{counter: -n})
+
+
+def purge_likes_given(user_id, limit):
+    ids = [like_id for (like_id,) in (db.session
+                                      .query(Likes.id)
+                                      .filter(Likes.user_id == user_id)
+                                      .limit(limit))]
+
+    if ids:
+        Likes.query.filter(Likes.id.in_(ids)).delete(synchronize_session=False)
+
+    return len(ids)
+
+
+def purge_likes_received(user_id, limit):
+    likes = (db.session
+             .query(Likes.id, Likes.user_id)
+             .join(Message, Message.id == Likes.message_id)
+             .filter(Message.user_id == user_id)
+             .limit(limit)
+             .all())
+
+    if likes:
+        (Likes
+         .query
+         .filter(Likes.id.in_([like_id for like_id, _ in likes]))
+         .delete(synchronize_session=False))
+        _release('like_count', Counter(liker_id for _, liker_id in likes))
+
+    return len(likes)
+
+
+def purge_timeline(user_id, limit):
+    """Their own home timeline."""
+
+    return _delete_timeline_entries(
+        db.session
+        .query(TimelineEntry.user_id, TimelineEntry.message_id)
+        .filter(TimelineEntry.user_id == user_id)
+        .limit(limit))
+
+
+def purge_fanned_out(user_id, limit):
+    """Their messages in other people's timelines."""
+
+    return _delete_timeline_entries(
+        db.session
+        .query(TimelineEntry.user_id, TimelineEntry.message_id)
+        .join(Message, Message.id == TimelineEntry.message_id)
+        .filter(Message.user_id == user_id)
+        .limit(limit))
+
+
+def _delete_timeline_entries(keys):
+    # A subquery rather than a list of (user_id, message_id) pairs:
+    # PostgreSQL plans a long list of row values very badly
+    table = TimelineEntry.__table__
+
+    return db.session.execute(
+        table.delete().where(
+            tuple_(table.c.user_id, table.c.message_id).in_(keys.subquery()))
+    ).rowcount
+
+
+def purge_messages(user_id, limit):
+    ids = [message_id for (message_id,) in (db.session
+                                            .query(Message.id)
+                                            .filter(Message.user_id == user_id)
+                                            .limit(limit))]
+
+    if ids:
+        (MessageTerm
+         .query
+         .filter(MessageTerm.message_id.in_(ids))
+         .delete(synchronize_session=False))
+        (Message
+         .query
+         .filter(Message.id.in_(ids))
+         .delete(synchronize_session=False))
+
+    return len(ids)
+
+
+def purge_following(user_id, limit):
+    followed_ids = [followed_id for (followed_id,) in (
+        db.session
+        .query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user_id)
+        .limit(limit))]
+
+    if followed_ids:
+        (Follows
+         .query
+         .filter(Follows.user_following_id == user_id,
+                 Follows.user_being_followed_id.in_(followed_ids))
+         .delete(synchronize_session=False))
+        User.adjust_counts(followed_ids, follower_count=-1)
+        restore_fanout(dict.fromkeys(followed_ids, 1))
+
+    return len(followed_ids)
+
+
+def purge_followers(user_id, limit):
+    follower_ids = [follower_id for (follower_id,) in (
+        db.session
+        .query(Follows.user_following_id)
+        .filter(Follows.user_being_followed_id == user_id)
+        .limit(limit))]
+
+    if follower_ids:
+        (Follows
+         .query
+         .filter(Follows.user_being_followed_id == user_id,
+                 Follows.user_following_id.in_(follower_ids))
+         .delete(synchronize_session=False))
+        User.adjust_counts(follower_ids, following_count=-1)
+
+    return len(follower_ids)
+
+
+def purge_user(user_id, limit):
+    return (User
+            .query
+            .filter(User.id == user_id)
+            .delete(synchronize_session=False))
+
+
+# (name, function(user_id, limit) -> rows deleted); a step is done when it
+# deletes fewer than `limit` rows
+STEPS = [
+    ('likes_given', purge_likes_given),
+    ('likes_received', purge_likes_received),
+    ('timeline', purge_timeline),
+    ('fanned_out', purge_fanned_out),
+    ('messages', purge_messages),
+    ('following', purge_following),
+    ('followers', purge_followers),
+    ('user', purge_user),
+]
+
+STEP_NAMES = [name for name, _ in STEPS]
+
+
+def request_purge(user_id):
+    """Queue a purge of `user_id`, who should already be marked deleted.
+    Doesn't commit."""
+
+    if AccountPurge.query.get(user_id) is None:
+        db.session.add(AccountPurge(user_id=user_id, step=STEP_NAMES[0]))
+
+
+def pending_purges():
+    return (AccountPurge
+            .query
+            .filter(AccountPurge.finished_at.is_(None))
+            .order_by(AccountPurge.requested_at)
+            .all())
+
+
+def run_purge(purge, chunk_size=DEFAULT_CHUNK_SIZE, log=print):
+    """Run `purge` from its current step to the end, committing after
+    every chunk."""
+
+    user_id = purge.user_id
+
+    for name, step in STEPS[STEP_NAMES.index(purge.step):]:
+        purge.step = name
+
+        while True:
+            deleted = step(user_id, chunk_size)
+
+            purge.rows_deleted += deleted
+            purge.updated_at = datetime.utcnow()
+            db.session.commit()
+
+            if deleted < chunk_size:
+                break
+
+        log(f"User {user_id}: {name} done ({purge.rows_deleted} rows so far)")
+
+    purge.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def purge_accounts(chunk_size=DEFAULT_CHUNK_SIZE, log=print):
+    """Run every unfinished purge. Returns how many were finished."""
+
+    purges = pending_purges()
+
+    for purge in purges:
+        started = time.perf_counter()
+        run_purge(purge, chunk_size, log)
+        log(f"Purged user {purge.user_id} in "
+            f"{time.perf_counter() - started:.1f}s")
+
+    return len(purges)
+
+
+def purge_stats():
+    """Purges waiting or running, and rows deleted by them so far."""
+
+    waiting, rows = (db.session
+                     .query(db.func.count(AccountPurge.user_id),
+                            db.func.coalesce(
+                                db.func.sum(AccountPurge.rows_deleted), 0))
+                     .filter(AccountPurge.finished_at.is_(None))
+                     .one())
+
+    return {'pending': waiting, 'rows_deleted': int(rows)}
@@ -1,11 +1,42 @@
+import hashlib
 import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g
+import random
+import time
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+import click
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, abort, jsonify, url_for, Response, stream_with_context)
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import select, union_all
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, EditUserForm
-from models import db, connect_db, User, Message, Likes
+from models import (db, connect_db, User, Message, Likes, Follows,
+                    QueryStats, ENGINE_QUERY_COUNTS)
+from passwords import PasswordPoolFull, password_pool
+from user_cache import user_cache
+from message_cards import message_cards
+from like_buffer import like_buffer
+from follow_graph import follow_graph
+from account_purge import (DEFAULT_CHUNK_SIZE, purge_accounts, purge_stats,
+                           request_purge)
+from assets import assets, build_assets
+from migrations import migrate, pending_migrations
+from query_plans import DEFAULT_MIN_ROWS, check_query_plans
+from message_search import (index_message, reindex_messages,
+                            search_messages, unindex_message)
+from search import browse_users, create_search_indexes, search_users
+from recommendations import (DEFAULT_CHUNK_SIZE as RECOMMENDATION_CHUNK_SIZE,
+                             DEFAULT_TOP_N, RecommendationsUnavailable,
+                             build_recommendations, forget_recommendation,
+                             recommended_users)
+from pagination import (PAGE_SIZE, InvalidCursor, decode_cursor,
+                        decode_id_cursor, id_page, keyset, page)
+from timelines import (add_followee, fan_out_message, home_timeline,
+                       rebuild_all_timelines, rebuild_timeline,
+                       remove_followee, restore_fanout)
 
 CURR_USER_KEY = "curr_user"
 
@@ -25,9 +56,198 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
 #
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
+# Most SQL statements a request may run, by endpoint (SQL_QUERY_BUDGET for
+# any endpoint not listed). Requests over budget are logged; the view tests
+# set SQL_QUERY_BUDGET_ENFORCED so going over budget fails them.
+app.config['SQL_QUERY_BUDGET'] = 20
+app.config['SQL_QUERY_BUDGETS'] = {
+    # (one more for the 'merge' timeline engine's occasional refill)
+    'homepage': 6,
+    'users_show': 5,
+    'likes_page': 4,
+    'messages_show': 6,
+    'messages_search': 4,
+    'list_users': 4,
+    'show_following': 6,
+    'users_followers': 6,
+}
+app.config['SQL_QUERY_BUDGET_ENFORCED'] = False
+
+# Log a possible N+1 when one statement shape repeats this many times
+app.config['SQL_REPEATED_QUERY_THRESHOLD'] = 5
+
+# bcrypt runs on a small bounded thread pool (see passwords.py) so a burst
+# of logins can't tie up every request thread; it leaves two of the
+# REQUEST_THREADS (gunicorn's threads, see gunicorn.conf.py) free
+app.config['REQUEST_THREADS'] = int(os.environ.get('WEB_THREADS', 8))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_HASH_TIMEOUT'] = 3
+
+# Logged-in users' names and pictures are cached per process (see
+# user_cache.py) rather than loaded on every request
+app.config['USER_CACHE_SIZE'] = 1024
+app.config['USER_CACHE_TTL'] = 60
+
+# How home timelines are read: 'fanout', 'query' or 'merge' (see
+# timelines.py; benchmarks/timeline_engines.py compares them)
+app.config['TIMELINE_ENGINE'] = os.environ.get('TIMELINE_ENGINE', 'fanout')
+
+# Rendered message cards are cached per process too (see message_cards.py)
+app.config['MESSAGE_CARD_CACHE_SIZE'] = 10000
+
+# Read replicas of the main database, if any (comma-separated URLs). GETs
+# of REPLICA_READ_ENDPOINTS read from a random one, except for
+# REPLICA_STICKY_SECONDS after a visitor's last write (POST etc.), so they
+# see their own changes while the replicas catch up.
+REPLICA_URLS = [url.strip()
+                for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                if url.strip()]
+app.config['REPLICA_READ_ENDPOINTS'] = {
+    'homepage',
+    'list_users',
+    'users_show',
+    'show_following',
+    'users_followers',
+    'likes_page',
+    'messages_show',
+    'messages_search',
+}
+app.config['REPLICA_STICKY_SECONDS'] = 10
+
+# Write likes in batches in the background rather than one commit per
+# click (see like_buffer.py)
+app.config['LIKE_BUFFER_ENABLED'] = bool(os.environ.get('LIKE_BUFFER_ENABLED'))
+app.config['LIKE_BUFFER_INTERVAL'] = 0.5
+app.config['LIKE_BUFFER_MAX_PENDING'] = 1000
+
+# Keep who-follows-whom in memory for follow checks and following pages
+# (see follow_graph.py)
+app.config['FOLLOW_GRAPH_ENABLED'] = bool(
+    os.environ.get('FOLLOW_GRAPH_ENABLED'))
+app.config['FOLLOW_GRAPH_REFRESH_SECONDS'] = 2
+app.config['FOLLOW_GRAPH_MAX_OVERLAY'] = 100000
+
+# Users per following/followers page, and whether to send those pages as
+# they render rather than all at once
+app.config['FOLLOW_PAGE_SIZE'] = 60
+app.config['STREAM_FOLLOW_PAGES'] = bool(
+    os.environ.get('STREAM_FOLLOW_PAGES'))
+
+# Plain /static/ files can change, so browsers have to revalidate them;
+# fingerprinted ones (`flask build-assets`, served from /assets/) are
+# cached for a year
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+
+# Serve /metrics (JSON) for the monitoring scraper
+app.config['METRICS_ENABLED'] = bool(os.environ.get('METRICS_ENABLED'))
+
 toolbar = DebugToolbarExtension(app)
 
-connect_db(app)
+connect_db(app, REPLICA_URLS)
+password_pool.init_app(app)
+user_cache.init_app(app)
+message_cards.init_app(app)
+like_buffer.init_app(app)
+follow_graph.init_app(app)
+assets.init_app(app)
+
+
+@app.before_first_request
+def start_follow_graph():
+    """Start loading the follow graph (if enabled; gunicorn.conf.py starts
+    it sooner)."""
+
+    follow_graph.start()
+
+
+##############################################################################
+# SQL query budget
+
+class QueryBudgetExceeded(Exception):
+    """A request ran more SQL statements than its endpoint's budget."""
+
+
+@app.before_request
+def start_query_stats():
+    """Start counting this request's SQL statements."""
+
+    g.query_stats = QueryStats()
+
+
+@app.after_request
+def report_query_stats(resp):
+    """Report this request's SQL in headers and the log; check the budget."""
+
+    stats = g.get('query_stats')
+
+    if stats is None:
+        return resp
+
+    engines = ', '.join(f"{engine}={count}"
+                        for engine, count in sorted(stats.engines.items()))
+
+    resp.headers['X-SQL-Queries'] = str(stats.count)
+    resp.headers['X-SQL-Time'] = f"{stats.duration * 1000:.1f}ms"
+    resp.headers['X-SQL-Engines'] = engines
+
+    app.logger.info("%s %s: %d queries in %.1fms (%s)",
+                    request.method, request.path,
+                    stats.count, stats.duration * 1000, engines)
+
+    threshold = app.config['SQL_REPEATED_QUERY_THRESHOLD']
+    for shape, times in stats.repeated(threshold):
+        app.logger.warning("Possible N+1 in %s, ran %d times: %s",
+                           request.endpoint, times, shape)
+
+    budget = app.config['SQL_QUERY_BUDGETS'].get(
+        request.endpoint, app.config['SQL_QUERY_BUDGET'])
+
+    if budget is not None and stats.count > budget:
+        message = (f"{request.endpoint} ran {stats.count} SQL queries "
+                   f"(budget {budget})")
+
+        if app.config['SQL_QUERY_BUDGET_ENFORCED']:
+            raise QueryBudgetExceeded(message)
+
+        app.logger.warning(message)
+
+    return resp
+
+
+##############################################################################
+# Read replicas
+
+PRIMARY_UNTIL_KEY = "primary_until"
+
+
+@app.before_request
+def choose_replica():
+    """Let this request read from a replica, if it's safe to."""
+
+    replicas = app.config.get('SQLALCHEMY_REPLICA_BINDS')
+
+    if (replicas
+            and request.method == 'GET'
+            and request.endpoint in app.config['REPLICA_READ_ENDPOINTS']
+            and session.get(PRIMARY_UNTIL_KEY, 0) <= time.time()):
+        g.db_replica = random.choice(replicas)
+
+    else:
+        g.db_replica = None
+
+
+@app.after_request
+def pin_to_primary(resp):
+    """After a write, read from the primary for a while."""
+
+    if (app.config.get('SQLALCHEMY_REPLICA_BINDS')
+            and request.method not in ('GET', 'HEAD', 'OPTIONS')):
+        session[PRIMARY_UNTIL_KEY] = (
+            time.time() + app.config['REPLICA_STICKY_SECONDS'])
+
+    return resp
 
 
 ##############################################################################
@@ -39,10 +259,13 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a user_cache.CurrentUser; write through g.user.model.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = user_cache.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -110,6 +333,9 @@ def login():
                                  form.password.data)
 
         if user:
+            # Save the password if it was re-hashed with the current cost
+            db.session.commit()
+
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -128,6 +354,154 @@ def logout():
     return redirect("/login")
 
 
+##############################################################################
+# Pagination helpers
+
+def before_cursor(decode=decode_cursor):
+    """Decode the `before` cursor from the query string (None on page 1)."""
+
+    cursor = request.args.get('before')
+
+    if not cursor:
+        return None
+
+    try:
+        return decode(cursor)
+    except InvalidCursor:
+        abort(400)
+
+
+def wants_json():
+    """Did the client ask for the JSON variant of a page or action?"""
+
+    return request.args.get('format') == 'json'
+
+
+def unauthorized():
+    """Response for a logged-out request to a logged-in-only route."""
+
+    if wants_json():
+        return jsonify(error="Access unauthorized."), 401
+
+    flash("Access unauthorized.", "danger")
+    return redirect("/")
+
+
+def get_user_or_404(user_id):
+    """The user with `user_id`; 404 if there's none, or they're deleted."""
+
+    user = User.query.get(user_id)
+
+    if user is None or user.deleted_at is not None:
+        abort(404)
+
+    return user
+
+
+def liked_ids(messages):
+    """Ids of `messages` the logged-in user has liked (none if logged out).
+
+    One query for the page, however many likes the user has. Includes
+    their clicks the like buffer hasn't written yet.
+    """
+
+    if not g.user:
+        return set()
+
+    message_ids = [msg.id for msg in messages]
+    liked = g.user.liked_ids_among(message_ids)
+
+    if like_buffer.enabled:
+        liked = like_buffer.overlay(g.user.id, liked, message_ids)
+
+    return liked
+
+
+def messages_json(messages, next_cursor):
+    """JSON response for one page of messages."""
+
+    return jsonify(messages=[msg.serialize() for msg in messages],
+                   next=next_cursor)
+
+
+##############################################################################
+# Conditional GET
+#
+# A page's ETag and Last-Modified come from the version and updated_at of
+# the users it shows, plus the viewer (whose likes and follows it shows).
+# User.adjust_counts() bumps those on every follow, like or message, so
+# one small query tells us whether the client's copy is still current --
+# if it is, we send a 304 without loading or rendering anything else.
+
+def _next_whole_second(moment):
+    """The first whole second at or after `moment` (HTTP dates have no
+    fractions)."""
+
+    if moment.microsecond:
+        moment = moment.replace(microsecond=0) + timedelta(seconds=1)
+
+    return moment
+
+
+def not_modified(*user_ids, among=None):
+    """304 response if the client has the current page, else None.
+
+    The page shows users `user_ids`, and those in `among` (a query of user
+    ids) if given. If the page is needed, its validators are saved for
+    add_header() to send with it.
+    """
+
+    # Flashed messages are shown once, so the page has to be rendered
+    if session.get('_flashes'):
+        return None
+
+    # Their unwritten likes haven't bumped their version yet
+    if g.user and like_buffer.enabled and like_buffer.has_pending(g.user.id):
+        return None
+
+    if g.user:
+        user_ids += (g.user.id,)
+
+    if among is None:
+        users = User.id.in_(user_ids)
+
+    else:
+        # (not "id IN (...) OR id IN (subquery)": that scans all users)
+        users = User.id.in_(union_all(
+            among.statement,
+            *[select([db.literal(user_id)]) for user_id in user_ids]))
+
+    count, versions, updated_at = (db.session
+                                   .query(db.func.count(User.id),
+                                          db.func.sum(User.version),
+                                          db.func.max(User.updated_at))
+                                   .filter(users)
+                                   .one())
+
+    key = (request.full_path, g.user and g.user.id, count, versions)
+    g.etag = hashlib.sha1(repr(key).encode()).hexdigest()
+
+    # Rounded up, so a change is never dated before it happened. Until
+    # that second is over, though, another change could share its date,
+    # so there's no Last-Modified (just the ETag) before then.
+    last_modified = updated_at and _next_whole_second(updated_at)
+    g.last_modified = (last_modified
+                       if last_modified and last_modified <= datetime.utcnow()
+                       else None)
+
+    # The ETag changes with every change; only fall back on the date when
+    # the client has no ETag to send
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(g.etag)
+
+    else:
+        since = request.if_modified_since
+        fresh = bool(since and g.last_modified
+                     and g.last_modified <= since.replace(tzinfo=None))
+
+    return app.response_class(status=304) if fresh else None
+
+
 ##############################################################################
 # General user routes:
 
@@ -135,89 +509,283 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio and
+    location; results are ranked and paged with 'page'. Without one, lists
+    users newest first, paged with a 'before' user id.
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users, next_before = browse_users(request.args.get('before', type=int))
+        next_url = (url_for('list_users', before=next_before)
+                    if next_before else None)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page_number = request.args.get('page', 1, type=int)
+        users, has_more = search_users(search, page_number)
+        next_url = (url_for('list_users', q=search, page=page_number + 1)
+                    if has_more else None)
 
-    return render_template('users/index.html', users=users)
+    following_ids = (g.user.following_ids_among(u.id for u in users)
+                     if g.user else set())
+
+    return render_template('users/index.html',
+                           users=users,
+                           following_ids=following_ids,
+                           next_url=next_url)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    cached = not_modified(user_id)
+    if cached:
+        return cached
 
-    likes = Likes.query.filter_by(user_id=user_id).all()
-    like_ids = {l.message_id for l in likes}
+    user = get_user_or_404(user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages, like_ids=like_ids)
+    messages, next_cursor = page(keyset(Message
+                                        .query
+                                        .filter(Message.user_id == user_id),
+                                        Message.timestamp,
+                                        Message.id,
+                                        before_cursor())
+                                 .limit(PAGE_SIZE + 1)
+                                 .all())
+
+    if wants_json():
+        return messages_json(messages, next_cursor)
+
+    return render_template('users/show.html',
+                           user=user,
+                           messages=messages,
+                           like_ids=liked_ids(messages),
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following, a page at a time
+    (highest user id first; 'before' a user id)."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    before = request.args.get('before', type=int)
+    following, next_before = followed_users(
+        user_id, before, app.config['FOLLOW_PAGE_SIZE'])
+
+    cached = not_modified(user_id, *(u.id for u in following))
+    if cached:
+        return cached
+
+    user = get_user_or_404(user_id)
+    following_ids = g.user.following_ids_among(u.id for u in following)
+
+    return render_follow_page('users/following.html',
+                              user=user,
+                              following=following,
+                              following_ids=following_ids,
+                              next_url=next_page_url(next_before))
 
 
 @app.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user, a page at a time (highest user
+    id first; 'before' a user id)."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    before = request.args.get('before', type=int)
+    followers, next_before = follower_users(
+        user_id, before, app.config['FOLLOW_PAGE_SIZE'])
+
+    cached = not_modified(user_id, *(u.id for u in followers))
+    if cached:
+        return cached
+
+    user = get_user_or_404(user_id)
+    following_ids = g.user.following_ids_among(u.id for u in followers)
+
+    return render_follow_page('users/followers.html',
+                              user=user,
+                              followers=followers,
+                              following_ids=following_ids,
+                              next_url=next_page_url(next_before))
+
+
+# All a user card shows; following/followers pages load only these, as
+# plain rows
+USER_CARD_COLUMNS = (User.id, User.username, User.image_url,
+                     User.header_image_url, User.bio)
+
+
+def followed_users(user_id, before, limit):
+    """One page of the (not deleted) users `user_id` follows, below user id
+    `before`. Returns (user card rows, next_before)."""
+
+    if not follow_graph.ready:
+        query = (db.session
+                 .query(*USER_CARD_COLUMNS)
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id,
+                         User.visible()))
+
+        return user_page(query, Follows.user_being_followed_id, before, limit)
+
+    # Ids from memory; no join through follows
+    ids = follow_graph.following(user_id)
+    end = len(ids) if before is None else bisect_left(ids, before)
+    start = max(0, end - limit)
+
+    if start == end:
+        return [], None
+
+    users = (db.session
+             .query(*USER_CARD_COLUMNS)
+             .filter(User.id.in_(ids[start:end].tolist()), User.visible())
+             .order_by(User.id.desc())
+             .all())
+
+    # (A page short of deleted users still leads to the next one)
+    return users, ids[start] if start else None
+
+
+def follower_users(user_id, before, limit):
+    """One page of the (not deleted) followers of `user_id`, below user id
+    `before`. Returns (user card rows, next_before)."""
+
+    query = (db.session
+             .query(*USER_CARD_COLUMNS)
+             .join(Follows, Follows.user_following_id == User.id)
+             .filter(Follows.user_being_followed_id == user_id,
+                     User.visible()))
+
+    return user_page(query, Follows.user_following_id, before, limit)
+
+
+def user_page(query, id_col, before, limit):
+    """Up to `limit` rows of `query`, highest `id_col` first, below
+    `before`. Returns (rows, next_before); next_before is None on the last
+    page.
+
+    Ordering by the follows column (not users.id) lets the follows index
+    hand rows over in order, so a page is a seek however long the list.
+    """
+
+    if before is not None:
+        query = query.filter(id_col < before)
+
+    rows = query.order_by(id_col.desc()).limit(limit + 1).all()
+
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, rows[-1].id
+
+
+def next_page_url(next_before):
+    """Link to the next page of this list, or None on the last page."""
+
+    if next_before is None:
+        return None
+
+    return url_for(request.endpoint, before=next_before, **request.view_args)
+
+
+def render_follow_page(template_name, **context):
+    """Render a following/followers page, streamed if STREAM_FOLLOW_PAGES.
+
+    Its queries have all run by now, so streaming doesn't hide them from
+    the query budget; the page just goes out as it renders rather than
+    being built up whole first.
+    """
+
+    if app.config['STREAM_FOLLOW_PAGES']:
+        return stream_template(template_name, **context)
+
+    return render_template(template_name, **context)
+
+
+def stream_template(template_name, **context):
+    """render_template(), sent a few chunks at a time as it renders (what
+    Flask 2.2's flask.stream_template does)."""
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(100)
+
+    return Response(stream_with_context(stream))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
+    """Add a follow for the currently-logged-in user.
+
+    With ?format=json, answers with the new state instead of redirecting.
+    """
 
     if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+        return unauthorized()
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    get_user_or_404(follow_id)
+
+    db.session.add(Follows(user_following_id=g.user.id,
+                           user_being_followed_id=follow_id))
+
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # Already following (a double click)
+        db.session.rollback()
+    else:
+        User.adjust_counts(g.user.id, following_count=1)
+        User.adjust_counts(follow_id, follower_count=1)
+        add_followee(g.user.id, follow_id)
+        forget_recommendation(g.user.id, follow_id)
+        db.session.commit()
+        follow_graph.add(g.user.id, follow_id)
+
+    if wants_json():
+        return jsonify(user_id=follow_id, following=True)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
-    """Have currently-logged-in-user stop following this user."""
+    """Have currently-logged-in-user stop following this user.
+
+    With ?format=json, answers with the new state instead of redirecting.
+    """
 
     if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+        return unauthorized()
+
+    removed = (Follows
+               .query
+               .filter_by(user_following_id=g.user.id,
+                          user_being_followed_id=follow_id)
+               .delete(synchronize_session=False))
+
+    # (nothing to undo if they weren't following)
+    if removed:
+        User.adjust_counts(g.user.id, following_count=-1)
+        User.adjust_counts(follow_id, follower_count=-1)
+        remove_followee(g.user.id, follow_id)
+        restore_fanout({follow_id: 1})
+        db.session.commit()
+        follow_graph.remove(g.user.id, follow_id)
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    if wants_json():
+        return jsonify(user_id=follow_id, following=False)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -234,9 +802,9 @@ def profile():
 
     if form.validate_on_submit():
         password = form.password.data
-        user_valid = User.authenticate(g.user.username, password)
+        user = User.authenticate(g.user.username, password)
 
-        if not user_valid:
+        if not user:
             flash("Access unauthorized.", "danger")
             return redirect("/")
 
@@ -247,20 +815,23 @@ def profile():
         bio = form.bio.data
         location = form.location.data
 
-        g.user.username = username
-        g.user.email = email
+        user.username = username
+        user.email = email
 
         # Keep current URL if they left it blank
         if image_url:
-            g.user.image_url = image_url
+            user.image_url = image_url
 
         # Keep current URL if they left it blank
         if header_image_url:
-            g.user.header_image_url = header_image_url
-        g.user.bio = bio
-        g.user.location = location
+            user.header_image_url = header_image_url
+        user.bio = bio
+        user.location = location
+        User.profile_changed(user.id)
 
         db.session.commit()
+        user_cache.invalidate(user.id)
+        message_cards.invalidate_author(user.id)
 
         return redirect(f'/users/{g.user.id}')
 
@@ -280,8 +851,12 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Hidden everywhere now; `flask purge-accounts` deletes their rows later
+    User.mark_deleted(g.user.id)
+    request_purge(g.user.id)
     db.session.commit()
+    user_cache.invalidate(g.user.id)
+    message_cards.invalidate_author(g.user.id)
 
     return redirect("/signup")
 
@@ -303,8 +878,12 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        User.adjust_counts(g.user.id, message_count=1)
+        fan_out_message(msg)
+        index_message(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -312,33 +891,47 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search messages.
+
+    Takes a 'q' param of words, prefix* terms and "quoted phrases", all of
+    which must match. Results are newest first, paged with 'before'.
+    """
+
+    search = request.args.get('q', '')
+
+    messages, next_cursor = search_messages(search, before=before_cursor())
+
+    if wants_json():
+        return messages_json(messages, next_cursor)
+
+    return render_template('messages/search.html',
+                           search=search,
+                           messages=messages,
+                           like_ids=liked_ids(messages),
+                           next_cursor=next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
-
-    likes = Likes.query.filter_by(user_id=msg.user_id).all()
+    # Messages can't be edited, so only their author's version matters
+    cached = not_modified(among=(db.session
+                                 .query(Message.user_id)
+                                 .filter(Message.id == message_id)))
+    if cached:
+        return cached
 
-    # Use a set b/c it only has keys and O(1) searching because you're
-    # searching for that specific key
-    # set comprehension syntax - replace with curly braces
-    # jinja syntax will be the same
-
-    # like_ids is a better variable name than curr_liked_message
-    like_ids = {l.message_id for l in likes}
+    msg = Message.query.get_or_404(message_id)
 
-    messages = (Message
-                .query
-                .filter(Message.user_id == g.user.id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    if msg.user.deleted_at is not None:
+        abort(404)
 
     return render_template('messages/show.html',
                            message=msg,
-                           messages=messages,
-                           like_ids=like_ids)
+                           like_ids=liked_ids([msg]))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -350,6 +943,9 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    User.adjust_counts(msg.user_id, message_count=-1)
+    Message.release_like_counts([msg.id])
+    unindex_message(msg.id)
     db.session.delete(msg)
     db.session.commit()
 
@@ -359,40 +955,111 @@ def messages_destroy(message_id):
 ##############################################################################
 # Likes routes:
 
+def liked_response(message_id, liked):
+    """Response to a like (or unlike) click: the new state as JSON, or
+    back to a page."""
+
+    if wants_json():
+        return jsonify(message_id=message_id, liked=liked)
+
+    if liked:
+        return redirect('/')
+
+    return redirect(f'/users/{g.user.id}/likes')
+
+
 @app.route('/messages/<int:message_id>/like', methods=["POST"])
 def like_message(message_id):
-    """allows user to like a message and save it to a liked message page"""
+    """allows user to like a message and save it to a liked message page
+
+    With ?format=json, answers with the new state instead of redirecting.
+    """
+
+    if not g.user:
+        return unauthorized()
+
+    if like_buffer.enabled:
+        like_buffer.record(g.user.id, message_id, True)
+        return liked_response(message_id, True)
+
     current_msg_like = Likes(user_id=g.user.id, message_id=message_id)
     db.session.add(current_msg_like)
-    db.session.commit()
-    return redirect('/')
+
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # Already liked (a double click): nothing to count. Or there's
+        # no such message.
+        db.session.rollback()
+        if not g.user.liked_ids_among([message_id]):
+            abort(404)
+    else:
+        User.adjust_counts(g.user.id, like_count=1)
+        db.session.commit()
+
+    return liked_response(message_id, True)
 
 
 @app.route('/users/<int:user_id>/likes')
 def likes_page(user_id):
-    """takes user to page of likes"""
+    """takes user to page of likes
 
-    likes = Likes.query.filter_by(user_id=user_id).all()
-    like_ids = {l.message_id for l in likes}
+    Most recently liked first, paged by like id: a backwards seek on
+    ix_likes_user_id, however far back the page is.
+    """
+
+    user = get_user_or_404(user_id)
+
+    likes = (db.session
+             .query(Message, Likes.id)
+             .options(db.joinedload(Message.user))
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id, Message.visible()))
+
+    before = before_cursor(decode_id_cursor)
+    if before is not None:
+        likes = likes.filter(Likes.id < before)
 
-    messages = Message.query.filter(Message.id.in_(like_ids))
+    messages, next_cursor = id_page(likes
+                                    .order_by(Likes.id.desc())
+                                    .limit(PAGE_SIZE + 1)
+                                    .all())
+
+    if wants_json():
+        return messages_json(messages, next_cursor)
 
     return render_template('messages/likes.html',
-                           user=g.user,
+                           user=user,
                            messages=messages,
-                           like_ids=like_ids)
+                           like_ids=liked_ids(messages),
+                           next_cursor=next_cursor)
 
 
 @app.route('/messages/<int:message_id>/unlike', methods=["POST"])
 def unlike_message(message_id):
     """Unlikes a message and removes it from our likes
-    database and redirects to the user likes page"""
+    database and redirects to the user likes page
 
-    current_msg = Likes.query.filter_by(message_id=message_id).first()
-    db.session.delete(current_msg)
-    db.session.commit()
+    With ?format=json, answers with the new state instead of redirecting.
+    """
 
-    return redirect(f'/users/{g.user.id}/likes')
+    if not g.user:
+        return unauthorized()
+
+    if like_buffer.enabled:
+        like_buffer.record(g.user.id, message_id, False)
+        return liked_response(message_id, False)
+
+    removed = (Likes
+               .query
+               .filter_by(user_id=g.user.id, message_id=message_id)
+               .delete(synchronize_session=False))
+
+    if removed:
+        User.adjust_counts(g.user.id, like_count=-1)
+        db.session.commit()
+
+    return liked_response(message_id, False)
 
 
 ##############################################################################
@@ -404,30 +1071,190 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, with a
+      cursor for the next (older) page
     """
 
     if g.user:
 
-        users_list = [u.id for u in g.user.following]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(users_list))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages, next_cursor = page(home_timeline(
+            g.user.id,
+            before=before_cursor(),
+            limit=PAGE_SIZE + 1,
+            following_count=g.user.following_count))
 
-        likes = Likes.query.filter_by(user_id=g.user.id).all()
-        like_ids = {l.message_id for l in likes}
+        if wants_json():
+            return messages_json(messages, next_cursor)
 
         return render_template('home.html',
                                messages=messages,
-                               like_ids=like_ids)
+                               like_ids=liked_ids(messages),
+                               next_cursor=next_cursor,
+                               suggestions=recommended_users(g.user.id))
 
     else:
         return render_template('home-anon.html')
 
 
+@app.errorhandler(PasswordPoolFull)
+def password_pool_full(e):
+    """Too many logins/signups in flight: shed load rather than queue."""
+
+    return ("Too many sign-ins right now; please try again in a moment.",
+            503, {'Retry-After': '1'})
+
+
+@app.route('/assets/<path:filename>')
+def built_asset(filename):
+    """A fingerprinted static file (see assets.py)."""
+
+    return assets.send(filename)
+
+
+@app.route('/metrics')
+def metrics():
+    """Runtime stats as JSON (only if METRICS_ENABLED)."""
+
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+
+    return jsonify(password_pool=password_pool.stats(),
+                   user_cache=user_cache.stats(),
+                   message_cards=message_cards.stats(),
+                   like_buffer=like_buffer.stats(),
+                   follow_graph=follow_graph.stats(),
+                   account_purges=purge_stats(),
+                   sql_queries_by_engine=dict(ENGINE_QUERY_COUNTS))
+
+
+##############################################################################
+# Maintenance commands
+
+@app.cli.command('rebuild-timelines')
+@click.argument('user_ids', nargs=-1, type=int)
+def rebuild_timelines_command(user_ids):
+    """Rebuild home timelines from messages and follows.
+
+    Rebuilds the given users' timelines, or everyone's if no ids are given.
+    """
+
+    if user_ids:
+        for user_id in user_ids:
+            rebuild_timeline(user_id)
+    else:
+        rebuild_all_timelines()
+
+    db.session.commit()
+    click.echo(f"Rebuilt {len(user_ids) or 'all'} timeline(s).")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and compress static files for /assets/."""
+
+    manifest = build_assets(app.static_folder, log=click.echo)
+    click.echo(f"Built {len(manifest)} asset(s); restart the app to use them.")
+
+
+@app.cli.command('create-search-indexes')
+def create_search_indexes_command():
+    """Add the user search indexes to an existing database."""
+
+    create_search_indexes()
+    db.session.commit()
+    click.echo("Search indexes created.")
+
+
+@app.cli.command('reindex-messages')
+def reindex_messages_command():
+    """Rebuild the message search index from messages."""
+
+    reindex_messages()
+    db.session.commit()
+    click.echo("Message search index rebuilt.")
+
+
+@app.cli.command('reconcile-counters')
+@click.argument('user_ids', nargs=-1, type=int)
+def reconcile_counters_command(user_ids):
+    """Recompute users' message/like/follow counters and fix any drift.
+
+    Checks the given users, or everyone if no ids are given.
+    """
+
+    fixed = User.reconcile_counts(user_ids or None)
+    db.session.commit()
+    click.echo(f"Fixed counters for {len(fixed)} user(s).")
+
+
+@app.cli.command('purge-accounts')
+@click.option('--chunk-size', default=DEFAULT_CHUNK_SIZE,
+              help="Rows to delete per transaction.")
+@click.option('--watch', type=float, default=None,
+              help="Keep checking for new purges every this many seconds.")
+def purge_accounts_command(chunk_size, watch):
+    """Delete the rows of accounts deleted since the last run."""
+
+    while True:
+        purged = purge_accounts(chunk_size, log=click.echo)
+        if purged or watch is None:
+            click.echo(f"Purged {purged} account(s).")
+
+        if watch is None:
+            break
+
+        db.session.remove()
+        time.sleep(watch)
+
+
+@app.cli.command('build-recommendations')
+@click.option('--chunk-size', default=RECOMMENDATION_CHUNK_SIZE,
+              help="Users to score (and save) at a time.")
+@click.option('--top', default=DEFAULT_TOP_N,
+              help="Suggestions to keep per user.")
+def build_recommendations_command(chunk_size, top):
+    """Recompute everyone's "Who to follow" suggestions (nightly)."""
+
+    try:
+        saved = build_recommendations(chunk_size, top, log=click.echo)
+    except RecommendationsUnavailable as e:
+        raise click.ClickException(str(e))
+
+    click.echo(f"Saved {saved} suggestion(s).")
+
+
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help="List pending migrations only.")
+def migrate_command(status):
+    """Apply pending schema migrations (see migrations.py)."""
+
+    if status:
+        pending = [version for version, _ in pending_migrations()]
+        click.echo("\n".join(pending) or "Up to date.")
+        return
+
+    done = migrate(log=click.echo)
+    click.echo(f"Applied {len(done)} migration(s).")
+
+
+@app.cli.command('check-query-plans')
+@click.option('--min-rows', default=DEFAULT_MIN_ROWS,
+              help="Only flag scans of tables at least this big.")
+def check_query_plans_command(min_rows):
+    """Fail if a main route's query sequentially scans a large table."""
+
+    problems = check_query_plans(app, min_rows)
+
+    for path, statement, tables in problems:
+        click.echo(f"{path}: seq scan on {', '.join(tables)}\n"
+                   f"    {' '.join(statement.split())}\n")
+
+    if problems:
+        raise SystemExit(1)
+
+    click.echo("No sequential scans of large tables.")
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -437,7 +1264,23 @@ def homepage():
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Pages with validators (see not_modified()) may be kept, but have to
+    be revalidated; they depend on who's looking, so only by the browser.
+    Static files set their own.
+    """
+
+    if request.endpoint in ('static', 'built_asset'):
+        return req
+
+    if 'etag' in g and req.status_code in (200, 304):
+        req.set_etag(g.etag)
+        if g.last_modified:
+            req.last_modified = g.last_modified
+        req.headers['Cache-Control'] = 'private, no-cache'
+        req.headers['Vary'] = 'Cookie'
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
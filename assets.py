@@ -0,0 +1,198 @@
+"""Fingerprinted, precompressed static files.
+
+`flask build-assets` copies everything in static/ to static/build/, with a
+hash of its contents in the name (style.css -> style.1a2b3c4d5e6f.css),
+plus .gz and .br versions of text files. static/build/manifest.json maps
+the original paths to the built ones.
+
+A fingerprinted file never changes, so /assets/ serves them with a
+year-long, immutable Cache-Control, picking the brotli or gzip version
+when the browser accepts it. Templates link files with asset_url(), which
+falls back to the plain /static/ file if it hasn't been built (or in
+debug mode, so edits show up right away).
+
+Brotli needs the `brotli` package; without it only .gz files are made.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+
+from flask import request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+
+# Images and fonts are compressed already
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.map'}
+
+MAX_AGE = 365 * 24 * 60 * 60
+
+CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)/static/([^'")]+)\1\s*\)''')
+
+
+def fingerprint(path, content):
+    """`path` with a hash of `content` before its extension."""
+
+    root, ext = os.path.splitext(path)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+
+    return f"{root}.{digest}{ext}"
+
+
+def _gzip(content):
+    buf = io.BytesIO()
+
+    # mtime=0 so rebuilding the same file gives the same bytes
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9,
+                       mtime=0) as f:
+        f.write(content)
+
+    return buf.getvalue()
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def build_assets(static_folder, log=print):
+    """Build static_folder/build/ and its manifest; returns the manifest.
+
+    Files from earlier builds are left alone, so pages rendered before a
+    deploy can still load theirs.
+    """
+
+    build_folder = os.path.join(static_folder, BUILD_DIR)
+
+    sources = []
+    for root, dirs, files in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder):
+            dirs[:] = [d for d in dirs if d != BUILD_DIR]
+
+        for name in files:
+            path = os.path.join(root, name)
+            sources.append(os.path.relpath(path, static_folder)
+                           .replace(os.sep, '/'))
+
+    manifest = {}
+
+    # CSS last, so its url()s can point at the fingerprinted images
+    for path in sorted(sources, key=lambda path: (path.endswith('.css'),
+                                                  path)):
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            content = f.read()
+
+        if path.endswith('.css'):
+            content = CSS_URL_RE.sub(
+                lambda m: (f'url("/assets/{manifest[m.group(2)]}")'
+                           if m.group(2) in manifest else m.group(0)),
+                content.decode()).encode()
+
+        built = fingerprint(path, content)
+        target = os.path.join(build_folder, built)
+        _write(target, content)
+
+        sizes = [len(content)]
+
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            variants = [('.gz', _gzip(content))]
+            if brotli is not None:
+                variants.append(('.br', brotli.compress(content)))
+
+            for suffix, compressed in variants:
+                # Not worth it for tiny files
+                if len(compressed) < len(content):
+                    _write(target + suffix, compressed)
+                    sizes.append(len(compressed))
+
+        manifest[path] = built
+        log(f"{path} -> {built} ({', '.join(map(str, sizes))} bytes)")
+
+    if brotli is None:
+        log("brotli isn't installed; made .gz files only")
+
+    with open(os.path.join(build_folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class Assets:
+    """Links to and serves the built files."""
+
+    def __init__(self, app=None):
+        self.folder = None
+        self.manifest = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Load the manifest (unless debugging); make asset_url()
+        available to templates."""
+
+        self.folder = os.path.join(app.static_folder, BUILD_DIR)
+        self.manifest = {}
+
+        manifest_path = os.path.join(self.folder, MANIFEST)
+
+        if not app.debug and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+        app.jinja_env.globals['asset_url'] = self.url
+
+    def url(self, path):
+        """URL for static file `path` (e.g. 'stylesheets/style.css')."""
+
+        built = self.manifest.get(path)
+
+        if built is None:
+            return url_for('static', filename=path)
+
+        return url_for('built_asset', filename=built)
+
+    def send(self, filename):
+        """Response for built file `filename`, compressed if the browser
+        takes it."""
+
+        accepted = request.accept_encodings
+        encoding = None
+
+        for name, suffix in (('br', '.br'), ('gzip', '.gz')):
+            path = safe_join(self.folder, filename + suffix)
+
+            if accepted[name] and path and os.path.isfile(path):
+                encoding = name
+                break
+
+        if encoding:
+            resp = send_from_directory(
+                self.folder, filename + suffix,
+                mimetype=(mimetypes.guess_type(filename)[0]
+                          or 'application/octet-stream'))
+            resp.headers['Content-Encoding'] = encoding
+
+        else:
+            resp = send_from_directory(self.folder, filename)
+
+        resp.headers['Cache-Control'] = f'public, max-age={MAX_AGE}, immutable'
+        resp.headers['Vary'] = 'Accept-Encoding'
+
+        return resp
+
+
+assets = Assets()
@@ -0,0 +1,353 @@
+"""Route-level latency and throughput benchmark.
+
+    python benchmarks/routes.py postgresql:///warbler_bench \\
+        --scale 1000:20000 --scale 10000:200000 --output routes.json
+
+WARNING: this drops and recreates every table in the database you give it.
+Point it at a scratch database, never at real data.
+
+For each --scale USERS:MESSAGES it generates CSVs with
+generator/create_csvs.py, loads them with seed.py, and then times the main
+routes, logged in as a sample of users:
+
+- through the Flask test client, one request at a time (app + database
+  cost, no HTTP);
+- through a local gunicorn (the Procfile's threaded workers), with
+  --concurrency clients at once.
+
+The like/unlike and follow/unfollow POSTs are timed in pairs, so every
+run leaves the data as it found it. Prints requests/sec and p50/p95/p99
+milliseconds per route, and writes them to --output as JSON (with the git
+commit) so runs can be compared across commits.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_SCALES = ['1000:20000', '10000:200000']
+
+
+class Viewer:
+    """A logged-in user, plus the ids their requests will use."""
+
+    def __init__(self, user_id, other_user_id, message_id,
+                 like_id, follow_id):
+        self.user_id = user_id
+        self.other_user_id = other_user_id
+        self.message_id = message_id
+        self.like_id = like_id
+        self.follow_id = follow_id
+
+
+# (route name, requests for one iteration as (method, path) pairs)
+ROUTES = [
+    ('GET /', lambda v: [('GET', '/')]),
+    ('GET /users', lambda v: [('GET', '/users')]),
+    ('GET /users/<id>',
+     lambda v: [('GET', f'/users/{v.other_user_id}')]),
+    ('GET /users/<id>/likes',
+     lambda v: [('GET', f'/users/{v.other_user_id}/likes')]),
+    ('GET /messages/<id>',
+     lambda v: [('GET', f'/messages/{v.message_id}')]),
+    ('POST like+unlike',
+     lambda v: [('POST', f'/messages/{v.like_id}/like'),
+                ('POST', f'/messages/{v.like_id}/unlike')]),
+    ('POST follow+unfollow',
+     lambda v: [('POST', f'/users/follow/{v.follow_id}'),
+                ('POST', f'/users/stop-following/{v.follow_id}')]),
+]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed_scale(database_url, users, messages, seed):
+    """Generate and load a dataset of the given size."""
+
+    env = dict(os.environ, DATABASE_URL=database_url)
+
+    with tempfile.TemporaryDirectory() as csv_dir:
+        subprocess.run([sys.executable, 'generator/create_csvs.py',
+                        '--users', str(users),
+                        '--messages', str(messages),
+                        '--seed', str(seed),
+                        '--output', csv_dir],
+                       cwd=ROOT, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        subprocess.run([sys.executable, 'seed.py', csv_dir],
+                       cwd=ROOT, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+
+
+def pick_viewers(count, seed):
+    """`count` users, each with a message to like and a user to follow
+    that they haven't already."""
+
+    from models import db, Follows, Likes, Message, User
+
+    rng = random.Random(seed)
+    max_user = db.session.query(db.func.max(User.id)).scalar()
+    max_message = db.session.query(db.func.max(Message.id)).scalar()
+    viewers = []
+
+    for user_id in rng.sample(range(1, max_user + 1), count):
+        liked = {like_id for (like_id,) in db.session
+                 .query(Likes.message_id).filter(Likes.user_id == user_id)}
+        followed = {user_id} | {followed_id for (followed_id,) in db.session
+                                .query(Follows.user_being_followed_id)
+                                .filter(Follows.user_following_id == user_id)}
+
+        like_id = rng.choice([i for i in rng.sample(range(1, max_message + 1),
+                                                    len(liked) + 1)
+                              if i not in liked])
+        follow_id = rng.choice([i for i in rng.sample(range(1, max_user + 1),
+                                                      len(followed) + 1)
+                                if i not in followed])
+
+        viewers.append(Viewer(user_id=user_id,
+                              other_user_id=rng.randint(1, max_user),
+                              message_id=rng.randint(1, max_message),
+                              like_id=like_id,
+                              follow_id=follow_id))
+
+    return viewers
+
+
+def summarize(times, wall):
+    """Throughput and percentiles of a list of timings (seconds)."""
+
+    ordered = sorted(times)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1,
+                                 int(len(ordered) * p))] * 1000, 3)
+
+    return {'requests': len(ordered),
+            'rps': round(len(ordered) / wall, 1),
+            'p50_ms': pct(0.50),
+            'p95_ms': pct(0.95),
+            'p99_ms': pct(0.99)}
+
+
+def check_status(method, path, status):
+    if status >= 400:
+        raise RuntimeError(f"{method} {path} returned {status}")
+
+
+##############################################################################
+# Test client
+
+def run_test_client(app, viewers, iterations):
+    """Time each route through the Flask test client, sequentially."""
+
+    from app import CURR_USER_KEY
+
+    clients = []
+    for viewer in viewers:
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = viewer.user_id
+        clients.append((viewer, client))
+
+    results = {}
+
+    for name, requests in ROUTES:
+        times = []
+        started = time.perf_counter()
+
+        for i in range(iterations):
+            viewer, client = clients[i % len(clients)]
+
+            for method, path in requests(viewer):
+                start = time.perf_counter()
+                resp = client.open(path, method=method)
+                times.append(time.perf_counter() - start)
+                check_status(method, path, resp.status_code)
+
+        results[name] = summarize(times, time.perf_counter() - started)
+
+    return results
+
+
+##############################################################################
+# gunicorn
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(database_url, port, workers):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    server = subprocess.Popen(
+        # (gthread and WEB_THREADS come from gunicorn.conf.py)
+        ['gunicorn', '--workers', str(workers),
+         '--bind', f'127.0.0.1:{port}', 'app:app'],
+        cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.kill()
+    raise RuntimeError("gunicorn didn't start")
+
+
+def run_gunicorn(app, viewers, iterations, port, concurrency):
+    """Time each route through gunicorn, `concurrency` clients at once.
+
+    Each client thread is a different viewer, so the POST pairs never
+    race each other.
+    """
+
+    from app import CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+    clients = viewers[:concurrency]
+
+    results = {}
+
+    for name, requests in ROUTES:
+        times = []
+        lock = threading.Lock()
+
+        def client(index):
+            viewer = clients[index]
+            cookie = serializer.dumps({CURR_USER_KEY: viewer.user_id})
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            mine = []
+
+            for _ in range(index, iterations, len(clients)):
+                for method, path in requests(viewer):
+                    start = time.perf_counter()
+                    conn.request(method, path, headers={
+                        'Cookie': f'{cookie_name}={cookie}'})
+                    resp = conn.getresponse()
+                    resp.read()
+                    mine.append(time.perf_counter() - start)
+                    check_status(method, path, resp.status)
+
+            conn.close()
+            with lock:
+                times.extend(mine)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(len(clients)) as pool:
+            list(pool.map(client, range(len(clients))))
+
+        results[name] = summarize(times, time.perf_counter() - started)
+
+    return results
+
+
+def print_results(label, results):
+    print(f"  {label}")
+    for name, stats in results.items():
+        print(f"    {name:<24} {stats['rps']:>8.1f} req/s"
+              f"  p50 {stats['p50_ms']:>8.2f}ms"
+              f"  p95 {stats['p95_ms']:>8.2f}ms"
+              f"  p99 {stats['p99_ms']:>8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('database_url')
+    parser.add_argument('--scale', action='append',
+                        help="USERS:MESSAGES (repeatable; default: "
+                             f"{' '.join(DEFAULT_SCALES)})")
+    parser.add_argument('--iterations', type=int, default=200,
+                        help="requests per route")
+    parser.add_argument('--viewers', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--gunicorn-workers', type=int, default=2)
+    parser.add_argument('--no-gunicorn', action='store_true')
+    parser.add_argument('--seed', default='bench')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+
+    from app import app
+    from models import db
+    from user_cache import user_cache
+
+    report = {'commit': git_commit(),
+              'database': db.engine.dialect.name,
+              'iterations': args.iterations,
+              'concurrency': args.concurrency,
+              'scales': []}
+
+    for scale in args.scale or DEFAULT_SCALES:
+        users, messages = (int(n) for n in scale.split(':'))
+
+        # Let go of our connections so seed.py can drop the tables
+        db.session.remove()
+        db.engine.dispose()
+        user_cache.clear()
+
+        print(f"Seeding {users:,} users / {messages:,} messages...")
+        start = time.perf_counter()
+        seed_scale(args.database_url, users, messages, args.seed)
+        print(f"  seeded in {time.perf_counter() - start:.1f}s")
+
+        with app.app_context():
+            viewers = pick_viewers(max(args.viewers, args.concurrency),
+                                   args.seed)
+            db.session.remove()
+
+        result = {'users': users, 'messages': messages}
+
+        result['test_client'] = run_test_client(app, viewers,
+                                                args.iterations)
+        print_results("test client", result['test_client'])
+
+        if not args.no_gunicorn:
+            port = free_port()
+            server = start_gunicorn(args.database_url, port,
+                                    args.gunicorn_workers)
+            try:
+                result['gunicorn'] = run_gunicorn(app, viewers,
+                                                  args.iterations, port,
+                                                  args.concurrency)
+            finally:
+                server.terminate()
+                server.wait()
+
+            print_results(f"gunicorn ({args.concurrency} clients)",
+                          result['gunicorn'])
+
+        report['scales'].append(result)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Benchmark the home timeline engines against each other.
+
+    python benchmarks/timeline_engines.py postgresql:///warbler_bench \\
+        --viewers 20 --follow 2000 --output timelines.json
+
+Runs against a database that's already loaded (e.g. by seed.py or
+benchmarks/routes.py) and changes nothing in it: the extra follows made by
+--follow, and the timelines rebuilt for them, are rolled back at the end.
+
+Picks the --viewers users who follow the most accounts (after --follow
+makes each of them follow up to that many more), then times
+timelines.home_timeline() under each TIMELINE_ENGINE for --pages pages,
+following the cursors. Checks that every engine returns the same pages,
+and prints median/p95 milliseconds per engine and page.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def time_ms(fn, repeat):
+    """Run `fn` `repeat` times; return each run's wall time in ms and its
+    last result."""
+
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+
+    return times, result
+
+
+def summarize(times):
+    """Median and p95 of a list of timings."""
+
+    ordered = sorted(times)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    return {'median_ms': round(statistics.median(ordered), 3),
+            'p95_ms': round(p95, 3)}
+
+
+def add_follows(db, viewer_ids, count):
+    """Make each viewer follow up to `count` more random accounts, and
+    rebuild their timelines to match. Doesn't commit."""
+
+    from models import Follows, User
+    from timelines import rebuild_timeline
+
+    for viewer_id in viewer_ids:
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == viewer_id))
+        new_ids = [user_id for (user_id,) in (db.session
+                                              .query(User.id)
+                                              .filter(User.id != viewer_id,
+                                                      ~User.id.in_(followed))
+                                              .order_by(db.func.random())
+                                              .limit(count))]
+
+        db.session.bulk_insert_mappings(Follows, [
+            dict(user_following_id=viewer_id, user_being_followed_id=user_id)
+            for user_id in new_ids])
+        User.adjust_counts(viewer_id, following_count=len(new_ids))
+        rebuild_timeline(viewer_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('database_url')
+    parser.add_argument('--viewers', type=int, default=20)
+    parser.add_argument('--follow', type=int, default=0,
+                        help="Extra accounts for each viewer to follow.")
+    parser.add_argument('--pages', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+
+    from app import app
+    from models import db, User
+    from pagination import PAGE_SIZE, page
+    from timelines import TIMELINE_ENGINES, home_timeline
+
+    results = {}
+
+    with app.app_context():
+        viewer_ids = [user_id for (user_id,) in (db.session
+                                                 .query(User.id)
+                                                 .filter(User.visible())
+                                                 .order_by(
+                                                     User.following_count
+                                                     .desc())
+                                                 .limit(args.viewers))]
+
+        try:
+            if args.follow:
+                add_follows(db, viewer_ids, args.follow)
+                db.session.flush()
+
+            following = [(db.session
+                          .query(User.following_count)
+                          .filter(User.id == viewer_id)
+                          .scalar()) for viewer_id in viewer_ids]
+
+            print(f"{len(viewer_ids)} viewers following "
+                  f"{min(following)}-{max(following)} accounts")
+
+            pages_seen = {}
+
+            for engine in TIMELINE_ENGINES:
+                app.config['TIMELINE_ENGINE'] = engine
+                times = [[] for _ in range(args.pages)]
+
+                for viewer_id, count in zip(viewer_ids, following):
+                    cursor = None
+
+                    for number in range(args.pages):
+                        run, messages = time_ms(
+                            lambda: home_timeline(viewer_id,
+                                                  before=cursor,
+                                                  limit=PAGE_SIZE + 1,
+                                                  following_count=count),
+                            args.repeat)
+                        times[number].extend(run)
+
+                        messages, next_cursor = page(messages)
+                        pages_seen.setdefault((viewer_id, number), {})[
+                            engine] = [msg.id for msg in messages]
+
+                        if next_cursor is None:
+                            break
+                        cursor = (messages[-1].timestamp, messages[-1].id)
+
+                results[engine] = [summarize(run) for run in times if run]
+
+                print(f"{engine:>8}: " + "  ".join(
+                    f"page {number + 1} {result['median_ms']:>8.2f}ms"
+                    for number, result in enumerate(results[engine]))
+                    + "  (median)")
+
+            mismatches = [key for key, by_engine in pages_seen.items()
+                          if len({tuple(ids) for ids in by_engine.values()})
+                          > 1]
+            if mismatches:
+                print(f"Engines disagree on {len(mismatches)} page(s)!")
+
+        finally:
+            db.session.rollback()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'viewers': len(viewer_ids),
+                       'following': following,
+                       'results': results,
+                       'mismatched_pages': len(mismatches)},
+                      output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""Benchmark indexed user search against the old LIKE '%q%' scan.
+
+    python benchmarks/user_search.py postgresql:///warbler_bench --users 1000000
+
+WARNING: this drops and recreates every table in the database you give it.
+Point it at a scratch database, never at real data.
+
+Fills `users` with synthetic rows, then times each search term through the
+old `User.username.like('%q%').all()` query and through search.search_users().
+Prints median/p95 milliseconds per path, and writes them to --output as JSON
+if given.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ['bird', 'song', 'coffee', 'river', 'python', 'garden', 'music',
+         'travel', 'winter', 'mountain', 'books', 'cycling', 'ocean',
+         'pizza', 'jazz', 'photo', 'summer', 'forest', 'design', 'code']
+
+CITIES = ['Paris', 'Berlin', 'Lagos', 'Lima', 'Oslo', 'Pune', 'Quito',
+          'Seoul', 'Tokyo', 'Tunis', 'Austin', 'Denver', 'Boston']
+
+TERMS = ['bird', 'coffee12', 'Oslo', 'jazz ocean', 'riv', 'nosuchuser']
+
+CHUNK_SIZE = 10000
+
+
+def fill_postgres(db, num_users):
+    """Insert `num_users` synthetic users server-side with generate_series."""
+
+    words = ', '.join(f"'{w}'" for w in WORDS)
+    cities = ', '.join(f"'{c}'" for c in CITIES)
+
+    db.session.execute(f"""
+        INSERT INTO users (email, username, password, bio, location)
+        SELECT 'user' || i || '@example.com',
+               (ARRAY[{words}])[1 + i % {len(WORDS)}] || i,
+               'not-a-real-hash',
+               (ARRAY[{words}])[1 + (i / 7) % {len(WORDS)}] || ' and ' ||
+               (ARRAY[{words}])[1 + (i / 131) % {len(WORDS)}],
+               (ARRAY[{cities}])[1 + (i / 3) % {len(CITIES)}]
+        FROM generate_series(1, :num_users) AS i
+    """, {'num_users': num_users})
+
+
+def fill_other(db, num_users):
+    """Insert `num_users` synthetic users in executemany chunks."""
+
+    from models import User
+
+    for start in range(1, num_users + 1, CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, num_users + 1)
+        db.session.execute(User.__table__.insert(), [
+            dict(email=f"user{i}@example.com",
+                 username=f"{WORDS[i % len(WORDS)]}{i}",
+                 password='not-a-real-hash',
+                 bio=(f"{WORDS[(i // 7) % len(WORDS)]} and "
+                      f"{WORDS[(i // 131) % len(WORDS)]}"),
+                 location=CITIES[(i // 3) % len(CITIES)])
+            for i in range(start, stop)
+        ])
+
+
+def time_ms(fn, repeat):
+    """Run `fn` `repeat` times; return each run's wall time in ms."""
+
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+
+    return times
+
+
+def summarize(times):
+    """Median and p95 of a list of timings."""
+
+    ordered = sorted(times)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    return {'median_ms': round(statistics.median(ordered), 3),
+            'p95_ms': round(p95, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('database_url')
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+
+    from app import app
+    from models import db, User
+    from search import search_users
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        start = time.perf_counter()
+        if db.engine.dialect.name == 'postgresql':
+            fill_postgres(db, args.users)
+        else:
+            fill_other(db, args.users)
+        db.session.commit()
+
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute("ANALYZE users")
+            db.session.commit()
+
+        print(f"Loaded {args.users} users in "
+              f"{time.perf_counter() - start:.1f}s")
+
+        results = {}
+
+        for term in TERMS:
+            like = time_ms(lambda: (User
+                                    .query
+                                    .filter(User.username.like(f"%{term}%"))
+                                    .all()),
+                           args.repeat)
+            ranked = time_ms(lambda: search_users(term), args.repeat)
+
+            results[term] = {'like': summarize(like),
+                             'search': summarize(ranked)}
+
+            print(f"{term!r:>14}  like: {results[term]['like']['median_ms']:>9.2f}ms"
+                  f"  search: {results[term]['search']['median_ms']:>9.2f}ms"
+                  "  (median)")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'users': args.users,
+                       'database': db.engine.dialect.name,
+                       'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""Streaming CSV loader for seeding large databases.
+
+Each CSV is streamed straight into its table, one table (one transaction)
+at a time, so memory use stays flat however big the files are:
+
+- PostgreSQL: COPY ... FROM STDIN, fed from the open file.
+- Anything else: executemany() in chunks of CHUNK_SIZE rows.
+
+Secondary indexes, unique constraints and foreign keys are dropped before
+a table is loaded and recreated afterwards (building an index once is far
+cheaper than updating it row by row). If the CSV gives ids, the id
+sequence is moved past them. Progress goes to stdout as rows/sec.
+
+The CSV's header row names the columns to load; any other columns get
+their database defaults.
+"""
+
+import csv
+import sys
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+CHUNK_SIZE = 10000
+
+# Print progress at most this often (seconds)
+PROGRESS_INTERVAL = 5
+
+
+class Progress:
+    """Counts rows for one table and prints rows/sec as it goes."""
+
+    def __init__(self, table, out=sys.stdout):
+        self.table = table
+        self.out = out
+        self.rows = 0
+        self.started = self.reported = time.monotonic()
+
+    def add(self, rows):
+        self.rows += rows
+        now = time.monotonic()
+
+        if now - self.reported >= PROGRESS_INTERVAL:
+            self.reported = now
+            self.report()
+
+    def rate(self):
+        return self.rows / max(time.monotonic() - self.started, 1e-9)
+
+    def report(self, done=False):
+        status = "loaded" if done else "loading"
+        print(f"{self.table}: {status} {self.rows:,} rows "
+              f"({self.rate():,.0f} rows/s)", file=self.out, flush=True)
+
+
+class CountingReader:
+    """File wrapper for COPY that counts the lines read through it."""
+
+    def __init__(self, file, progress):
+        self.file = file
+        self.progress = progress
+
+    def read(self, size=-1):
+        chunk = self.file.read(size)
+        self.progress.add(chunk.count('\n'))
+        return chunk
+
+    def readline(self, size=-1):
+        line = self.file.readline(size)
+        self.progress.add(line.count('\n'))
+        return line
+
+
+##############################################################################
+# Deferred indexes and constraints
+
+def _postgres_deferred_ddl(connection, table, primary_key=False):
+    """(drop, create) statements for `table`'s FKs, unique constraints and
+    non-primary-key indexes, read from the catalog so indexes made by DDL
+    events (like search.py's) are included. With `primary_key`, the
+    primary key too."""
+
+    kinds = ['f', 'p', 'u'] if primary_key else ['f', 'u']
+
+    constraints = connection.execute(text("""
+        SELECT conname, contype, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = CAST(:table AS regclass)
+          AND contype = ANY(CAST(:kinds AS "char"[]))
+        ORDER BY contype
+    """), table=table, kinds=kinds).fetchall()
+
+    indexes = connection.execute(text("""
+        SELECT i.relname, pg_get_indexdef(i.oid)
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = CAST(:table AS regclass)
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                          WHERE c.conindid = i.oid)
+    """), table=table).fetchall()
+
+    # FKs ('f') sort before primary keys and unique constraints: drop
+    # them first, recreate them last
+    drop = ([f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'
+             for name, _, _ in constraints]
+            + [f'DROP INDEX "{name}"' for name, _ in indexes])
+
+    create = ([definition for _, definition in indexes]
+              + [f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'
+                 for name, _, definition in reversed(constraints)])
+
+    return drop, create
+
+
+def _sqlite_deferred_ddl(connection, table, primary_key=False):
+    """(drop, create) statements for `table`'s explicit indexes.
+
+    (SQLite can't drop constraints, primary keys included, and doesn't
+    check foreign keys unless asked to.)
+    """
+
+    indexes = connection.execute(text("""
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL
+    """), table=table).fetchall()
+
+    return ([f'DROP INDEX "{name}"' for name, _ in indexes],
+            [sql for _, sql in indexes])
+
+
+def deferred_ddl(connection, table, primary_key=False):
+    if connection.dialect.name == 'postgresql':
+        return _postgres_deferred_ddl(connection, table, primary_key)
+
+    if connection.dialect.name == 'sqlite':
+        return _sqlite_deferred_ddl(connection, table, primary_key)
+
+    return [], []
+
+
+@contextmanager
+def indexes_deferred(connection, table, primary_key=False):
+    """Drop `table`'s indexes and constraints (see deferred_ddl()) for the
+    duration of the block, and build them again at the end.
+
+    Offline loads only (like seed.py's): dropping an index locks the table
+    against readers and writers until the transaction ends.
+    """
+
+    drop, create = deferred_ddl(connection, table, primary_key)
+
+    for statement in drop:
+        connection.execute(text(statement))
+
+    yield
+
+    for statement in create:
+        connection.execute(text(statement))
+
+
+def truncate(connection, table):
+    """Empty `table` (TRUNCATE where there is one: it doesn't scan the
+    table or leave dead rows behind).
+
+    Offline loads only: TRUNCATE locks the table against readers and
+    writers until the transaction ends.
+    """
+
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(f'TRUNCATE {table}'))
+    else:
+        connection.execute(text(f'DELETE FROM {table}'))
+
+
+def reset_sequence(connection, table):
+    """Move `table`'s id sequence past its largest id (PostgreSQL only;
+    SQLite always carries on from the largest rowid)."""
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    connection.execute(text(f"""
+        SELECT setval(pg_get_serial_sequence('{table}', 'id'),
+                      COALESCE(MAX(id), 0) + 1, false)
+        FROM {table}
+    """))
+
+
+##############################################################################
+# Loading
+
+def _copy_csv(connection, table, columns, file, progress):
+    """COPY the rest of `file` (after its header) into `table`."""
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        CountingReader(file, progress))
+
+
+def _insert_csv(connection, table, columns, file, progress):
+    """executemany() the rest of `file` into `table`, a chunk at a time."""
+
+    insert = text(f"INSERT INTO {table} ({', '.join(columns)}) "
+                  f"VALUES ({', '.join(':' + c for c in columns)})")
+    chunk = []
+
+    for row in csv.reader(file):
+        chunk.append(dict(zip(columns, row)))
+
+        if len(chunk) == CHUNK_SIZE:
+            connection.execute(insert, chunk)
+            progress.add(len(chunk))
+            chunk = []
+
+    if chunk:
+        connection.execute(insert, chunk)
+        progress.add(len(chunk))
+
+
+def load_csv(engine, table, path, out=sys.stdout):
+    """Stream the CSV at `path` into `table`, in one transaction.
+
+    Returns the number of rows loaded.
+    """
+
+    progress = Progress(table, out)
+
+    with engine.begin() as connection, open(path, newline='') as file:
+        columns = next(csv.reader([file.readline()]))
+        drop, create = deferred_ddl(connection, table)
+
+        for statement in drop:
+            connection.execute(text(statement))
+
+        if connection.dialect.name == 'postgresql':
+            _copy_csv(connection, table, columns, file, progress)
+        else:
+            _insert_csv(connection, table, columns, file, progress)
+
+        progress.report(done=True)
+
+        started = time.monotonic()
+        for statement in create:
+            connection.execute(text(statement))
+
+        if 'id' in columns:
+            reset_sequence(connection, table)
+
+        if create:
+            print(f"{table}: rebuilt {len(create)} indexes/constraints "
+                  f"in {time.monotonic() - started:.1f}s", file=out)
+
+    return progress.rows
@@ -0,0 +1,394 @@
+"""Process-local, compact copy of who follows whom.
+
+Follow buttons ask "does X follow Y" for every user on a page, and the
+following page asks "who does X follow". With FOLLOW_GRAPH_ENABLED each
+worker keeps the whole `follows` table in memory and answers those without
+a query, in CSR form:
+
+- `targets`: every followed id, as one array of int32, sorted by follower
+  and then by followed id;
+- `offsets`: indexed by follower id; a follower's ids are
+  targets[offsets[id]:offsets[id + 1]].
+
+That's 4 bytes per edge plus 4 per user id (about 400MB for 100M follows
+among 10M users); "does X follow Y" is a binary search within X's slice.
+
+The arrays are built once, in a background thread started with the worker
+(gunicorn.conf.py), and are never modified. Changes go in an overlay of
+replacement rows: add_follow() and stop_following() update this worker's
+copy right away, and every FOLLOW_GRAPH_REFRESH_SECONDS the thread reloads
+the rows of users whose `updated_at` moved (adjust_counts() bumps it for
+both sides of a follow), which picks up other workers' changes. Once the
+overlay holds FOLLOW_GRAPH_MAX_OVERLAY users, the arrays are rebuilt.
+Follows loaded behind the app's back (seed.py) show up on the next rebuild.
+
+Until the first load finishes, `ready` is False and callers use the
+database.
+
+Settings (read by init_app):
+
+- FOLLOW_GRAPH_ENABLED: keep the graph (default False).
+- FOLLOW_GRAPH_REFRESH_SECONDS: how often to look for changes (default 2).
+- FOLLOW_GRAPH_MAX_OVERLAY: changed users before a rebuild (default
+  100000).
+"""
+
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+from models import db, Follows, User
+
+DEFAULT_REFRESH_SECONDS = 2
+DEFAULT_MAX_OVERLAY = 100000
+
+# Re-read changes this far back, for commits that landed after the last
+# refresh with an updated_at from before it
+REFRESH_OVERLAP = timedelta(seconds=5)
+
+# Followers per COPY when loading from PostgreSQL
+LOAD_CHUNK_USERS = 100000
+
+# Changed users whose rows are read per query when refreshing
+REFRESH_CHUNK_USERS = 1000
+
+EMPTY = array('i')
+
+
+class FollowGraph:
+    """CSR adjacency arrays of `follows` plus an overlay of changes."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.refresh_seconds = DEFAULT_REFRESH_SECONDS
+        self.max_overlay = DEFAULT_MAX_OVERLAY
+
+        self.app = None
+
+        # (offsets, targets); replaced whole, never modified
+        self._csr = (array('I', [0]), array('i'))
+        # follower id -> sorted array of followed ids, replacing their row
+        self._overlay = {}
+        self._loaded_since = None
+
+        self.ready = False
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.loads = 0
+        self.load_seconds = 0
+        self.refreshes = 0
+        self.errors = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings from `app.config`."""
+
+        self.shutdown()
+
+        self.app = app
+        self.enabled = app.config.get('FOLLOW_GRAPH_ENABLED', False)
+        self.refresh_seconds = app.config.get('FOLLOW_GRAPH_REFRESH_SECONDS',
+                                              DEFAULT_REFRESH_SECONDS)
+        self.max_overlay = app.config.get('FOLLOW_GRAPH_MAX_OVERLAY',
+                                          DEFAULT_MAX_OVERLAY)
+
+    ##########################################################################
+    # Lookups
+
+    def _row(self, user_id):
+        """(array, start, end) of the ids `user_id` follows."""
+
+        row = self._overlay.get(user_id)
+        if row is not None:
+            return row, 0, len(row)
+
+        offsets, targets = self._csr
+        if user_id < 0 or user_id + 1 >= len(offsets):
+            return EMPTY, 0, 0
+
+        return targets, offsets[user_id], offsets[user_id + 1]
+
+    def following(self, user_id):
+        """Sorted array of the ids `user_id` follows."""
+
+        ids, start, end = self._row(user_id)
+        return ids[start:end]
+
+    def is_following(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        ids, start, end = self._row(follower_id)
+        i = bisect_left(ids, followed_id, start, end)
+
+        return i < end and ids[i] == followed_id
+
+    def following_among(self, follower_id, user_ids):
+        """Which of `user_ids` does `follower_id` follow? Returns a set."""
+
+        ids, start, end = self._row(follower_id)
+        found = set()
+
+        for user_id in user_ids:
+            i = bisect_left(ids, user_id, start, end)
+            if i < end and ids[i] == user_id:
+                found.add(user_id)
+
+        return found
+
+    ##########################################################################
+    # Changes
+
+    def add(self, follower_id, followed_id):
+        """Record a (committed) follow."""
+
+        self._change(follower_id, followed_id, True)
+
+    def remove(self, follower_id, followed_id):
+        """Record a (committed) unfollow."""
+
+        self._change(follower_id, followed_id, False)
+
+    def _change(self, follower_id, followed_id, following):
+        if not self.ready:
+            return
+
+        with self._lock:
+            ids, start, end = self._row(follower_id)
+            i = bisect_left(ids, followed_id, start, end)
+
+            if (i < end and ids[i] == followed_id) == following:
+                return
+
+            row = ids[start:end]
+            if following:
+                row.insert(i - start, followed_id)
+            else:
+                del row[i - start]
+
+            self._overlay[follower_id] = row
+
+    ##########################################################################
+    # Loading
+
+    def start(self):
+        """Load the graph and keep it fresh in a background thread."""
+
+        with self._lock:
+            if not self.enabled or self._thread is not None:
+                return
+
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='follow-graph',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    if (not self.ready
+                            or len(self._overlay) >= self.max_overlay):
+                        self.load()
+                    else:
+                        self.refresh()
+
+            except Exception:
+                self.errors += 1
+                self.app.logger.exception("Couldn't update the follow graph")
+
+            finally:
+                db.session.remove()
+
+            self._stop.wait(self.refresh_seconds)
+
+    def load(self):
+        """(Re)build the arrays from `follows`, and clear the overlay."""
+
+        started = time.perf_counter()
+        since = datetime.utcnow() - REFRESH_OVERLAP
+
+        if db.engine.dialect.name == 'postgresql':
+            # One snapshot for the counts and the ids
+            connection = db.engine.connect().execution_options(
+                isolation_level='REPEATABLE READ')
+            try:
+                with connection.begin():
+                    csr = _load_postgres(connection)
+            finally:
+                connection.close()
+        else:
+            csr = _load_other(db.session)
+
+        with self._lock:
+            self._csr = csr
+            self._overlay = {}
+            self._loaded_since = since
+            self.ready = True
+
+        self.loads += 1
+        self.load_seconds = time.perf_counter() - started
+
+    def refresh(self):
+        """Reload the rows of users changed since the last refresh."""
+
+        since = datetime.utcnow() - REFRESH_OVERLAP
+
+        changed = [user_id for (user_id,) in (db.session
+                                              .query(User.id)
+                                              .filter(User.updated_at
+                                                      > self._loaded_since))]
+
+        for chunk_start in range(0, len(changed), REFRESH_CHUNK_USERS):
+            chunk = changed[chunk_start:chunk_start + REFRESH_CHUNK_USERS]
+            rows = {user_id: array('i') for user_id in chunk}
+
+            for follower_id, followed_id in (
+                    db.session
+                    .query(Follows.user_following_id,
+                           Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id.in_(chunk))
+                    .order_by(Follows.user_following_id,
+                              Follows.user_being_followed_id)):
+                rows[follower_id].append(followed_id)
+
+            with self._lock:
+                self._overlay.update(rows)
+
+        self._loaded_since = since
+        self.refreshes += 1
+
+    def shutdown(self):
+        """Stop the background thread."""
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def stats(self):
+        """Size in edges, users and bytes, and load/refresh counts."""
+
+        offsets, targets = self._csr
+        overlay = dict(self._overlay)
+
+        csr_bytes = (offsets.itemsize * len(offsets)
+                     + targets.itemsize * len(targets))
+        overlay_bytes = (sys.getsizeof(overlay)
+                         + sum(sys.getsizeof(row) for row in overlay.values()))
+
+        return {
+            'enabled': self.enabled,
+            'ready': self.ready,
+            'edges': len(targets),
+            'overlay_users': len(overlay),
+            'overlay_edges': sum(len(row) for row in overlay.values()),
+            'csr_bytes': csr_bytes,
+            'overlay_bytes': overlay_bytes,
+            'bytes': csr_bytes + overlay_bytes,
+            'loads': self.loads,
+            'load_seconds': round(self.load_seconds, 3),
+            'refreshes': self.refreshes,
+            'errors': self.errors,
+        }
+
+
+def _offsets(counts, max_id):
+    """CSR offsets from (follower id, number followed) pairs."""
+
+    offsets = array('I', [0]) * (max_id + 2)
+
+    for follower_id, count in counts:
+        offsets[follower_id + 1] = count
+
+    total = 0
+    for i in range(len(offsets)):
+        total += offsets[i]
+        offsets[i] = total
+
+    return offsets
+
+
+# A chunk of followers' running totals (offsets[low + 1:high + 1]) and
+# followed ids, each as one bytea of big-endian int32s (int4send), so they
+# go straight into the arrays without a Python object per row. (Totals
+# past 2**31 - 1 follows would fail the cast.)
+POSTGRES_OFFSETS_CHUNK = """
+    SELECT string_agg(int4send(CAST(%(base)s + running AS integer)), ''
+                      ORDER BY follower_id)
+    FROM (SELECT ids.follower_id,
+                 sum(count(follows.user_following_id))
+                     OVER (ORDER BY ids.follower_id) AS running
+          FROM generate_series(%(low)s, %(high)s - 1) AS ids(follower_id)
+          LEFT JOIN follows ON follows.user_following_id = ids.follower_id
+          GROUP BY ids.follower_id) AS totals
+"""
+
+POSTGRES_TARGETS_CHUNK = """
+    SELECT string_agg(int4send(user_being_followed_id), ''
+                      ORDER BY user_following_id, user_being_followed_id)
+    FROM follows
+    WHERE user_following_id >= %(low)s AND user_following_id < %(high)s
+"""
+
+
+def _load_postgres(connection):
+    """Build (offsets, targets) a chunk of followers at a time.
+
+    The database counts, sums and packs; here the bytes are only appended,
+    so memory peaks at the arrays plus one chunk.
+    """
+
+    max_id = connection.execute(
+        "SELECT max(user_following_id) FROM follows").scalar() or 0
+
+    offsets = array('I', [0])
+    targets = array('i')
+
+    cursor = connection.connection.cursor()
+
+    for low in range(0, max_id + 1, LOAD_CHUNK_USERS):
+        chunk = dict(low=low, high=min(low + LOAD_CHUNK_USERS, max_id + 1),
+                     base=len(targets))
+
+        cursor.execute(POSTGRES_TARGETS_CHUNK, chunk)
+        targets.frombytes(cursor.fetchone()[0] or b'')
+
+        cursor.execute(POSTGRES_OFFSETS_CHUNK, chunk)
+        offsets.frombytes(cursor.fetchone()[0])
+
+    if sys.byteorder == 'little':
+        offsets.byteswap()
+        targets.byteswap()
+
+    return offsets, targets
+
+
+def _load_other(session):
+    rows = (session
+            .query(Follows.user_following_id, Follows.user_being_followed_id)
+            .order_by(Follows.user_following_id,
+                      Follows.user_being_followed_id)
+            .all())
+
+    counts = {}
+    for follower_id, _ in rows:
+        counts[follower_id] = counts.get(follower_id, 0) + 1
+
+    offsets = _offsets(counts.items(), max(counts, default=0))
+    targets = array('i', (followed_id for _, followed_id in rows))
+
+    return offsets, targets
+
+
+follow_graph = FollowGraph()
@@ -3,26 +3,58 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+    python generator/create_csvs.py --users 1000000 --messages 100000000
+
+Runs offline (header images come from header_image_urls.txt) and streams
+rows to disk a chunk at a time, so memory stays flat at any size. Chunks
+are generated by --workers processes; each chunk is seeded from --seed and
+its position, so the same --seed and --end give the same files with any
+number of workers.
+
+The data is shaped like a real network rather than uniformly random:
+
+- who gets followed, who posts and which messages get liked all follow a
+  power law (a few accounts/messages get most of the attention);
+- how many accounts each user follows and likes is long-tailed.
+
+Ids aren't written: they're the row numbers, as they'll be once loaded
+into empty tables by seed.py.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import io
+import os
+import random
+from datetime import date, datetime, time
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import (coprime_stride, get_random_datetime, heavy_tailed_count,
+                     power_law_id)
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+FOLLOWS_PER_USER = 17
+LIKES_PER_USER = 5
 
-fake = Faker()
+# Nobody follows or likes more than this many things
+MAX_PER_USER = 5000
+
+# Rows per chunk of work (users per chunk for follows and likes)
+CHUNK_SIZE = 10000
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
 
 # Generate random profile image URLs to use for users
 
@@ -32,46 +64,192 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs (saved from splashbase, so we don't need the network)
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+with open(os.path.join(HERE, 'header_image_urls.txt')) as urls:
+    header_image_urls = urls.read().split()
+
+# One Faker per worker process, reseeded for each chunk
+
+fake = Faker()
+fake.seed_instance('vocabulary')
+words = sorted(set(fake.words(2000)))
+
+
+def chunk_random(seed, kind, start):
+    """Random source for one chunk, independent of which worker runs it."""
+
+    fake.seed_instance(f"{seed}:{kind}:{start}")
+
+    return random.Random(f"{seed}:{kind}:{start}")
+
+
+def to_csv(rows):
+    out = io.StringIO()
+    csv.writer(out).writerows(rows)
+
+    return out.getvalue()
+
+
+def user_rows(job):
+    """CSV text for users start..stop-1 (1-based ids)."""
+
+    seed, start, stop, _ = job
+    rng = chunk_random(seed, 'users', start)
+
+    rows = []
+    for user_id in range(start, stop):
+        # Suffixing the id keeps usernames and emails unique
+        username = f"{fake.user_name()}{user_id}"
+        rows.append([
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(header_image_urls),
+            fake.city(),
+        ])
+
+    return to_csv(rows)
+
+
+def message_rows(job):
+    """CSV text for messages start..stop-1, by power-law-active authors."""
+
+    seed, start, stop, opts = job
+    rng = chunk_random(seed, 'messages', start)
+    now = opts['now']
+
+    rows = []
+    for _ in range(start, stop):
+        text = ' '.join(rng.choices(words, k=rng.randint(3, 25)))
+        rows.append([
+            text.capitalize()[:MAX_WARBLER_LENGTH - 1] + '.',
+            get_random_datetime(rng=rng, now=now),
+            power_law_id(rng, opts['users'], opts['author_stride']),
+        ])
+
+    return to_csv(rows)
+
+
+def pick_distinct(rng, count, n, stride, exclude=None):
+    """Up to `count` distinct power-law ids in 1..n (fewer if popular ids
+    keep repeating; we give up after a bounded number of draws)."""
+
+    picked = set()
+
+    for _ in range(count * 20):
+        if len(picked) == count:
+            break
+
+        picked.add(power_law_id(rng, n, stride))
+        picked.discard(exclude)
+
+    return sorted(picked)
+
+
+def follow_rows(job):
+    """CSV text for the follows of users start..stop-1."""
+
+    seed, start, stop, opts = job
+    rng = chunk_random(seed, 'follows', start)
+    users = opts['users']
+    limit = min(MAX_PER_USER, users // 2)
+
+    rows = []
+    for follower in range(start, stop):
+        count = heavy_tailed_count(rng, opts['follows_per_user'], limit)
+        rows.extend([followee, follower]
+                    for followee in pick_distinct(
+                        rng, count, users, opts['followee_stride'],
+                        exclude=follower))
+
+    return to_csv(rows)
+
+
+def like_rows(job):
+    """CSV text for the likes of users start..stop-1."""
+
+    seed, start, stop, opts = job
+    rng = chunk_random(seed, 'likes', start)
+    messages = opts['messages']
+    limit = min(MAX_PER_USER, messages // 2)
+
+    rows = []
+    for user_id in range(start, stop):
+        count = heavy_tailed_count(rng, opts['likes_per_user'], limit)
+        rows.extend([user_id, message_id]
+                    for message_id in pick_distinct(
+                        rng, count, messages, opts['message_stride']))
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+    return to_csv(rows)
+
+
+def write_csv(pool, path, headers, make_rows, total, seed, opts):
+    """Write `path` from chunks of `make_rows`, generated in parallel."""
+
+    jobs = ((seed, start, min(start + CHUNK_SIZE, total + 1), opts)
+            for start in range(1, total + 1, CHUNK_SIZE))
+
+    with open(path, 'w', newline='') as out:
+        csv.writer(out).writerow(headers)
+
+        # imap hands back chunks in order, so row numbers stay ids
+        for done, chunk in enumerate(pool.imap(make_rows, jobs), 1):
+            out.write(chunk)
+            print(f"\r{os.path.basename(path)}: "
+                  f"{min(done * CHUNK_SIZE, total):,}/{total:,}",
+                  end='', flush=True)
+
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows-per-user', type=float,
+                        default=FOLLOWS_PER_USER)
+    parser.add_argument('--likes-per-user', type=float,
+                        default=LIKES_PER_USER)
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime.combine(date.today(), time()),
+                        help="latest message timestamp (default: today)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default=HERE,
+                        help="directory to write the CSVs to")
+    args = parser.parse_args()
+
+    opts = dict(
+        users=args.users,
+        messages=args.messages,
+        follows_per_user=args.follows_per_user,
+        likes_per_user=args.likes_per_user,
+        # Different strides so the most-followed, most-active and
+        # most-liked aren't all the same ids
+        followee_stride=coprime_stride(args.users, 7919),
+        author_stride=coprime_stride(args.users, 104729),
+        message_stride=coprime_stride(args.messages, 7919),
+        now=args.end,
+    )
+
+    os.makedirs(args.output, exist_ok=True)
+
+    def path(name):
+        return os.path.join(args.output, name)
+
+    with Pool(args.workers) as pool:
+        write_csv(pool, path('users.csv'), USERS_CSV_HEADERS,
+                  user_rows, args.users, args.seed, opts)
+        write_csv(pool, path('messages.csv'), MESSAGES_CSV_HEADERS,
+                  message_rows, args.messages, args.seed, opts)
+        write_csv(pool, path('follows.csv'), FOLLOWS_CSV_HEADERS,
+                  follow_rows, args.users, args.seed, opts)
+        write_csv(pool, path('likes.csv'), LIKES_CSV_HEADERS,
+                  like_rows, args.users, args.seed, opts)
+
+
+if __name__ == '__main__':
+    main()
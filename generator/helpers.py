@@ -1,14 +1,56 @@
 """Support functions for CSV generation."""
 
+import random
 from datetime import datetime
-from random import uniform
+from math import gcd, log
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random datetime within the `year_gap` years before `now`."""
 
-    now = datetime.now()
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def coprime_stride(n, start):
+    """Smallest number >= `start` sharing no factor with `n`.
+
+    (rank * stride) % n then visits every number below n exactly once, so
+    it scatters popular ranks across the id space.
+    """
+
+    stride = start
+
+    while gcd(stride, n) != 1:
+        stride += 1
+
+    return stride
+
+
+def power_law_id(rng, n, stride):
+    """Random id in 1..n, where the k-th most popular id is picked about
+    1/k as often as the most popular one (Zipf's law, exponent 1).
+
+    (n + 1) ** U for uniform U has exactly that 1/x density, so this needs
+    no tables however big n is.
+    """
+
+    rank = int((n + 1) ** rng.random())
+
+    # Ranks start at 1 so that, with different strides, each distribution
+    # has a different most popular id (rank 0 would be id 1 for all)
+    return (rank * stride) % n + 1
+
+
+def heavy_tailed_count(rng, mean, limit):
+    """Random count with the given mean and a long tail (lognormal):
+    most users do a little, a few do a lot."""
+
+    sigma = 1.2
+    mu = log(max(mean, 1e-9)) - sigma ** 2 / 2
+
+    return min(int(rng.lognormvariate(mu, sigma)), limit)
+
@@ -0,0 +1,26 @@
+"""gunicorn settings (read from the working directory on startup)."""
+
+import os
+
+worker_class = 'gthread'
+
+# The app sizes its password pool from this too (REQUEST_THREADS)
+threads = int(os.environ.get('WEB_THREADS', 8))
+
+
+def post_worker_init(worker):
+    """Start loading the follow graph (if enabled) as the worker starts."""
+
+    from follow_graph import follow_graph
+
+    follow_graph.start()
+
+
+def worker_exit(server, worker):
+    """Write any buffered likes before the worker goes away."""
+
+    from follow_graph import follow_graph
+    from like_buffer import like_buffer
+
+    like_buffer.shutdown()
+    follow_graph.shutdown()
@@ -0,0 +1,299 @@
+"""Write-behind buffer for likes and unlikes.
+
+Normally each like is its own INSERT and commit. On a viral message that's
+thousands of tiny transactions a second against `likes`. With
+LIKE_BUFFER_ENABLED, like_message() and unlike_message() just record the
+click here and return; a background thread writes everything pending in
+one transaction every LIKE_BUFFER_INTERVAL seconds (sooner if
+LIKE_BUFFER_MAX_PENDING clicks are waiting).
+
+Only the last click per (user, message) is kept, so a burst of
+like/unlike toggles becomes at most one write. Like counts are adjusted
+from what the batch actually inserted and deleted, so repeats and toggles
+can't skew them.
+
+Until a click is written, the clicker's like buttons show it (see
+overlay()); their like count catches up on the next flush. Pending clicks
+are written when the process shuts down cleanly (atexit, and gunicorn's
+worker_exit hook in gunicorn.conf.py); a crash loses at most one
+interval's worth.
+
+Settings (read by init_app):
+
+- LIKE_BUFFER_ENABLED: buffer likes (default False: write them at once).
+- LIKE_BUFFER_INTERVAL: seconds between flushes (default 0.5).
+- LIKE_BUFFER_MAX_PENDING: flush early once this many are waiting
+  (default 1000).
+"""
+
+import atexit
+import threading
+from collections import Counter
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from models import db, User
+
+DEFAULT_INTERVAL = 0.5
+DEFAULT_MAX_PENDING = 1000
+
+PG_INSERT = text("""
+    INSERT INTO likes (user_id, message_id)
+    SELECT v.user_id, v.message_id
+    FROM unnest(CAST(:user_ids AS INTEGER[]), CAST(:message_ids AS INTEGER[]))
+         AS v (user_id, message_id)
+    WHERE EXISTS (SELECT 1 FROM messages WHERE id = v.message_id)
+      AND EXISTS (SELECT 1 FROM users WHERE id = v.user_id)
+    ON CONFLICT (user_id, message_id) DO NOTHING
+    RETURNING user_id
+""")
+
+PG_DELETE = text("""
+    DELETE FROM likes
+    USING unnest(CAST(:user_ids AS INTEGER[]), CAST(:message_ids AS INTEGER[]))
+          AS v (user_id, message_id)
+    WHERE likes.user_id = v.user_id AND likes.message_id = v.message_id
+    RETURNING likes.user_id
+""")
+
+INSERT = text("""
+    INSERT INTO likes (user_id, message_id)
+    SELECT :user_id, :message_id
+    WHERE EXISTS (SELECT 1 FROM messages WHERE id = :message_id)
+      AND EXISTS (SELECT 1 FROM users WHERE id = :user_id)
+      AND NOT EXISTS (SELECT 1 FROM likes
+                      WHERE user_id = :user_id AND message_id = :message_id)
+""")
+
+DELETE = text("""
+    DELETE FROM likes WHERE user_id = :user_id AND message_id = :message_id
+""")
+
+
+class LikeBuffer:
+    """In-process queue of like/unlike clicks, written in batches."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.interval = DEFAULT_INTERVAL
+        self.max_pending = DEFAULT_MAX_PENDING
+
+        self.app = None
+
+        # (user_id, message_id) -> True (like) or False (unlike)
+        self._pending = {}
+        # The batch being written; still shown by overlay() until committed
+        self._flushing = {}
+
+        self._lock = threading.Lock()
+        # Only one flush at a time
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.recorded = 0
+        self.written = 0
+        self.flushes = 0
+        self.errors = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings from `app.config`."""
+
+        self.shutdown()
+
+        self.app = app
+        self.enabled = app.config.get('LIKE_BUFFER_ENABLED', False)
+        self.interval = app.config.get('LIKE_BUFFER_INTERVAL',
+                                       DEFAULT_INTERVAL)
+        self.max_pending = app.config.get('LIKE_BUFFER_MAX_PENDING',
+                                          DEFAULT_MAX_PENDING)
+
+    def record(self, user_id, message_id, liked):
+        """Queue `user_id` liking (or, if not `liked`, unliking)
+        `message_id`."""
+
+        self._ensure_thread()
+
+        with self._lock:
+            self._pending[(user_id, message_id)] = liked
+            self.recorded += 1
+            full = len(self._pending) >= self.max_pending
+
+        if full:
+            self._wake.set()
+
+    def overlay(self, user_id, liked_ids, message_ids):
+        """`liked_ids` (ids of `message_ids` `user_id` has liked, per the
+        database) updated with their clicks that aren't written yet."""
+
+        liked_ids = set(liked_ids)
+
+        with self._lock:
+            if not (self._pending or self._flushing):
+                return liked_ids
+
+            for message_id in message_ids:
+                key = (user_id, message_id)
+                liked = self._pending.get(key, self._flushing.get(key))
+
+                if liked is True:
+                    liked_ids.add(message_id)
+                elif liked is False:
+                    liked_ids.discard(message_id)
+
+        return liked_ids
+
+    def has_pending(self, user_id):
+        """Does `user_id` have clicks that aren't written yet?"""
+
+        with self._lock:
+            return any(key[0] == user_id
+                       for batch in (self._pending, self._flushing)
+                       for key in batch)
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run,
+                                                name='like-buffer',
+                                                daemon=True)
+                self._thread.start()
+                atexit.register(self.shutdown)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write every pending click in one transaction. Returns how many
+        clicks were written."""
+
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._flushing, self._pending = self._pending, {}
+                batch = self._flushing
+
+            try:
+                with self.app.app_context():
+                    self._write(batch)
+
+            except OperationalError:
+                # Couldn't reach the database: try again next time (newer
+                # clicks for the same like win)
+                self.errors += 1
+                self.app.logger.exception("Will retry %d buffered like(s)",
+                                          len(batch))
+                with self._lock:
+                    for key, liked in batch.items():
+                        self._pending.setdefault(key, liked)
+                return 0
+
+            except Exception:
+                self.errors += 1
+                self.app.logger.exception("Lost %d buffered like(s)",
+                                          len(batch))
+                return 0
+
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+            self.flushes += 1
+            self.written += len(batch)
+
+            return len(batch)
+
+    def _write(self, batch):
+        likes = [key for key, liked in batch.items() if liked]
+        unlikes = [key for key, liked in batch.items() if not liked]
+
+        session = db.session
+
+        try:
+            if db.engine.dialect.name == 'postgresql':
+                added = self._pg_changed(session, PG_INSERT, likes)
+                removed = self._pg_changed(session, PG_DELETE, unlikes)
+            else:
+                added = self._changed(session, INSERT, likes)
+                removed = self._changed(session, DELETE, unlikes)
+
+            # Users whose count goes up or down by the same amount share an
+            # UPDATE
+            deltas = {}
+            for user_id in added.keys() | removed.keys():
+                delta = added[user_id] - removed[user_id]
+                if delta:
+                    deltas.setdefault(delta, []).append(user_id)
+
+            for delta, user_ids in deltas.items():
+                User.adjust_counts(user_ids, like_count=delta)
+
+            session.commit()
+
+        finally:
+            session.remove()
+
+    @staticmethod
+    def _pg_changed(session, statement, keys):
+        """Run a batch statement for `keys`; Counter of changed rows by
+        user id."""
+
+        if not keys:
+            return Counter()
+
+        user_ids, message_ids = zip(*keys)
+        rows = session.execute(statement, {'user_ids': list(user_ids),
+                                           'message_ids': list(message_ids)})
+
+        return Counter(user_id for (user_id,) in rows)
+
+    @staticmethod
+    def _changed(session, statement, keys):
+        changed = Counter()
+
+        for user_id, message_id in keys:
+            result = session.execute(statement, {'user_id': user_id,
+                                                 'message_id': message_id})
+            changed[user_id] += result.rowcount
+
+        return changed
+
+    def shutdown(self):
+        """Stop the flusher thread and write whatever is pending."""
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+
+        if thread is not None:
+            self._stop.set()
+            self._wake.set()
+            thread.join()
+            atexit.unregister(self.shutdown)
+
+        if self.app is not None:
+            self.flush()
+
+    def stats(self):
+        """Pending clicks and lifetime counts."""
+
+        return {
+            'enabled': self.enabled,
+            'pending': len(self._pending),
+            'recorded': self.recorded,
+            'written': self.written,
+            'flushes': self.flushes,
+            'errors': self.errors,
+        }
+
+
+like_buffer = LikeBuffer()
@@ -0,0 +1,126 @@
+"""Cache of rendered message cards.
+
+Timelines, profiles, likes and search results all show messages as the
+same card: the author's picture and name, the date and the text. Messages
+can't be edited, so a card only changes when its author's name or
+picture does; we keep rendered cards in an LRU cache keyed by message id
+and the author's profile version (see User.profile_version), and render
+only the viewer's like button per request.
+
+The profile version is bumped in the database by profile edits only --
+not by the likes, follows and posts that bump User.version -- so popular
+authors' cards stay cached, and a stale card is never shown, even by other
+processes. profile() also drops an edited author's cards here, rather
+than leaving them to age out.
+
+Settings (read by init_app):
+
+- MESSAGE_CARD_CACHE_SIZE: most cards kept (default 10000); 0 turns
+  caching off.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+DEFAULT_SIZE = 10000
+
+TEMPLATE = 'messages/_card.html'
+
+
+class MessageCardCache:
+    """LRU cache of rendered cards, by message id."""
+
+    def __init__(self, app=None):
+        self.max_size = DEFAULT_SIZE
+
+        # message id -> (author id, author profile version, html)
+        self._entries = OrderedDict()
+        # author id -> ids of their messages in _entries
+        self._by_author = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings from `app.config`; make message_card() available
+        to templates."""
+
+        self.max_size = app.config.get('MESSAGE_CARD_CACHE_SIZE',
+                                       DEFAULT_SIZE)
+        app.jinja_env.globals['message_card'] = self.render
+        self.clear()
+
+    def render(self, msg):
+        """The card for message `msg`, from the cache if it's current."""
+
+        author = msg.user
+
+        with self._lock:
+            entry = self._entries.get(msg.id)
+
+            if entry is not None and entry[1] == author.profile_version:
+                self._entries.move_to_end(msg.id)
+                self.hits += 1
+                return Markup(entry[2])
+
+            self.misses += 1
+
+        html = (current_app.jinja_env
+                .get_template(TEMPLATE)
+                .render(msg=msg, author=author))
+        self._store(msg.id, author.id, author.profile_version, html)
+
+        return Markup(html)
+
+    def _store(self, message_id, author_id, version, html):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[message_id] = (author_id, version, html)
+            self._entries.move_to_end(message_id)
+            self._by_author.setdefault(author_id, set()).add(message_id)
+
+            while len(self._entries) > self.max_size:
+                self._forget(*self._entries.popitem(last=False))
+
+    def _forget(self, message_id, entry):
+        message_ids = self._by_author.get(entry[0])
+
+        if message_ids is not None:
+            message_ids.discard(message_id)
+            if not message_ids:
+                del self._by_author[entry[0]]
+
+    def invalidate_author(self, author_id):
+        """Drop every card by `author_id` (after editing or deleting them)."""
+
+        with self._lock:
+            for message_id in self._by_author.pop(author_id, ()):
+                self._entries.pop(message_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_author.clear()
+
+    def stats(self):
+        """Size and lifetime hit/miss counts."""
+
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'authors': len(self._by_author),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+message_cards = MessageCardCache()
@@ -0,0 +1,416 @@
+"""Full-text search over warbles, backed by an inverted index.
+
+Every distinct word of a message is stored in `message_terms` as
+(term, message_id). The primary key on that pair is the posting list for
+each term, already sorted by message id, so "newest messages containing
+`term`" is a backwards index range scan that stops after one page.
+
+Queries are ANDs of:
+
+- words:            warbler song
+- prefixes:         warb*  (at least MIN_PREFIX_LENGTH characters;
+                    shorter ones are taken as words)
+- quoted phrases:   "early bird"
+
+A phrase requires all of its words via the index, and is then checked
+against the text of each candidate message (warbles are at most 140
+characters, so that's cheap).
+
+The index is updated as messages are posted and deleted;
+reindex_messages() rebuilds it from scratch.
+"""
+
+import csv
+import io
+import re
+
+from sqlalchemy import and_, exists, select, text, true, union_all
+
+from bulk_load import indexes_deferred, truncate
+from models import db, Message, MessageTerm
+from pagination import PAGE_SIZE, page
+
+TOKEN_RE = re.compile(r'\w+')
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+# Longer "words" are almost always URLs or junk
+MAX_TERM_LENGTH = 64
+
+REINDEX_CHUNK_SIZE = 5000
+
+# "a*" would match half the index; shorter prefixes are taken as words
+MIN_PREFIX_LENGTH = 2
+
+# A prefix that has to drive the search stands for at most this many
+# words, the first ones alphabetically
+MAX_PREFIX_TERMS = 50
+
+# A page of phrase matches can need more candidates than fit on a page;
+# give up after this many rounds rather than scanning the whole index
+MAX_CANDIDATE_ROUNDS = 10
+
+
+def tokenize(text):
+    """Lowercased words of `text`, in order."""
+
+    return [token
+            for token in TOKEN_RE.findall(text.lower())
+            if len(token) <= MAX_TERM_LENGTH]
+
+
+class SearchQuery:
+    """A parsed message search: required words, prefixes and phrases."""
+
+    def __init__(self, query):
+        self.terms = []
+        self.prefixes = []
+        self.phrases = []
+
+        for phrase, word in QUERY_RE.findall(query):
+            if phrase:
+                self._add_phrase(tokenize(phrase))
+
+            elif word.endswith('*') and tokenize(word):
+                *leading, prefix = tokenize(word)
+                if len(prefix) < MIN_PREFIX_LENGTH:
+                    self._add_phrase(tokenize(word))
+                else:
+                    self._add_phrase(leading)
+                    self.prefixes.append(prefix)
+
+            else:
+                self._add_phrase(tokenize(word))
+
+    def _add_phrase(self, tokens):
+        self.terms.extend(token for token in tokens
+                          if token not in self.terms)
+
+        # "don't" tokenizes to two words; keep them together
+        if len(tokens) > 1:
+            self.phrases.append(tokens)
+
+    def __bool__(self):
+        return bool(self.terms or self.prefixes)
+
+    def matches_phrases(self, text):
+        """Does `text` contain every phrase of this query, word for word?"""
+
+        tokens = tokenize(text)
+
+        return all(_contains_run(tokens, phrase) for phrase in self.phrases)
+
+
+def _contains_run(tokens, run):
+    """Does `run` appear as consecutive items in `tokens`?"""
+
+    return any(tokens[i:i + len(run)] == run
+               for i in range(len(tokens) - len(run) + 1))
+
+
+def _prefix_range(column, prefix):
+    """Condition for terms starting with `prefix`, as an index range.
+
+    (A LIKE 'prefix%' can't use the primary key index under every
+    collation; a >= / < range always can.)
+    """
+
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    return and_(column >= prefix, column < upper)
+
+
+def _term_condition(column, term=None, prefix=None):
+    """Condition on a term column for an exact term or a prefix."""
+
+    if prefix is not None:
+        return _prefix_range(column, prefix)
+
+    return column == term
+
+
+def _prefix_words(prefix):
+    """Select of the first MAX_PREFIX_TERMS indexed words starting with
+    `prefix`.
+
+    A loose index scan (a recursive CTE of "the next word after this
+    one"): each step is one seek, so it never reads the postings of the
+    words it skips over.
+    """
+
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def next_word(after):
+        return (select([db.func.min(MessageTerm.term)])
+                .where(and_(after, MessageTerm.term < upper))
+                .as_scalar())
+
+    words = (select([next_word(MessageTerm.term >= prefix).label('term')])
+             .cte('words', recursive=True))
+    previous = words.alias('previous')
+    words = words.union_all(
+        select([next_word(MessageTerm.term > previous.c.term)])
+        .where(previous.c.term.isnot(None)))
+
+    return (select([words.c.term])
+            .where(words.c.term.isnot(None))
+            .limit(MAX_PREFIX_TERMS))
+
+
+def _postings(condition, others, before_id, limit):
+    """Select of the newest `limit` ids of messages whose term meets
+    `condition` (below `before_id`, if given) that have all of `others`
+    too."""
+
+    postings = select([MessageTerm.message_id]).where(condition)
+
+    if before_id is not None:
+        postings = postings.where(MessageTerm.message_id < before_id)
+
+    for lookup in others:
+        other = db.aliased(MessageTerm)
+        postings = postings.where(
+            exists().where(and_(other.message_id == MessageTerm.message_id,
+                                _term_condition(other.term, **lookup))))
+
+    return postings.order_by(MessageTerm.message_id.desc()).limit(limit)
+
+
+def _prefix_postings(prefix, others, before_id, limit):
+    """_postings() for a prefix: rather than sort every posting in the
+    prefix's range, takes the newest `limit` of each word it stands for
+    and merges those."""
+
+    words = _prefix_words(prefix)
+
+    if db.engine.dialect.name == 'postgresql':
+        words = words.alias('words')
+        per_word = _postings(MessageTerm.term == words.c.term, others,
+                             before_id, limit).lateral('per_word')
+        merged = (select([per_word.c.message_id])
+                  .select_from(words.join(per_word, true())))
+
+    else:
+        # No LATERAL: look the words up, then one select each
+        per_word = [_postings(MessageTerm.term == term, others, before_id,
+                              limit)
+                    for (term,) in db.session.execute(words)]
+
+        if not per_word:
+            return None
+
+        merged = union_all(*per_word) if len(per_word) > 1 else per_word[0]
+
+    merged = merged.alias('merged')
+
+    # (DISTINCT: a message can hold several of the words)
+    return (select([merged.c.message_id])
+            .distinct()
+            .order_by(merged.c.message_id.desc())
+            .limit(limit))
+
+
+def _candidates(query, before_id, limit):
+    """Up to `limit` messages matching the indexed part of `query`,
+    newest first, with ids below `before_id` if given."""
+
+    # Walk one term's posting list newest first (exact terms are usually
+    # far more selective than prefixes, and longer words more than short
+    # ones) and check the rest with EXISTS lookups on the same index, so
+    # the scan stops as soon as it has `limit` matches
+    lookups = ([dict(term=term)
+                for term in sorted(query.terms, key=len, reverse=True)]
+               + [dict(prefix=prefix) for prefix in query.prefixes])
+
+    driver, others = lookups[0], lookups[1:]
+
+    if 'prefix' in driver:
+        ids = _prefix_postings(driver['prefix'], others, before_id, limit)
+    else:
+        ids = _postings(_term_condition(MessageTerm.term, **driver), others,
+                        before_id, limit)
+
+    if ids is None:
+        return []
+
+    ids = ids.alias('ids')
+
+    return (Message
+            .query
+            .options(db.joinedload(Message.user))
+            .join(ids, ids.c.message_id == Message.id)
+            .order_by(Message.id.desc())
+            .all())
+
+
+def search_messages(query, before=None, limit=PAGE_SIZE):
+    """One page of messages matching `query`, newest first.
+
+    `before` is a decoded (timestamp, id) cursor from a previous page.
+    Returns (messages, next_cursor) like pagination.page().
+    """
+
+    query = SearchQuery(query)
+
+    if not query:
+        return [], None
+
+    before_id = before[1] if before else None
+    found = []
+
+    # Fetch one extra so page() can tell whether there's another page
+    for _ in range(MAX_CANDIDATE_ROUNDS):
+        wanted = limit + 1 - len(found)
+        candidates = _candidates(query, before_id, wanted)
+
+        # (skipping deleted accounts' messages until they're purged)
+        found.extend(msg for msg in candidates
+                     if query.matches_phrases(msg.text)
+                     and msg.user.deleted_at is None)
+
+        if len(candidates) < wanted or len(found) > limit:
+            break
+
+        before_id = candidates[-1].id
+
+    return page(found, limit)
+
+
+def index_message(msg):
+    """Add a newly posted (and flushed) message to the index.
+
+    Doesn't commit.
+    """
+
+    db.session.bulk_insert_mappings(MessageTerm, [
+        dict(term=term, message_id=msg.id)
+        for term in set(tokenize(msg.text))
+    ])
+
+
+def unindex_message(message_id):
+    """Remove a message from the index.
+
+    The foreign key cascade does this on PostgreSQL, but SQLite only
+    enforces foreign keys when asked to. Doesn't commit.
+    """
+
+    (MessageTerm
+     .query
+     .filter(MessageTerm.message_id == message_id)
+     .delete(synchronize_session=False))
+
+
+def _insert_terms(connection, table, chunk):
+    """Add the terms of a chunk of (message_id, text) rows to `table`
+    (message_terms, or a table like it)."""
+
+    rows = [(term, message_id)
+            for message_id, body in chunk
+            for term in set(tokenize(body))]
+
+    if connection.dialect.name != 'postgresql':
+        connection.execute(
+            text(f"INSERT INTO {table} (term, message_id) "
+                 f"VALUES (:term, :message_id)"),
+            [dict(term=term, message_id=message_id)
+             for term, message_id in rows])
+        return
+
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table} (term, message_id) FROM STDIN WITH (FORMAT csv)", buf)
+
+
+def _message_chunks():
+    """(id before the chunk, chunk) for every message, as chunks of
+    REINDEX_CHUNK_SIZE (message_id, text) rows, oldest first."""
+
+    messages = Message.__table__
+    last_id = 0
+
+    while True:
+        chunk = db.session.execute(
+            select([messages.c.id, messages.c.text])
+            .where(messages.c.id > last_id)
+            .order_by(messages.c.id)
+            .limit(REINDEX_CHUNK_SIZE)).fetchall()
+
+        if not chunk:
+            return
+
+        yield last_id, chunk
+
+        last_id = chunk[-1].id
+
+
+# Terms a chunk of messages should have, next to the ones they do
+SYNC_TERMS = [
+    """
+    INSERT INTO message_terms (term, message_id)
+    SELECT new_terms.term, new_terms.message_id FROM new_terms
+    WHERE EXISTS (SELECT 1 FROM messages
+                  WHERE messages.id = new_terms.message_id)
+      AND NOT EXISTS (SELECT 1 FROM message_terms
+                      WHERE message_terms.term = new_terms.term
+                        AND message_terms.message_id = new_terms.message_id)
+    """,
+    """
+    DELETE FROM message_terms
+    WHERE message_id > :after AND message_id <= :last
+      AND NOT EXISTS (SELECT 1 FROM new_terms
+                      WHERE new_terms.term = message_terms.term
+                        AND new_terms.message_id = message_terms.message_id)
+    """,
+]
+
+
+def reindex_messages(offline=False):
+    """Rebuild the whole index from `messages`, REINDEX_CHUNK_SIZE
+    messages at a time.
+
+    Terms are tokenized here, so they match index_message()'s exactly.
+    Each chunk's go into a temporary table (COPYed in on PostgreSQL), and
+    the index gains the missing ones and loses the stale ones in a short
+    transaction of its own, so searches and posts carry on meanwhile.
+    Commits after each chunk.
+
+    With `offline` (seed.py: nothing else is using the database), it
+    instead empties the table and COPYs every term straight in, with the
+    indexes dropped until the end. That's far faster, but locks the table
+    until the caller commits.
+    """
+
+    if offline:
+        _refill_index()
+        return
+
+    for after, chunk in _message_chunks():
+        connection = db.session.connection()
+
+        connection.execute(text(
+            "CREATE TEMPORARY TABLE new_terms (term TEXT, message_id INTEGER)"))
+        _insert_terms(connection, 'new_terms', chunk)
+
+        for statement in SYNC_TERMS:
+            connection.execute(text(statement), after=after,
+                               last=chunk[-1].id)
+
+        connection.execute(text("DROP TABLE new_terms"))
+        db.session.commit()
+
+
+def _refill_index():
+    """reindex_messages(offline=True). Doesn't commit."""
+
+    connection = db.session.connection()
+    table = MessageTerm.__tablename__
+
+    truncate(connection, table)
+
+    with indexes_deferred(connection, table, primary_key=True):
+        for _, chunk in _message_chunks():
+            _insert_terms(connection, table, chunk)
@@ -0,0 +1,300 @@
+"""Versioned schema changes for existing databases.
+
+db.create_all() builds a new database with the current schema, but never
+changes tables that already exist. Changes made after that are listed in
+MIGRATIONS, run in order by `flask migrate`, and recorded in
+`schema_migrations` so each runs once.
+
+Migrations should be safe to run against a database create_all() just
+built (use IF NOT EXISTS and the like), since that database already has
+everything models.py declares.
+
+Indexes are built CONCURRENTLY on PostgreSQL, so a live site keeps taking
+writes while they build.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import bindparam, inspect, text
+
+from account_purge import AccountPurge
+from message_search import reindex_messages
+from models import db, Likes, MessageTerm, TimelineEntry, User
+from recommendations import Recommendation
+from search import trigram_installed
+from timelines import rebuild_all_timelines
+
+
+class SchemaMigration(db.Model):
+    """A migration that has been applied."""
+
+    __tablename__ = 'schema_migrations'
+
+    version = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    applied_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+MIGRATIONS = []
+
+
+def migration(version):
+    """Register the decorated function as migration `version`."""
+
+    def register(fn):
+        MIGRATIONS.append((version, fn))
+        return fn
+
+    return register
+
+
+def create_index(name, table, columns, unique=False, where=None,
+                 using=None):
+    """Create an index (partial, if `where` is given; of another type, if
+    `using` is) if it isn't there yet, without blocking writes on
+    PostgreSQL. Commits the session first."""
+
+    db.session.commit()
+
+    unique = 'UNIQUE ' if unique else ''
+    columns = ', '.join(columns)
+    where = f' WHERE {where}' if where else ''
+    if using:
+        table = f'{table} USING {using}'
+
+    if db.engine.dialect.name != 'postgresql':
+        db.session.execute(f'CREATE {unique}INDEX IF NOT EXISTS {name} '
+                           f'ON {table} ({columns}){where}')
+        db.session.commit()
+        return
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    autocommit = db.engine.execution_options(isolation_level='AUTOCOMMIT')
+
+    # An interrupted concurrent build leaves an invalid index behind;
+    # IF NOT EXISTS would skip over it, so drop it and start again
+    invalid = autocommit.execute(
+        """SELECT 1 FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+           WHERE i.relname = %s AND NOT x.indisvalid""", (name,)).scalar()
+
+    if invalid:
+        autocommit.execute(f'DROP INDEX CONCURRENTLY {name}')
+
+    autocommit.execute(f'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS '
+                       f'{name} ON {table} ({columns}){where}')
+
+
+def columns(table):
+    """Names of the columns `table` has right now."""
+
+    return {column['name'] for column in
+            inspect(db.engine).get_columns(table)}
+
+
+def add_column(table, name, definition):
+    """Add a column if the table doesn't have it yet. Commits. Returns
+    whether it was added."""
+
+    db.session.commit()
+
+    if name in columns(table):
+        return False
+
+    db.session.execute(f'ALTER TABLE {table} ADD COLUMN {name} '
+                       f'{definition}')
+    db.session.commit()
+    return True
+
+
+def create_table(model):
+    """Create a model's table (and its indexes) if it isn't there yet.
+    Returns whether it was created."""
+
+    db.session.commit()
+
+    if db.engine.has_table(model.__tablename__):
+        return False
+
+    model.__table__.create(db.engine)
+    return True
+
+
+@migration('0001_messages_user_timestamp')
+def index_messages_by_user():
+    create_index('ix_messages_user_timestamp', 'messages',
+                 ['user_id', 'timestamp', 'id'])
+
+
+@migration('0002_unique_likes')
+def unique_likes():
+    # Keep the first of any duplicate likes, then fix the likers' counts
+    duplicated_user_ids = [user_id for (user_id,) in db.session
+                           .query(Likes.user_id)
+                           .group_by(Likes.user_id, Likes.message_id)
+                           .having(db.func.count() > 1)
+                           .distinct()]
+
+    db.session.execute("""
+        DELETE FROM likes
+        WHERE EXISTS (SELECT 1 FROM likes AS first
+                      WHERE first.user_id = likes.user_id
+                        AND first.message_id = likes.message_id
+                        AND first.id < likes.id)
+    """)
+
+    # Plain SQL, and only if there's a count to fix: on an original-schema
+    # database the counters (0003a) and versions (0005) come later, and
+    # 0003a computes every count when it adds them
+    users = columns('users')
+
+    if duplicated_user_ids and 'like_count' in users:
+        bump = (", version = version + 1, updated_at = :now"
+                if 'version' in users else "")
+        db.session.execute(
+            text(f"""
+                UPDATE users
+                SET like_count = (SELECT count(*) FROM likes
+                                  WHERE likes.user_id = users.id){bump}
+                WHERE id IN :user_ids
+            """).bindparams(bindparam('user_ids', expanding=True)),
+            dict(user_ids=duplicated_user_ids, now=datetime.utcnow()))
+
+    create_index('uq_likes_user_message', 'likes',
+                 ['user_id', 'message_id'], unique=True)
+
+
+@migration('0003_follows_following')
+def index_follows_by_follower():
+    create_index('ix_follows_following_followed', 'follows',
+                 ['user_following_id', 'user_being_followed_id'])
+
+
+@migration('0003a_counters_and_timelines')
+def add_counters_and_timelines():
+    # Added alongside the code that maintains them, so only a database
+    # create_all() built since has them
+    added = [add_column('users', column, "INTEGER NOT NULL DEFAULT 0")
+             for column in ['message_count', 'like_count', 'following_count',
+                            'follower_count']]
+
+    if any(added):
+        # Not reconcile_counts(): it bumps users.version, which 0005 adds
+        # -- and every count needs computing anyway
+        User.query.update(User.counter_values(), synchronize_session=False)
+        db.session.commit()
+
+    # Fan-out needs the follower counts above
+    if create_table(TimelineEntry):
+        rebuild_all_timelines()
+        db.session.commit()
+
+    if create_table(MessageTerm):
+        reindex_messages()
+        db.session.commit()
+
+
+@migration('0004_users_follower_count')
+def index_users_by_follower_count():
+    create_index('ix_users_follower_count', 'users', ['follower_count'])
+
+
+@migration('0005_users_version')
+def add_user_versions():
+    # Constant defaults: SQLite can't add a column defaulting to now(), and
+    # PostgreSQL doesn't have to rewrite the table
+    add_column('users', 'version', "INTEGER NOT NULL DEFAULT 0")
+    add_column('users', 'updated_at',
+               "TIMESTAMP NOT NULL DEFAULT '1970-01-01 00:00:00'")
+
+
+@migration('0006_account_deletion')
+def add_account_deletion():
+    add_column('users', 'deleted_at', "TIMESTAMP")
+    create_index('ix_users_deleted', 'users', ['id'],
+                 where='deleted_at IS NOT NULL')
+    AccountPurge.__table__.create(db.engine, checkfirst=True)
+
+    # Until autovacuum gets to it, the planner has no idea deleted_at is
+    # almost always null, and hash-joins every timeline against it
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('ANALYZE users')
+        db.session.commit()
+
+
+@migration('0007_message_id_indexes')
+def index_by_message():
+    # Without these, deleting a message scans both tables for its rows
+    create_index('ix_timeline_entries_message', 'timeline_entries',
+                 ['message_id'])
+    create_index('ix_likes_message', 'likes', ['message_id'])
+
+
+@migration('0008_users_updated_at')
+def index_users_by_updated_at():
+    create_index('ix_users_updated_at', 'users', ['updated_at'])
+
+
+@migration('0009_recommendations')
+def add_recommendations():
+    Recommendation.__table__.create(db.engine, checkfirst=True)
+
+
+@migration('0010_username_trigram_gist')
+def username_trigram_gist():
+    # GiST can return the closest usernames first, which search ranks by
+    if db.engine.dialect.name != 'postgresql' or not trigram_installed():
+        return
+
+    create_index('ix_users_username_trgm_gist', 'users',
+                 ['username gist_trgm_ops'], using='gist')
+    db.engine.execution_options(isolation_level='AUTOCOMMIT').execute(
+        'DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_trgm')
+
+
+@migration('0011_likes_user_id')
+def index_likes_by_user():
+    # The likes page pages by like id, newest first
+    create_index('ix_likes_user_id', 'likes', ['user_id', 'id'])
+
+
+@migration('0012_users_profile_version')
+def add_profile_versions():
+    add_column('users', 'profile_version', "INTEGER NOT NULL DEFAULT 0")
+
+
+def applied_versions():
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+
+    return {version for (version,) in
+            db.session.query(SchemaMigration.version)}
+
+
+def pending_migrations():
+    """(version, function) of migrations not applied yet, in order."""
+
+    applied = applied_versions()
+
+    return [(version, fn) for version, fn in MIGRATIONS
+            if version not in applied]
+
+
+def migrate(log=print):
+    """Apply every pending migration, in order. Returns their versions."""
+
+    done = []
+
+    for version, fn in pending_migrations():
+        log(f"Applying {version}...")
+        fn()
+        db.session.add(SchemaMigration(version=version))
+        db.session.commit()
+        done.append(version)
+
+    return done
@@ -1,24 +1,158 @@
 """SQLAlchemy models for Warbler."""
 
+import re
+import time
+from collections import Counter
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_request_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import and_, event, exists, or_, orm, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.expression import SelectBase
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import password_pool
 
 
-def connect_db(app):
+##############################################################################
+# Read replicas
+#
+# Replicas are extra binds (replica_0, replica_1, ...). While a request is
+# allowed to read from one (app.py puts its bind key in g.db_replica),
+# plain SELECTs go there; anything else -- flushes, UPDATE/DELETE, SELECT
+# ... FOR UPDATE -- goes to the primary, and so does every statement after
+# the session's first write, so a request always sees its own changes.
+
+# Engine -> bind name ('primary' or 'replica_N'), for query stats
+ENGINE_NAMES = {}
+
+# Statements run per engine since the process started
+ENGINE_QUERY_COUNTS = Counter()
+
+
+def _is_plain_read(clause):
+    return (isinstance(clause, SelectBase)
+            and getattr(clause, '_for_update_arg', None) is None)
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends reads to the request's replica, if it has one."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('db_replica') if has_request_context() else None
+
+        if not _is_plain_read(clause) or self._flushing:
+            self.info['wrote'] = True
+
+        elif replica and not self.info.get('wrote'):
+            return db.get_engine(self.app, bind=replica)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with RoutingSession and named engines."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_engine(self, app=None, bind=None):
+        engine = super().get_engine(app, bind)
+        ENGINE_NAMES[engine] = bind or 'primary'
+        return engine
+
+
+db = RoutingSQLAlchemy()
+
+
+def add_replicas(app, replica_uris):
+    """Register read replicas (database URLs) as binds replica_0, ..."""
+
+    if app.config.get('SQLALCHEMY_BINDS') is None:
+        app.config['SQLALCHEMY_BINDS'] = {}
+
+    replica_binds = app.config.setdefault('SQLALCHEMY_REPLICA_BINDS', [])
+
+    for uri in replica_uris:
+        bind = f'replica_{len(replica_binds)}'
+        app.config['SQLALCHEMY_BINDS'][bind] = uri
+        replica_binds.append(bind)
+
+
+def connect_db(app, replica_uris=()):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. `replica_uris` are read
+    replicas of the main database, if there are any.
     """
 
     db.app = app
+    add_replicas(app, replica_uris)
     db.init_app(app)
 
 
+##############################################################################
+# Per-request SQL statistics
+#
+# Every statement run by any engine is timed; while a request is being
+# handled (and app.py has put a QueryStats on g) it's also tallied there, so
+# we can report query counts and spot N+1 patterns.
+
+# IN lists render one placeholder per value; collapse them so the same
+# query with a different number of ids still counts as one shape
+IN_LIST_RE = re.compile(r'IN \(\s*(?:(?:%\(\w+\)s|\?|:\w+)\s*,?\s*)+\)',
+                        re.IGNORECASE)
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Normalize SQL so repeats of the same query compare equal."""
+
+    shape = IN_LIST_RE.sub('IN (...)', statement)
+    return WHITESPACE_RE.sub(' ', shape).strip()
+
+
+class QueryStats:
+    """Statements run while handling one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self.engines = Counter()
+
+    def record(self, statement, duration, engine='primary'):
+        """Count one statement that took `duration` seconds on `engine`."""
+
+        self.count += 1
+        self.duration += duration
+        self.shapes[statement_shape(statement)] += 1
+        self.engines[engine] += 1
+
+    def repeated(self, threshold):
+        """[(shape, times)] for shapes run at least `threshold` times."""
+
+        return [(shape, times)
+                for shape, times in self.shapes.most_common()
+                if times >= threshold]
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context,
+                       executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start_time'].pop()
+    engine = ENGINE_NAMES.get(conn.engine, 'primary')
+    ENGINE_QUERY_COUNTS[engine] += 1
+
+    if has_request_context() and 'query_stats' in g:
+        g.query_stats.record(statement, duration, engine)
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -36,6 +170,28 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with the followed user, so it finds followers;
+    # this one finds who a user follows
+    __table_args__ = (
+        db.Index('ix_follows_following_followed',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?
+
+        An EXISTS against the primary key, so it never loads either user's
+        collections.
+        """
+
+        return db.session.query(
+            cls.query
+            .filter_by(user_following_id=follower_id,
+                       user_being_followed_id=followed_id)
+            .exists()
+        ).scalar()
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -57,6 +213,16 @@ class Likes(db.Model):
         db.ForeignKey('messages.id', ondelete='cascade')
     )
 
+    # A user likes a message at most once
+    __table_args__ = (
+        db.Index('uq_likes_user_message', 'user_id', 'message_id',
+                 unique=True),
+        # For deleting a message's likes (the cascade, and account purges)
+        db.Index('ix_likes_message', 'message_id'),
+        # A user's likes, newest first (the likes page)
+        db.Index('ix_likes_user_id', 'user_id', 'id'),
+    )
+
     def __repr__(self):
         return f"<Like #{self.id}: {self.user_id}, {self.message_id}>"
 
@@ -106,7 +272,85 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counts for profile cards; kept up to date by the views
+    # via adjust_counts() and repaired by reconcile_counts()
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever anything shown on the user's pages changes (counts,
+    # profile), so the pages can answer conditional GETs cheaply
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    # Bumped only when what message cards show of the user (username,
+    # picture) may have changed; counts moving don't touch it
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set when the account is deleted; it's hidden from then on, until
+    # account_purge.py removes it and everything it made
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        # Finds the few accounts over the timeline fan-out limit
+        db.Index('ix_users_follower_count', 'follower_count'),
+        # Finds recently changed users (follow_graph.py's refresh)
+        db.Index('ix_users_updated_at', 'updated_at'),
+        # Finds the (few) deleted accounts waiting to be purged
+        db.Index('ix_users_deleted', 'id',
+                 postgresql_where=deleted_at.isnot(None),
+                 sqlite_where=deleted_at.isnot(None)),
+    )
+
+    # Let the database's ON DELETE CASCADE remove a deleted user's messages
+    # instead of the ORM loading them and nulling out user_id
+    messages = db.relationship('Message',
+                               cascade='all, delete',
+                               passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -133,23 +377,62 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(self.id, other_user.id)
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` does this user follow?
+
+        One query for a whole page of users; returns a set so templates can
+        check each card in O(1).
+        """
+
+        user_ids = list(user_ids)
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids))
+                .all())
+
+        return {followed_id for (followed_id,) in rows}
+
+    def liked_ids_among(self, message_ids):
+        """Which of `message_ids` has this user liked?
+
+        Checks just the messages on a page (via the unique likes index)
+        instead of loading every like the user has made; returns a set.
+        """
+
+        message_ids = list(message_ids)
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(message_ids))
+                .all())
+
+        return {message_id for (message_id,) in rows}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
 
-        Hashes password and adds user to system.
+        Hashes password (on the password pool) and adds user to system.
+        Raises PasswordPoolFull if the pool is too busy.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_pool.hash(password)
 
         user = User(
             username=username,
@@ -170,17 +453,148 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A password hashed with an old work factor is re-hashed with the
+        current one (the caller should commit). Raises PasswordPoolFull if
+        the password pool is too busy.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = (cls
+                .query
+                .filter_by(username=username)
+                .filter(cls.visible())
+                .first())
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_pool.check(user.password, password)
             if is_auth:
+                if password_pool.needs_rehash(user.password):
+                    user.password = password_pool.hash(password)
                 return user
 
         return False
 
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to the counters of one user id, or a list or query
+        of them.
+
+        e.g. User.adjust_counts(user.id, like_count=1)
+
+        This is a single UPDATE, so concurrent requests can't lose counts.
+        Also bumps the users' version. Doesn't commit.
+        """
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+
+        changes = {getattr(cls, name): getattr(cls, name) + delta
+                   for name, delta in deltas.items()}
+        changes.update(cls.version_bump())
+
+        (cls
+         .query
+         .filter(cls.id.in_(user_ids))
+         .update(changes, synchronize_session=False))
+
+    @classmethod
+    def profile_changed(cls, user_ids):
+        """Bump the version and profile version of users who edited their
+        profile (see message_cards.py). Doesn't commit."""
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+
+        (cls
+         .query
+         .filter(cls.id.in_(user_ids))
+         .update({cls.profile_version: cls.profile_version + 1,
+                  **cls.version_bump()},
+                 synchronize_session=False))
+
+    @classmethod
+    def version_bump(cls):
+        """UPDATE values marking a user as changed."""
+
+        return {cls.version: cls.version + 1,
+                cls.updated_at: datetime.utcnow()}
+
+    @classmethod
+    def counter_values(cls):
+        """Map each counter column to a subquery computing its true value."""
+
+        return {
+            cls.message_count: (select([db.func.count(Message.id)])
+                                .where(Message.user_id == cls.id)
+                                .as_scalar()),
+            cls.like_count: (select([db.func.count(Likes.id)])
+                             .where(Likes.user_id == cls.id)
+                             .as_scalar()),
+            cls.following_count: (select([db.func.count()])
+                                  .where(Follows.user_following_id == cls.id)
+                                  .as_scalar()),
+            cls.follower_count: (select([db.func.count()])
+                                 .where(Follows.user_being_followed_id == cls.id)
+                                 .as_scalar()),
+        }
+
+    @classmethod
+    def reconcile_counts(cls, user_ids=None, chunk_size=1000):
+        """Recompute counters and fix any that drifted.
+
+        Checks `user_ids`, or every user if not given. Returns the ids that
+        were fixed. Doesn't commit.
+        """
+
+        values = cls.counter_values()
+
+        drifted = (db.session
+                   .query(cls.id)
+                   .filter(or_(*[column != value
+                                 for column, value in values.items()])))
+
+        if user_ids is not None:
+            drifted = drifted.filter(cls.id.in_(user_ids))
+
+        drifted_ids = [user_id for (user_id,) in drifted]
+
+        for start in range(0, len(drifted_ids), chunk_size):
+            (cls
+             .query
+             .filter(cls.id.in_(drifted_ids[start:start + chunk_size]))
+             .update({**values, **cls.version_bump()},
+                     synchronize_session=False))
+
+        return drifted_ids
+
+    @classmethod
+    def visible(cls):
+        """Filter for users that haven't been deleted."""
+
+        return cls.deleted_at.is_(None)
+
+    @classmethod
+    def is_deleted(cls, user_id):
+        """EXISTS clause: is the user with id `user_id` (a column) deleted?
+
+        Correlated, so PostgreSQL probes ix_users_deleted per row instead of
+        hashing every deleted id and scanning the other table.
+        """
+
+        return exists().where(and_(cls.id == user_id,
+                                   cls.deleted_at.isnot(None)))
+
+    @classmethod
+    def mark_deleted(cls, user_id):
+        """Hide a user (and what they made) straight away. Doesn't commit;
+        account_purge.request_purge() arranges for the rest."""
+
+        (cls
+         .query
+         .filter(cls.id == user_id)
+         .update({cls.deleted_at: datetime.utcnow(), **cls.version_bump()},
+                 synchronize_session=False))
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -200,7 +614,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -211,6 +625,115 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # A user's messages, newest first (for profiles and timeline rebuilds)
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
     def __repr__(self):
         return f"<Message #{self.id}: {self.text}, {self.timestamp}, {self.user_id}>"
 
+    @classmethod
+    def visible(cls):
+        """Filter for messages whose author hasn't been deleted."""
+
+        return ~User.is_deleted(cls.user_id)
+
+    @classmethod
+    def release_like_counts(cls, message_ids):
+        """Take messages out of their likers' like counts.
+
+        `message_ids` is a list or query of ids. Call just before deleting
+        the messages; their likes go with them via the database cascade.
+        Doesn't commit.
+        """
+
+        likes_here = (select([db.func.count(Likes.id)])
+                      .where(Likes.user_id == User.id)
+                      .where(Likes.message_id.in_(message_ids))
+                      .as_scalar())
+
+        (User
+         .query
+         .filter(User.id.in_(db.session
+                             .query(Likes.user_id)
+                             .filter(Likes.message_id.in_(message_ids))))
+         .update({User.like_count: User.like_count - likes_here,
+                  **User.version_bump()},
+                 synchronize_session=False))
+
+    def serialize(self):
+        """Serialize to a dictionary for JSON responses."""
+
+        return {
+            "id": self.id,
+            "text": self.text,
+            "timestamp": self.timestamp.isoformat(),
+            "user_id": self.user_id,
+        }
+
+
+class MessageTerm(db.Model):
+    """One entry in the inverted index of message text: `term` appears in
+    message `message_id` (see message_search.py)."""
+
+    __tablename__ = 'message_terms'
+
+    term = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    def __repr__(self):
+        return f"<MessageTerm {self.term!r}: {self.message_id}>"
+
+
+class TimelineEntry(db.Model):
+    """A message fanned out to a follower's home timeline.
+
+    Rows are written when a message is posted (see timelines.py), so reading
+    a home timeline is a single range scan on (user_id, timestamp).
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # The second one lets deleting a message find its entries
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timeline_entries_message', 'message_id'),
+    )
+
+    def __repr__(self):
+        return f"<TimelineEntry {self.user_id}: {self.message_id}, {self.timestamp}>"
+
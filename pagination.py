@@ -0,0 +1,99 @@
+"""Keyset ("before" cursor) pagination for message lists.
+
+Pages are ordered newest first by (timestamp, id) -- or by an id alone,
+for lists ordered by something other than the messages' age (id_page()).
+Instead of OFFSET, each page carries an opaque cursor for its last row, and
+the next page asks for rows strictly older than it. That's the same indexed seek on page 1 and on
+page 10,000.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+PAGE_SIZE = 100
+
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class InvalidCursor(ValueError):
+    """A cursor that we didn't make (or that got mangled)."""
+
+
+def encode_cursor(timestamp, id):
+    """Opaque cursor pointing at the row (timestamp, id)."""
+
+    raw = f"{timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}|{id}"
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (timestamp, id).
+
+    Raises InvalidCursor if it can't be decoded.
+    """
+
+    try:
+        raw = urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, id = raw.split('|')
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(id)
+    except (ValueError, UnicodeError) as exc:
+        raise InvalidCursor(cursor) from exc
+
+
+def encode_id_cursor(id):
+    """Opaque cursor for lists ordered by an id alone (like a user's
+    likes, newest like first)."""
+
+    return urlsafe_b64encode(str(id).encode('utf-8')).decode('ascii')
+
+
+def decode_id_cursor(cursor):
+    """Turn an id cursor back into the id.
+
+    Raises InvalidCursor if it can't be decoded.
+    """
+
+    try:
+        return int(urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError) as exc:
+        raise InvalidCursor(cursor) from exc
+
+
+def keyset(query, timestamp_col, id_col, before=None):
+    """Order `query` newest first, starting just past the `before` row.
+
+    `before` is a decoded (timestamp, id) pair, or None for the first page.
+    """
+
+    if before:
+        query = query.filter(tuple_(timestamp_col, id_col) < tuple_(*before))
+
+    return query.order_by(timestamp_col.desc(), id_col.desc())
+
+
+def page(items, limit=PAGE_SIZE):
+    """Split up to `limit + 1` fetched messages into (page, next_cursor).
+
+    Fetching one extra row tells us whether there's an older page without
+    a separate COUNT; next_cursor is None on the last page.
+    """
+
+    if len(items) <= limit:
+        return items, None
+
+    items = items[:limit]
+    last = items[-1]
+
+    return items, encode_cursor(last.timestamp, last.id)
+
+
+def id_page(rows, limit=PAGE_SIZE):
+    """page() for up to `limit + 1` (item, id) rows ordered by that id,
+    newest first: returns (items, next_cursor)."""
+
+    next_cursor = (encode_id_cursor(rows[limit - 1][1])
+                   if len(rows) > limit else None)
+
+    return [item for item, _ in rows[:limit]], next_cursor
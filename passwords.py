@@ -0,0 +1,174 @@
+"""Password hashing on a bounded worker pool.
+
+bcrypt is deliberately slow. Run on the request thread, a burst of logins
+(or a credential-stuffing attack) occupies every worker and everything
+else queues behind it. Instead, hashing and checking go through a small,
+fixed-size thread pool (bcrypt releases the GIL while it works), with a
+cap on how many jobs may be waiting. Past the cap we fail fast with
+PasswordPoolFull rather than queue without bound, so the cheap routes
+keep their share of the CPU.
+
+Every pending job is a request thread waiting on it, so the cap is kept
+below the number of request threads per process: however many logins
+arrive at once, RESERVED_REQUEST_THREADS threads are left for everything
+else.
+
+Settings (read by init_app):
+
+- BCRYPT_LOG_ROUNDS: work factor for new hashes. Hashes made with any
+  other cost are re-hashed on the next successful login.
+- PASSWORD_HASH_WORKERS: threads doing bcrypt work (default: CPU count).
+- REQUEST_THREADS: request threads per process (default 8; gunicorn's
+  `threads`).
+- PASSWORD_HASH_MAX_PENDING: most jobs running or queued (default:
+  REQUEST_THREADS - RESERVED_REQUEST_THREADS, at least 1).
+- PASSWORD_HASH_TIMEOUT: seconds to wait for a result (default 3).
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+DEFAULT_LOG_ROUNDS = 12
+DEFAULT_TIMEOUT = 3
+DEFAULT_REQUEST_THREADS = 8
+
+# Request threads that password jobs never tie up
+RESERVED_REQUEST_THREADS = 2
+
+
+def default_max_pending(request_threads):
+    """Pending cap leaving RESERVED_REQUEST_THREADS threads free."""
+
+    return max(1, request_threads - RESERVED_REQUEST_THREADS)
+
+
+class PasswordPoolFull(Exception):
+    """Too many password jobs are pending; try again later."""
+
+
+class PasswordPool:
+    """Bounded executor for bcrypt hashing and checking."""
+
+    def __init__(self, app=None):
+        self.log_rounds = DEFAULT_LOG_ROUNDS
+        self.workers = os.cpu_count() or 1
+        self.max_pending = default_max_pending(DEFAULT_REQUEST_THREADS)
+        self.timeout = DEFAULT_TIMEOUT
+
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings from `app.config`."""
+
+        self.log_rounds = app.config.get('BCRYPT_LOG_ROUNDS',
+                                         DEFAULT_LOG_ROUNDS)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS',
+                                      os.cpu_count() or 1)
+        request_threads = app.config.get('REQUEST_THREADS',
+                                         DEFAULT_REQUEST_THREADS)
+        self.max_pending = app.config.get('PASSWORD_HASH_MAX_PENDING',
+                                          default_max_pending(request_threads))
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT',
+                                      DEFAULT_TIMEOUT)
+
+        # Restart the executor on first use with the new settings
+        self.shutdown()
+
+    def shutdown(self):
+        """Stop the worker threads (they're restarted on next use)."""
+
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+            self._slots = None
+
+    def _ensure_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='bcrypt')
+                self._slots = threading.BoundedSemaphore(self.max_pending)
+
+            return self._executor, self._slots
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result."""
+
+        executor, slots = self._ensure_executor()
+
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordPoolFull()
+
+        with self._lock:
+            self.pending += 1
+
+        def release(future):
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+            slots.release()
+
+        future = executor.submit(fn, *args)
+        future.add_done_callback(release)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordPoolFull()
+
+    def hash(self, password):
+        """bcrypt hash of `password`, as a string."""
+
+        hashed = self._run(bcrypt.generate_password_hash,
+                           password, self.log_rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        return self._run(bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different work factor than ours?
+
+        bcrypt hashes look like $2b$12$..., where 12 is the cost.
+        """
+
+        try:
+            cost = int(hashed.split('$')[2])
+        except (IndexError, ValueError):
+            return True
+
+        return cost != self.log_rounds
+
+    def stats(self):
+        """Pool size, current queue depth and lifetime counts."""
+
+        return {
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
+
+
+password_pool = PasswordPool()
@@ -0,0 +1,144 @@
+"""Check that the main routes' queries use indexes.
+
+Requests each route through the test client (as a logged-in user), records
+every SELECT (or WITH ... SELECT) it runs, and EXPLAINs them. A sequential scan of a table with
+at least `min_rows` rows means a query will slow down as the table grows,
+so it's reported. (Small tables are fine: scanning them is often cheaper
+than an index, and the planner knows it.)
+
+Needs PostgreSQL, and a database with realistic data in it (the planner's
+choices depend on table sizes; run ANALYZE after loading).
+"""
+
+import re
+import threading
+
+from sqlalchemy import event
+
+from models import db, Follows, Message, User
+
+SEQ_SCAN_RE = re.compile(r'Seq Scan on (\w+)')
+
+DEFAULT_MIN_ROWS = 10000
+
+
+def sample_paths():
+    """Paths for the main routes, with ids of real rows, plus the user to
+    view them as (someone who follows people)."""
+
+    viewer_id = (db.session
+                 .query(Follows.user_following_id)
+                 .group_by(Follows.user_following_id)
+                 .order_by(db.func.count().desc())
+                 .limit(1)
+                 .scalar())
+    user_id = (db.session
+               .query(User.id)
+               .order_by(User.message_count.desc())
+               .limit(1)
+               .scalar())
+    message_id = db.session.query(db.func.max(Message.id)).scalar()
+
+    paths = ['/', '/users', '/users?q=bird', '/messages/search?q=bird',
+             '/messages/search?q=bi*']
+
+    if user_id:
+        paths += [f'/users/{user_id}',
+                  f'/users/{user_id}/likes',
+                  f'/users/{user_id}/following',
+                  f'/users/{user_id}/followers']
+
+    if message_id:
+        paths.append(f'/messages/{message_id}')
+
+    return paths, viewer_id or user_id
+
+
+def table_sizes():
+    """Estimated rows per table, from the planner's statistics."""
+
+    rows = db.session.execute("""
+        SELECT relname, reltuples FROM pg_class
+        WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace
+    """)
+
+    return {name: count for name, count in rows}
+
+
+def seq_scans(plan, sizes, min_rows):
+    """Tables in EXPLAIN output `plan` (lines) that are scanned
+    sequentially and have at least `min_rows` rows."""
+
+    return sorted({table
+                   for line in plan
+                   for table in SEQ_SCAN_RE.findall(line)
+                   if sizes.get(table, 0) >= min_rows})
+
+
+def route_queries(app, paths, viewer_id):
+    """{path: [(statement, parameters), ...]} of the queries each path
+    runs."""
+
+    from app import CURR_USER_KEY
+
+    client = app.test_client()
+
+    if viewer_id:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = viewer_id
+
+    queries = {}
+    current = []
+
+    # (not background threads' queries, e.g. loading the follow graph)
+    request_thread = threading.get_ident()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        # (WITH: CTEs, like message search's prefix scan, are the heaviest)
+        if (threading.get_ident() == request_thread
+                and statement.lstrip().upper().startswith(('SELECT',
+                                                           'WITH'))):
+            current.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+
+    try:
+        for path in paths:
+            current.clear()
+            client.get(path)
+            queries[path] = list(current)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+    return queries
+
+
+def check_query_plans(app, min_rows=DEFAULT_MIN_ROWS):
+    """EXPLAIN each main route's queries.
+
+    Returns a list of (path, statement, tables) for queries that
+    sequentially scan a large table; empty if everything uses indexes.
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        raise RuntimeError("query plan checks need PostgreSQL")
+
+    paths, viewer_id = sample_paths()
+    sizes = table_sizes()
+    db.session.remove()
+
+    problems = []
+
+    for path, queries in route_queries(app, paths, viewer_id).items():
+        for statement, parameters in queries:
+            cursor = db.session.connection().connection.cursor()
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            plan = [line for (line,) in cursor.fetchall()]
+
+            tables = seq_scans(plan, sizes, min_rows)
+            if tables:
+                problems.append((path, statement, tables))
+
+    db.session.rollback()
+
+    return problems
@@ -0,0 +1,317 @@
+"""'Who to follow' suggestions, computed in a nightly batch.
+
+A user's candidates are scored from two signals:
+
+- friends of friends: how many of the people they follow follow the
+  candidate, i.e. F @ F, with F the users x users follow matrix;
+- co-likes: how many messages they and the candidate both liked, i.e.
+  L @ L.T, with L the users x messages like matrix.
+
+Both are sparse matrix products (scipy), so the counting happens in C
+rather than in Python or in the database. The edges are read once with
+COPY; the products are then taken a chunk of `chunk_size` users (rows) at
+a time, so memory stays at the two matrices plus one chunk's scores, and
+the best `top_n` candidates per user (not themselves, not anyone they
+already follow, not deleted) replace that chunk's rows in
+`recommendations`.
+
+The home page then shows a user's top few with one indexed lookup
+(recommended_users()). Following someone drops them from your list right
+away; anything else (new users, new follows) shows up after the next
+`flask build-recommendations`, which is meant to run nightly.
+
+numpy and scipy are only needed by the job: without them the job raises
+RecommendationsUnavailable and the sidebar shows whatever the table has.
+"""
+
+import csv
+import io
+import time
+from datetime import datetime
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+from models import db, User, Follows, Likes
+
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_TOP_N = 20
+
+# Suggestions shown in the home page sidebar
+SIDEBAR_LENGTH = 5
+
+# A co-liked message counts for less than a followee following them
+FRIENDS_OF_FRIENDS_WEIGHT = 1.0
+CO_LIKE_WEIGHT = 0.5
+
+# Users per COPY when reading edges from PostgreSQL
+LOAD_CHUNK_USERS = 100000
+
+
+class RecommendationsUnavailable(Exception):
+    """numpy/scipy aren't installed."""
+
+
+class Recommendation(db.Model):
+    """One of a user's suggested follows."""
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Not a foreign key: a purge would have to scan this table for the
+    # user; recommended_users() joins users, which drops them anyway
+    candidate_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    generated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    def __repr__(self):
+        return (f"<Recommendation {self.user_id} #{self.rank}: "
+                f"{self.candidate_id} ({self.score})>")
+
+
+def recommended_users(user_id, limit=SIDEBAR_LENGTH):
+    """The (visible) users suggested to `user_id`, best first."""
+
+    return (User.query
+            .join(Recommendation, Recommendation.candidate_id == User.id)
+            .filter(Recommendation.user_id == user_id, User.visible())
+            .order_by(Recommendation.rank)
+            .limit(limit)
+            .all())
+
+
+def forget_recommendation(user_id, candidate_id):
+    """`user_id` followed `candidate_id`: stop suggesting them."""
+
+    (Recommendation.query
+     .filter_by(user_id=user_id, candidate_id=candidate_id)
+     .delete(synchronize_session=False))
+
+
+##############################################################################
+# The batch job
+
+
+def _edges(column_a, column_b):
+    """(a, b) int arrays of every row of column_a's table."""
+
+    table = column_a.table
+
+    if db.engine.dialect.name != 'postgresql':
+        rows = db.session.query(column_a, column_b).all()
+        pairs = np.array(rows, dtype=np.int64).reshape(-1, 2)
+        return pairs[:, 0], pairs[:, 1]
+
+    max_id = db.session.query(db.func.max(column_a)).scalar() or 0
+    cursor = db.session.connection().connection.cursor()
+    chunks = []
+
+    # The text is parsed in C by numpy, not split into Python objects
+    for low in range(0, max_id + 1, LOAD_CHUNK_USERS):
+        buf = io.BytesIO()
+        cursor.copy_expert(
+            f"COPY (SELECT {column_a.name}, {column_b.name} "
+            f"FROM {table.name} WHERE {column_a.name} >= {low} "
+            f"AND {column_a.name} < {low + LOAD_CHUNK_USERS}) TO STDOUT",
+            buf)
+        chunks.append(np.fromstring(buf.getvalue(), dtype=np.int64, sep=' '))
+
+    pairs = np.concatenate(chunks or [np.empty(0, np.int64)]).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def _matrix(rows, cols, shape):
+    """CSR matrix with a 1 at each (row, col)."""
+
+    # (Skipping rows of users who signed up after we listed users)
+    inside = (rows < shape[0]) & (cols < shape[1])
+    rows, cols = rows[inside], cols[inside]
+
+    return sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape)
+
+
+def load_matrices():
+    """(follows, likes, candidates): the follow and like matrices, and a
+    boolean array of the user ids that may be suggested."""
+
+    user_ids = np.array(
+        [user_id for (user_id,) in db.session.query(User.id)
+         .filter(User.visible())], dtype=np.int64)
+    n_users = int(user_ids.max()) + 1 if len(user_ids) else 0
+
+    candidates = np.zeros(n_users, dtype=bool)
+    candidates[user_ids] = True
+
+    followers, followed = _edges(Follows.user_following_id,
+                                 Follows.user_being_followed_id)
+    follows = _matrix(followers, followed, (n_users, n_users))
+
+    likers, message_ids = _edges(Likes.user_id, Likes.message_id)
+    n_messages = int(message_ids.max()) + 1 if len(message_ids) else 0
+    likes = _matrix(likers, message_ids, (n_users, n_messages))
+
+    return follows, likes, candidates
+
+
+def score_matrices(follows, likes):
+    """(people, paths): one product of a chunk of `people` rows with
+    `paths` scores both signals at once.
+
+    people = [F | L] and paths = [[w1 * F], [w2 * L.T]], so
+    people[rows] @ paths = w1 * F[rows] @ F + w2 * L[rows] @ L.T.
+    (Adding the two products instead would cost a sort of the sum.)
+    """
+
+    people = sparse.hstack([follows, likes], format='csr')
+    paths = sparse.vstack([FRIENDS_OF_FRIENDS_WEIGHT * follows,
+                           CO_LIKE_WEIGHT * likes.T], format='csr')
+
+    return people, paths
+
+
+def score_chunk(people, paths, follows, candidates, start, end, top_n):
+    """The best `top_n` candidates for users start..end-1.
+
+    Returns (user_ids, ranks, candidate_ids, scores) arrays.
+    """
+
+    scores = people[start:end] @ paths
+    indptr, indices, data = scores.indptr, scores.indices, scores.data
+
+    # Never themselves, nor anyone deleted
+    rows = np.repeat(np.arange(start, end), np.diff(indptr))
+    data[(indices == rows) | ~candidates[indices]] = 0
+
+    out_users, out_ranks, out_candidates, out_scores = [], [], [], []
+
+    for row in range(end - start):
+        user_id = start + row
+        lo, hi = indptr[row], indptr[row + 1]
+
+        if lo == hi or not candidates[user_id]:
+            continue
+
+        row_ids, row_scores = indices[lo:hi], data[lo:hi]
+        followed = follows.indices[follows.indptr[user_id]:
+                                   follows.indptr[user_id + 1]]
+
+        # The best few, with room for ones they already follow
+        k = top_n + len(followed)
+        if len(row_scores) > k:
+            best = np.argpartition(-row_scores, k)[:k]
+            row_ids, row_scores = row_ids[best], row_scores[best]
+
+        keep = (row_scores > 0) & ~np.isin(row_ids, followed)
+        row_ids, row_scores = row_ids[keep], row_scores[keep]
+
+        # Highest score first; ties to the lowest (oldest) user id
+        best = np.lexsort((row_ids, -row_scores))[:top_n]
+
+        out_users.append(np.full(len(best), user_id))
+        out_ranks.append(np.arange(1, len(best) + 1))
+        out_candidates.append(row_ids[best])
+        out_scores.append(row_scores[best])
+
+    if not out_users:
+        empty = np.empty(0, np.int64)
+        return empty, empty, empty, np.empty(0, np.float32)
+
+    return (np.concatenate(out_users), np.concatenate(out_ranks),
+            np.concatenate(out_candidates), np.concatenate(out_scores))
+
+
+def _save_chunk(start, end, chunk, generated_at):
+    """Replace the recommendations of users start..end-1."""
+
+    (Recommendation.query
+     .filter(Recommendation.user_id >= start, Recommendation.user_id < end)
+     .delete(synchronize_session=False))
+
+    rows = zip(*(column.tolist() for column in chunk))
+
+    if db.engine.dialect.name == 'postgresql':
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for user_id, rank, candidate_id, score in rows:
+            writer.writerow((user_id, rank, candidate_id, score,
+                             generated_at.isoformat()))
+        buf.seek(0)
+
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            "COPY recommendations (user_id, rank, candidate_id, score, "
+            "generated_at) FROM STDIN WITH (FORMAT csv)", buf)
+    else:
+        db.session.execute(Recommendation.__table__.insert(), [
+            dict(user_id=user_id, rank=rank, candidate_id=candidate_id,
+                 score=score, generated_at=generated_at)
+            for user_id, rank, candidate_id, score in rows])
+
+    db.session.commit()
+
+
+def build_recommendations(chunk_size=DEFAULT_CHUNK_SIZE, top_n=DEFAULT_TOP_N,
+                          log=print):
+    """Recompute everyone's suggestions. Returns how many were saved."""
+
+    if sparse is None:
+        raise RecommendationsUnavailable(
+            "Building recommendations needs numpy and scipy "
+            "(pip install -r requirements.txt).")
+
+    started = time.perf_counter()
+    generated_at = datetime.utcnow()
+
+    follows, likes, candidates = load_matrices()
+    log(f"Loaded {follows.nnz} follows and {likes.nnz} likes "
+        f"in {time.perf_counter() - started:.1f}s.")
+
+    people, paths = score_matrices(follows, likes)
+    del likes
+    n_users = len(candidates)
+
+    saved = 0
+
+    for start in range(0, n_users, chunk_size):
+        end = min(start + chunk_size, n_users)
+        chunk = score_chunk(people, paths, follows, candidates, start, end,
+                            top_n)
+        _save_chunk(start, end, chunk, generated_at)
+        saved += len(chunk[0])
+
+        log(f"Users {start}-{end - 1}: {len(chunk[0])} suggestions "
+            f"({time.perf_counter() - started:.1f}s).")
+
+    # Users at or past n_users are gone (or new since the load); their old
+    # rows go too
+    (Recommendation.query
+     .filter(Recommendation.user_id >= n_users)
+     .delete(synchronize_session=False))
+    db.session.commit()
+
+    return saved
@@ -0,0 +1,281 @@
+"""Ranked user search over username, bio and location.
+
+The search is backed by real indexes instead of a LIKE '%q%' table scan:
+
+- PostgreSQL: a pg_trgm GiST index on username (fuzzy and substring
+  matches, closest first) plus a GIN index on a tsvector of username, bio
+  and location (word matches). Results are ranked by the better of the
+  two scores, with an exact username first. If the server doesn't ship
+  pg_trgm, only the tsvector index is used.
+
+- SQLite: an FTS5 table using the trigram tokenizer, kept in sync with
+  `users` by triggers and ranked with bm25().
+
+Any other database falls back to LIKE on username.
+
+The indexes are created along with the `users` table by db.create_all();
+create_search_indexes() adds them to an existing database.
+"""
+
+from sqlalchemy import DDL, event, func, literal_column, select, text, union
+
+from models import db, User
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGES = 10
+
+# Only this many index matches (of each kind) get ranked, so a very
+# common word costs the same as a rare one
+SEARCH_CANDIDATE_LIMIT = 1000
+
+# trigram indexes can't help with anything shorter
+MIN_TRIGRAM_LENGTH = 3
+
+# Must match the indexed expression exactly for the planner to use it
+USER_DOCUMENT_SQL = (
+    "to_tsvector('simple', "
+    "coalesce(users.username, '') || ' ' || "
+    "coalesce(users.bio, '') || ' ' || "
+    "coalesce(users.location, ''))"
+)
+
+# GiST rather than GIN: besides `%` and ILIKE, it can hand back the
+# closest usernames first (ORDER BY username <-> term), so the candidate
+# limit keeps the best matches rather than any
+POSTGRES_TRIGRAM_INDEXES = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm_gist "
+    "ON users USING gist (username gist_trgm_ops)",
+    "DROP INDEX IF EXISTS ix_users_username_trgm",
+]
+
+POSTGRES_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_users_document "
+    f"ON users USING gin (({USER_DOCUMENT_SQL}))",
+]
+
+SQLITE_INDEXES = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "username, bio, location, "
+    "content='users', content_rowid='id', tokenize='trigram')",
+
+    "CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users "
+    "BEGIN "
+    "INSERT INTO users_fts (rowid, username, bio, location) "
+    "VALUES (new.id, new.username, new.bio, new.location); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users "
+    "BEGIN "
+    "INSERT INTO users_fts (users_fts, rowid, username, bio, location) "
+    "VALUES ('delete', old.id, old.username, old.bio, old.location); "
+    "END",
+
+    # Only the searched columns -- counter updates shouldn't touch the index
+    "CREATE TRIGGER IF NOT EXISTS users_fts_update "
+    "AFTER UPDATE OF username, bio, location ON users "
+    "BEGIN "
+    "INSERT INTO users_fts (users_fts, rowid, username, bio, location) "
+    "VALUES ('delete', old.id, old.username, old.bio, old.location); "
+    "INSERT INTO users_fts (rowid, username, bio, location) "
+    "VALUES (new.id, new.username, new.bio, new.location); "
+    "END",
+]
+
+
+def trigram_available(bind):
+    """Can pg_trgm be installed on this PostgreSQL server?"""
+
+    return bind.execute("SELECT 1 FROM pg_available_extensions "
+                        "WHERE name = 'pg_trgm'").scalar() is not None
+
+
+def _trigram_available(ddl, target, bind, **kw):
+    return trigram_available(bind)
+
+
+for statement in POSTGRES_TRIGRAM_INDEXES:
+    event.listen(User.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='postgresql',
+                                           callable_=_trigram_available))
+
+for statement in POSTGRES_INDEXES:
+    event.listen(User.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
+
+for statement in SQLITE_INDEXES:
+    event.listen(User.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+
+event.listen(User.__table__, 'before_drop',
+             DDL("DROP TABLE IF EXISTS users_fts").execute_if(dialect='sqlite'))
+
+
+def create_search_indexes():
+    """Add the search indexes to an existing database.
+
+    Safe to run more than once. On SQLite this also (re)builds the FTS
+    table from `users`. Doesn't commit.
+    """
+
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        statements = POSTGRES_INDEXES
+
+        if trigram_available(db.session):
+            statements = POSTGRES_TRIGRAM_INDEXES + statements
+
+        for statement in statements:
+            db.session.execute(statement)
+
+        _trigram_installed.clear()
+
+    elif dialect == 'sqlite':
+        for statement in SQLITE_INDEXES:
+            db.session.execute(statement)
+        db.session.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+
+# engine url -> is pg_trgm installed in that database?
+_trigram_installed = {}
+
+
+def trigram_installed():
+    """Is pg_trgm installed in the database we're connected to?"""
+
+    url = str(db.engine.url)
+
+    if url not in _trigram_installed:
+        _trigram_installed[url] = db.session.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        ).scalar() is not None
+
+    return _trigram_installed[url]
+
+
+def escape_like(term):
+    """Escape LIKE wildcards in user input."""
+
+    return (term
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def _postgres_search(term):
+    """Query of users matching `term`, best first (PostgreSQL)."""
+
+    document = literal_column(USER_DOCUMENT_SQL)
+    tsquery = func.plainto_tsquery('simple', term)
+    rank = func.ts_rank(document, tsquery)
+
+    slices = [
+        # An exact username always makes the cut
+        select([User.id]).where(User.username == term),
+        # Word matches. ts_rank can't be read off the index, so for a very
+        # common word these are a sample; the username matches below are
+        # what people mostly look for.
+        (select([User.id])
+         .where(document.op('@@')(tsquery))
+         .limit(SEARCH_CANDIDATE_LIMIT)),
+    ]
+
+    if trigram_installed():
+        rank = func.greatest(func.similarity(User.username, term), rank)
+        # Closest usernames first, straight off the GiST index
+        slices.append(
+            select([User.id])
+            .where(db.or_(User.username.op('%')(term),
+                          User.username.ilike(f"%{escape_like(term)}%",
+                                              escape='\\')))
+            .order_by(User.username.op('<->')(term))
+            .limit(SEARCH_CANDIDATE_LIMIT))
+
+    candidates = union(*slices).alias('candidates')
+
+    return (User
+            .query
+            .join(candidates, candidates.c.id == User.id)
+            .order_by((User.username == term).desc(), rank.desc(), User.id))
+
+
+def _sqlite_search(term):
+    """Query of users matching `term`, best first (SQLite FTS5)."""
+
+    # Quote the whole term so FTS5 treats it as a string, not query syntax
+    phrase = '"' + term.replace('"', '""') + '"'
+
+    matches = (text("SELECT rowid AS id, bm25(users_fts) AS rank "
+                    "FROM users_fts WHERE users_fts MATCH :phrase "
+                    "LIMIT :candidates")
+               .bindparams(phrase=phrase, candidates=SEARCH_CANDIDATE_LIMIT)
+               .columns(id=db.Integer, rank=db.Float)
+               .alias('matches'))
+
+    return (User
+            .query
+            .join(matches, matches.c.id == User.id)
+            .order_by(matches.c.rank, User.id))
+
+
+def _like_search(term):
+    """Query of users whose username contains `term` (unindexed)."""
+
+    return (User
+            .query
+            .filter(User.username.like(f"%{escape_like(term)}%",
+                                       escape='\\'))
+            .order_by(User.id))
+
+
+def search_users(term, page=1):
+    """One page of users matching `term`, most relevant first.
+
+    Pages are SEARCH_PAGE_SIZE long and stop after SEARCH_MAX_PAGES, so a
+    search never sorts or skips more than a few hundred rows. Returns
+    (users, has_more).
+    """
+
+    page = min(max(page, 1), SEARCH_MAX_PAGES)
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        query = _postgres_search(term)
+    elif dialect == 'sqlite' and len(term) >= MIN_TRIGRAM_LENGTH:
+        query = _sqlite_search(term)
+    else:
+        query = _like_search(term)
+
+    users = (query
+             .filter(User.visible())
+             .offset((page - 1) * SEARCH_PAGE_SIZE)
+             .limit(SEARCH_PAGE_SIZE + 1)
+             .all())
+
+    has_more = len(users) > SEARCH_PAGE_SIZE and page < SEARCH_MAX_PAGES
+
+    return users[:SEARCH_PAGE_SIZE], has_more
+
+
+def browse_users(before=None):
+    """One page of all users, newest first, older than user id `before`.
+
+    Returns (users, next_before); next_before is None on the last page.
+    """
+
+    query = User.query.filter(User.visible())
+
+    if before is not None:
+        query = query.filter(User.id < before)
+
+    users = (query
+             .order_by(User.id.desc())
+             .limit(SEARCH_PAGE_SIZE + 1)
+             .all())
+
+    if len(users) <= SEARCH_PAGE_SIZE:
+        return users, None
+
+    users = users[:SEARCH_PAGE_SIZE]
+    return users, users[-1].id
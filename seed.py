@@ -1,20 +1,43 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+    python seed.py [CSV_DIR]
 
+CSV_DIR defaults to generator/. likes.csv is loaded too if it's there.
+"""
+
+import os
+import sys
+import time
+from functools import partial
+
+from app import app, db
+from bulk_load import load_csv
+from models import User
+from message_search import reindex_messages
+from timelines import rebuild_all_timelines
+
+# In load order (messages and likes need their users and messages)
+CSV_TABLES = ['users', 'messages', 'follows', 'likes']
+
+csv_dir = sys.argv[1] if len(sys.argv) > 1 else 'generator'
 
 db.drop_all()
 db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+for table in CSV_TABLES:
+    path = os.path.join(csv_dir, f'{table}.csv')
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+    if os.path.exists(path):
+        load_csv(db.engine, table, path)
 
-db.session.commit()
+# Nothing else is using the database yet, so the rebuilds can take the
+# fast path that locks their tables
+with app.app_context():
+    for step in [User.reconcile_counts,
+                 partial(rebuild_all_timelines, offline=True),
+                 partial(reindex_messages, offline=True)]:
+        started = time.monotonic()
+        step()
+        db.session.commit()
+        name = getattr(step, 'func', step).__name__
+        print(f"{name}: {time.monotonic() - started:.1f}s")
@@ -0,0 +1,60 @@
+// Like and follow buttons: post the form in the background (?format=json)
+// and flip the button, instead of loading a whole new page. Without
+// JavaScript, or if the request fails, the plain form still works.
+
+'use strict';
+
+const TOGGLES = [
+  {kind: 'like', on: true,
+   from: /\/messages\/(\d+)\/like$/, to: '/messages/$1/unlike'},
+  {kind: 'like', on: false,
+   from: /\/messages\/(\d+)\/unlike$/, to: '/messages/$1/like'},
+  {kind: 'follow', on: true,
+   from: /\/users\/follow\/(\d+)$/, to: '/users/stop-following/$1'},
+  {kind: 'follow', on: false,
+   from: /\/users\/stop-following\/(\d+)$/, to: '/users/follow/$1'},
+];
+
+function showState(button, kind, on) {
+  button.classList.toggle('btn-primary', on);
+
+  if (kind === 'like') {
+    button.classList.toggle('btn-secondary', !on);
+  } else {
+    button.classList.toggle('btn-outline-primary', !on);
+    button.textContent = on ? 'Unfollow' : 'Follow';
+  }
+}
+
+document.addEventListener('submit', async function (evt) {
+  const form = evt.target;
+  const action = form.getAttribute('action') || '';
+  const toggle = TOGGLES.find(t => t.from.test(action));
+
+  if (!toggle) return;
+
+  evt.preventDefault();
+
+  const button = form.querySelector('button');
+  button.disabled = true;
+
+  try {
+    const resp = await fetch(action + '?format=json', {
+      method: 'POST',
+      credentials: 'same-origin',
+      headers: {Accept: 'application/json'},
+    });
+
+    if (!resp.ok) throw new Error(`${action}: ${resp.status}`);
+
+  } catch (err) {
+    form.submit();
+    return;
+
+  } finally {
+    button.disabled = false;
+  }
+
+  form.setAttribute('action', action.replace(toggle.from, toggle.to));
+  showState(button, toggle.kind, toggle.on);
+});
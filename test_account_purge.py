@@ -0,0 +1,162 @@
+"""Account deletion and purge tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_account_purge.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from account_purge import (AccountPurge, purge_accounts, purge_stats,
+                           run_purge)
+from message_search import index_message
+from timelines import rebuild_all_timelines
+
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class AccountPurgeTestCase(TestCase):
+    """Test deleting accounts and purging them in the background."""
+
+    def setUp(self):
+        AccountPurge.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        gone = User.signup("gone", "gone@test.com", "password", None)
+        fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.flush()
+
+        # They follow each other and like each other's messages
+        for follower, followed in ((gone, fan), (fan, gone)):
+            db.session.add(Follows(user_following_id=follower.id,
+                                   user_being_followed_id=followed.id))
+            User.adjust_counts(follower.id, following_count=1)
+            User.adjust_counts(followed.id, follower_count=1)
+
+        likes = []
+        for author, liker in ((gone, fan), (fan, gone)):
+            for i in range(3):
+                msg = Message(text=f"warble {i}", user_id=author.id)
+                db.session.add(msg)
+                db.session.flush()
+                index_message(msg)
+                likes.append(Likes(user_id=liker.id, message_id=msg.id))
+            User.adjust_counts(author.id, message_count=3)
+            User.adjust_counts(liker.id, like_count=3)
+
+        db.session.add_all(likes)
+        db.session.commit()
+
+        self.gone_id = gone.id
+        self.fan_id = fan.id
+
+        with app.app_context():
+            rebuild_all_timelines()
+            db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        return super().tearDown()
+
+    def delete_account(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.gone_id
+
+        resp = self.client.post("/users/delete")
+        self.assertEqual(resp.status_code, 302)
+
+    def test_hidden_at_once(self):
+        """Is a deleted account gone from pages, search and login before
+        it's purged?"""
+
+        self.delete_account()
+
+        self.assertIsNotNone(User.query.get(self.gone_id))
+        self.assertEqual(purge_stats()['pending'], 1)
+
+        self.assertFalse(User.authenticate("gone", "password"))
+        self.assertEqual(
+            self.client.get(f"/users/{self.gone_id}").status_code, 404)
+
+        for url in (f"/users/{self.gone_id}/likes",
+                    f"/users/{self.gone_id}/likes?format=json"):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.fan_id
+
+        home = self.client.get("/").get_data(as_text=True)
+        self.assertNotIn("@gone", home)
+
+        found = self.client.get("/messages/search?q=warble")
+        self.assertNotIn("@gone", found.get_data(as_text=True))
+
+        users = self.client.get("/users?q=gone").get_data(as_text=True)
+        self.assertNotIn("@gone", users)
+
+        followers = self.client.get(f"/users/{self.fan_id}/followers")
+        self.assertNotIn("@gone", followers.get_data(as_text=True))
+
+    def test_purge_fixes_counts(self):
+        """Are the account's rows deleted, and everyone else's counters
+        fixed?"""
+
+        self.delete_account()
+
+        # Small chunks, so every step takes a few rounds
+        with app.app_context():
+            self.assertEqual(
+                purge_accounts(chunk_size=2, log=lambda msg: None), 1)
+
+        db.session.remove()
+
+        self.assertIsNone(User.query.get(self.gone_id))
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.filter_by(
+            user_id=self.gone_id).count(), 0)
+
+        fan = User.query.get(self.fan_id)
+        self.assertEqual((fan.like_count, fan.follower_count,
+                          fan.following_count), (0, 0, 0))
+        self.assertEqual(User.reconcile_counts(), [])
+
+        self.assertEqual(purge_stats()['pending'], 0)
+        with app.app_context():
+            self.assertEqual(purge_accounts(log=lambda msg: None), 0)
+
+    def test_resumes(self):
+        """Does an interrupted purge carry on from its last step?"""
+
+        self.delete_account()
+
+        purge = AccountPurge.query.get(self.gone_id)
+        purge.step = 'messages'
+        db.session.commit()
+
+        with app.app_context():
+            purge = AccountPurge.query.get(self.gone_id)
+            run_purge(purge, chunk_size=2, log=lambda msg: None)
+            self.assertIsNotNone(purge.finished_at)
+
+        self.assertIsNone(User.query.get(self.gone_id))
+        # Skipped steps' rows went with the user row (foreign keys cascade)
+        self.assertEqual(Likes.query.filter_by(user_id=self.gone_id).count(),
+                         0)
@@ -0,0 +1,102 @@
+"""Static asset build tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from assets import assets, brotli, build_assets, BUILD_DIR
+
+
+class AssetTestCase(TestCase):
+    """Test fingerprinting, compressing and serving static files."""
+
+    def setUp(self):
+        self.static = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.static, 'images'))
+
+        with open(os.path.join(self.static, 'images', 'bg.png'), 'wb') as f:
+            f.write(b'not really a png')
+        with open(os.path.join(self.static, 'style.css'), 'w') as f:
+            f.write('body { background: url("/static/images/bg.png"); }\n'
+                    + 'p { color: black; }\n' * 50)
+
+        self.manifest = build_assets(self.static, log=lambda message: None)
+        self.build = os.path.join(self.static, BUILD_DIR)
+
+        self.client = app.test_client()
+        self.saved = (assets.folder, assets.manifest)
+        assets.folder, assets.manifest = self.build, self.manifest
+
+    def tearDown(self):
+        assets.folder, assets.manifest = self.saved
+        shutil.rmtree(self.static)
+        return super().tearDown()
+
+    def read(self, path):
+        with open(os.path.join(self.build, path), 'rb') as f:
+            return f.read()
+
+    def test_build(self):
+        """Are files fingerprinted, compressed, and linked from CSS?"""
+
+        css = self.manifest['style.css']
+        png = self.manifest['images/bg.png']
+
+        self.assertRegex(css, r'^style\.[0-9a-f]{12}\.css$')
+        self.assertIn(f'/assets/{png}'.encode(), self.read(css))
+        self.assertEqual(gzip.decompress(self.read(css + '.gz')),
+                         self.read(css))
+
+        # Images aren't worth compressing
+        self.assertFalse(os.path.exists(os.path.join(self.build,
+                                                     png + '.gz')))
+
+        # Same contents, same names
+        self.assertEqual(build_assets(self.static, log=lambda message: None),
+                         self.manifest)
+
+    def test_serve(self):
+        """Are built files served compressed, and cached for good?"""
+
+        css = self.manifest['style.css']
+
+        with app.test_request_context():
+            self.assertEqual(assets.url('style.css'), f'/assets/{css}')
+            self.assertEqual(assets.url('missing.js'), '/static/missing.js')
+
+        resp = self.client.get(f'/assets/{css}',
+                               headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertEqual(resp.get_data(), self.read(css + '.gz'))
+
+        resp = self.client.get(f'/assets/{css}')
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.get_data(), self.read(css))
+
+    @skipIf(brotli is None, "brotli isn't installed")
+    def test_brotli(self):
+        """Is brotli preferred when the browser takes it?"""
+
+        css = self.manifest['style.css']
+        resp = self.client.get(f'/assets/{css}',
+                               headers={'Accept-Encoding': 'gzip, br'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(resp.get_data()), self.read(css))
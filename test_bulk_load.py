@@ -0,0 +1,96 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_bulk_load.py
+
+
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from bulk_load import load_csv
+
+
+db.create_all()
+
+USERS_CSV = """\
+id,email,username,password,location
+7,a@test.com,alice,HASHED_PASSWORD,Oslo
+9,b@test.com,"bob, jr",HASHED_PASSWORD,Lima
+"""
+
+
+class BulkLoadTestCase(TestCase):
+    """Test streaming CSVs into tables."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        db.session.commit()
+
+        handle, self.path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as file:
+            file.write(USERS_CSV)
+
+    def tearDown(self):
+        os.remove(self.path)
+        db.session.rollback()
+        User.query.delete()
+        db.session.commit()
+        return super().tearDown()
+
+    def index_names(self):
+        return {row[0] for row in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'users'")}
+
+    def test_copy(self):
+        """Does COPY load the rows, restore indexes and reset the id
+        sequence?"""
+
+        indexes = self.index_names()
+
+        rows = load_csv(db.engine, 'users', self.path, out=io.StringIO())
+
+        self.assertEqual(rows, 2)
+        self.assertEqual(User.query.get(9).username, "bob, jr")
+        self.assertEqual(self.index_names(), indexes)
+
+        user = User(email="c@test.com", username="carol",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.assertEqual(user.id, 10)
+
+    def test_executemany(self):
+        """Does the chunked fallback load rows and keep indexes?"""
+
+        engine = create_engine('sqlite://')
+        engine.execute(
+            "CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT, "
+            "username TEXT, password TEXT, location TEXT)")
+        engine.execute("CREATE INDEX ix_users_location ON users (location)")
+
+        rows = load_csv(engine, 'users', self.path, out=io.StringIO())
+
+        self.assertEqual(rows, 2)
+        self.assertEqual(
+            engine.execute("SELECT username FROM users WHERE id = 9").scalar(),
+            "bob, jr")
+        self.assertEqual(
+            engine.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"))
+            .scalar(),
+            "ix_users_location")
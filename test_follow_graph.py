@@ -0,0 +1,135 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_follow_graph.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import follow_graph as follow_graph_module
+from follow_graph import FollowGraph, follow_graph
+
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the in-memory follow graph."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password",
+                             None)
+                 for i in range(4)]
+        db.session.flush()
+        self.ids = [user.id for user in users]
+
+        a, b, c, d = self.ids
+        for follower_id, followed_id in ((a, b), (a, c), (b, a), (d, a)):
+            db.session.add(Follows(user_following_id=follower_id,
+                                   user_being_followed_id=followed_id))
+            User.adjust_counts(follower_id, following_count=1)
+            User.adjust_counts(followed_id, follower_count=1)
+        db.session.commit()
+
+        self.graph = FollowGraph()
+        self.graph.init_app(app)
+
+    def tearDown(self):
+        db.session.rollback()
+        follow_graph.ready = False
+        return super().tearDown()
+
+    def test_lookups(self):
+        """Does a loaded graph answer like the follows table?"""
+
+        a, b, c, d = self.ids
+
+        self.assertFalse(self.graph.ready)
+        self.graph.load()
+        self.assertTrue(self.graph.ready)
+
+        self.assertEqual(list(self.graph.following(a)), sorted([b, c]))
+        self.assertEqual(list(self.graph.following(c)), [])
+        self.assertEqual(list(self.graph.following(d + 1000)), [])
+        self.assertTrue(self.graph.is_following(b, a))
+        self.assertFalse(self.graph.is_following(a, d))
+        self.assertEqual(self.graph.following_among(a, [b, c, d]), {b, c})
+
+        stats = self.graph.stats()
+        self.assertEqual(stats['edges'], 4)
+        self.assertGreater(stats['bytes'], 0)
+
+    def test_chunked_load(self):
+        """Do small load chunks build the same arrays as one big one?"""
+
+        self.graph.load()
+        offsets, targets = self.graph._csr
+
+        with patch.object(follow_graph_module, 'LOAD_CHUNK_USERS', 2):
+            self.graph.load()
+
+        self.assertEqual(self.graph._csr, (offsets, targets))
+        self.assertEqual(len(offsets), max(self.ids) + 2)
+
+    def test_changes(self):
+        """Are this worker's changes applied at once, and other workers'
+        picked up by a refresh?"""
+
+        a, b, c, d = self.ids
+        self.graph.load()
+
+        self.graph.add(c, d)
+        self.graph.remove(a, b)
+        self.assertTrue(self.graph.is_following(c, d))
+        self.assertEqual(list(self.graph.following(a)), [c])
+
+        # Somebody else's follow, in the database only
+        db.session.add(Follows(user_following_id=d, user_being_followed_id=b))
+        User.adjust_counts(d, following_count=1)
+        db.session.commit()
+
+        self.graph.refresh()
+        self.assertEqual(list(self.graph.following(d)), sorted([a, b]))
+        # (and rows we'd changed ourselves are reread from the database)
+        self.assertEqual(list(self.graph.following(a)), sorted([b, c]))
+
+    def test_views(self):
+        """Do follow buttons and following pages come from the graph?"""
+
+        a, b, c, d = self.ids
+
+        with app.app_context():
+            follow_graph.load()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = c
+
+        self.client.post(f"/users/follow/{d}")
+        self.assertTrue(follow_graph.is_following(c, d))
+
+        resp = self.client.get(f"/users/{c}/following")
+        html = resp.get_data(as_text=True)
+        self.assertIn("@user3", html)
+        self.assertIn("Unfollow", html)
+
+        self.client.post(f"/users/stop-following/{d}")
+        self.assertFalse(follow_graph.is_following(c, d))
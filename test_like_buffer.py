@@ -0,0 +1,137 @@
+"""Like buffer tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_like_buffer.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from like_buffer import LikeBuffer, like_buffer
+
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LikeBufferTestCase(TestCase):
+    """Test buffering likes and writing them in batches."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        liker = User.signup("liker", "liker@test.com", "password", None)
+        db.session.flush()
+        msg = Message(text="like me", user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.liker_id = liker.id
+        self.msg_id = msg.id
+
+        self.buffer = LikeBuffer()
+        self.buffer.init_app(app)
+        self.buffer.interval = 60
+
+    def tearDown(self):
+        self.buffer.shutdown()
+        db.session.rollback()
+        return super().tearDown()
+
+    def like_count(self):
+        db.session.remove()
+        return User.query.get(self.liker_id).like_count
+
+    def test_toggles_collapse(self):
+        """Is only the last click per like written, and counted once?"""
+
+        for liked in [True, False, True]:
+            self.buffer.record(self.liker_id, self.msg_id, liked)
+
+        self.assertEqual(self.buffer.stats()['pending'], 1)
+        self.assertEqual(self.buffer.flush(), 1)
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(self.like_count(), 1)
+
+        # Liking again changes nothing; unliking removes it
+        self.buffer.record(self.liker_id, self.msg_id, True)
+        self.buffer.flush()
+        self.assertEqual(self.like_count(), 1)
+
+        self.buffer.record(self.liker_id, self.msg_id, False)
+        self.buffer.flush()
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(self.like_count(), 0)
+
+    def test_missing_message(self):
+        """Are likes of deleted messages dropped quietly?"""
+
+        self.buffer.record(self.liker_id, self.msg_id, True)
+        self.buffer.record(self.liker_id, -1, True)
+        self.buffer.flush()
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(self.like_count(), 1)
+        self.assertEqual(self.buffer.stats()['errors'], 0)
+
+    def test_overlay_and_shutdown(self):
+        """Are pending clicks shown to the clicker, and written on
+        shutdown?"""
+
+        self.buffer.record(self.liker_id, self.msg_id, True)
+
+        self.assertEqual(self.buffer.overlay(self.liker_id, set(),
+                                             [self.msg_id]),
+                         {self.msg_id})
+        self.assertEqual(self.buffer.overlay(-1, set(), [self.msg_id]),
+                         set())
+        self.assertTrue(self.buffer.has_pending(self.liker_id))
+        self.assertFalse(self.buffer.has_pending(-1))
+        self.assertEqual(Likes.query.count(), 0)
+
+        self.buffer.shutdown()
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(self.buffer.stats()['pending'], 0)
+
+    def test_like_view(self):
+        """Does a buffered like show up on the next page right away?"""
+
+        like_buffer.enabled = True
+        like_buffer.interval = 60
+
+        try:
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.liker_id
+
+            resp = self.client.post(f"/messages/{self.msg_id}/like"
+                                    "?format=json")
+            self.assertEqual(resp.get_json()['liked'], True)
+            # (at most loading the user; nothing written)
+            self.assertLessEqual(int(resp.headers['X-SQL-Queries']), 1)
+
+            html = self.client.get(f"/messages/{self.msg_id}").get_data(
+                as_text=True)
+            self.assertIn(f"/messages/{self.msg_id}/unlike", html)
+
+        finally:
+            like_buffer.shutdown()
+            like_buffer.enabled = False
+
+        self.assertEqual(Likes.query.count(), 1)
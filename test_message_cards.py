@@ -0,0 +1,113 @@
+"""Message card cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_message_cards.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from message_cards import MessageCardCache, message_cards
+
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MessageCardCacheTestCase(TestCase):
+    """Test caching rendered message cards."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        user = User.signup("author", "author@test.com", "password", None)
+        db.session.flush()
+        db.session.add_all([Message(text=f"warble {i}", user_id=user.id)
+                            for i in range(3)])
+        db.session.commit()
+        self.user_id = user.id
+
+        self.cache = MessageCardCache()
+        self.cache.max_size = 10
+
+    def tearDown(self):
+        db.session.rollback()
+        message_cards.clear()
+        return super().tearDown()
+
+    def messages(self):
+        return Message.query.order_by(Message.id).all()
+
+    def test_hit_and_miss(self):
+        """Is a card rendered once, kept through count changes, and
+        rendered again when its author edits their profile?"""
+
+        with app.app_context():
+            msg = self.messages()[0]
+
+            html = self.cache.render(msg)
+            self.assertIn("@author", html)
+            self.assertIn("warble 0", html)
+            self.assertEqual(self.cache.render(msg), html)
+
+            # A new follower bumps User.version, but not the card
+            User.adjust_counts(self.user_id, follower_count=1)
+            db.session.commit()
+            self.cache.render(self.messages()[0])
+
+            User.profile_changed(self.user_id)
+            db.session.commit()
+            self.cache.render(self.messages()[0])
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+
+    def test_eviction_and_invalidation(self):
+        """Are old cards evicted when full, and an author's dropped?"""
+
+        with app.app_context():
+            messages = self.messages()
+
+            self.cache.max_size = 2
+            for msg in messages:
+                self.cache.render(msg)
+
+            self.assertEqual(list(self.cache._entries),
+                             [msg.id for msg in messages[1:]])
+            self.assertEqual(self.cache._by_author[self.user_id],
+                             {msg.id for msg in messages[1:]})
+
+            self.cache.invalidate_author(self.user_id)
+            self.assertEqual(self.cache.stats()['size'], 0)
+            self.assertEqual(self.cache.stats()['authors'], 0)
+
+    def test_profile_edit_shows_on_cards(self):
+        """Do cards show an author's new name after they edit it?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.client.get(f"/users/{self.user_id}")
+
+        self.client.post("/users/profile",
+                         data={"username": "renamed",
+                               "email": "author@test.com",
+                               "password": "password"})
+
+        html = self.client.get(f"/users/{self.user_id}").get_data(as_text=True)
+        self.assertIn("@renamed", html)
+        self.assertNotIn("@author", html)
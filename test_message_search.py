@@ -0,0 +1,184 @@
+"""Message search tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_message_search.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, MessageTerm
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from message_search import SearchQuery, reindex_messages, search_messages
+from pagination import decode_cursor
+
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SearchQueryTestCase(TestCase):
+    """Test query parsing."""
+
+    def test_parse(self):
+        """Are words, prefixes and phrases pulled apart?"""
+
+        query = SearchQuery('Early "worm catcher" warb*')
+
+        self.assertEqual(query.terms, ["early", "worm", "catcher"])
+        self.assertEqual(query.prefixes, ["warb"])
+        self.assertEqual(query.phrases, [["worm", "catcher"]])
+
+        # Too short to be worth a prefix scan
+        query = SearchQuery("a* b*")
+        self.assertEqual((query.terms, query.prefixes), (["a", "b"], []))
+
+    def test_phrase_match(self):
+        """Do phrases have to appear word for word?"""
+
+        query = SearchQuery('"worm catcher"')
+
+        self.assertTrue(query.matches_phrases("The Worm, catcher!"))
+        self.assertFalse(query.matches_phrases("catcher of the worm"))
+
+
+class MessageSearchTestCase(TestCase):
+    """Test searching indexed messages."""
+
+    def setUp(self):
+        """Create test client, post some messages through the view."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        user = User.signup("searcher", "searcher@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        for text in ["The early bird catches the worm",
+                     "A worm is a bird's breakfast",
+                     "Warblers warble early"]:
+            self.client.post("/messages/new", data={"text": text})
+
+    def tearDown(self):
+        db.session.rollback()
+        return super().tearDown()
+
+    def search(self, query, **kwargs):
+        with app.app_context():
+            messages, next_cursor = search_messages(query, **kwargs)
+            return [msg.text for msg in messages], next_cursor
+
+    def test_words_are_anded(self):
+        """Must every word match?"""
+
+        texts, _ = self.search("worm bird")
+        self.assertEqual(texts, ["A worm is a bird's breakfast",
+                                 "The early bird catches the worm"])
+
+        texts, _ = self.search("early warblers")
+        self.assertEqual(texts, ["Warblers warble early"])
+
+    def test_phrase(self):
+        """Do quoted phrases only match in order?"""
+
+        texts, _ = self.search('"early bird"')
+        self.assertEqual(texts, ["The early bird catches the worm"])
+
+    def test_prefix(self):
+        """Do prefix* terms match every word starting with them?"""
+
+        texts, _ = self.search("warb*")
+        self.assertEqual(texts, ["Warblers warble early"])
+
+        texts, _ = self.search("cat* worm")
+        self.assertEqual(texts, ["The early bird catches the worm"])
+
+    def test_prefix_words_merged(self):
+        """Does a prefix page through the words it stands for newest first,
+        each message once?"""
+
+        # "warblers" and "warble" are both in one message
+        texts, _ = self.search("wa*")
+        self.assertEqual(texts, ["Warblers warble early"])
+
+        texts, cursor = self.search("bi*", limit=1)
+        self.assertEqual(texts, ["A worm is a bird's breakfast"])
+
+        texts, cursor = self.search("bi*", limit=1,
+                                    before=decode_cursor(cursor))
+        self.assertEqual(texts, ["The early bird catches the worm"])
+        self.assertIsNone(cursor)
+
+    def test_pagination(self):
+        """Does the cursor pick up where the last page left off?"""
+
+        texts, next_cursor = self.search("worm", limit=1)
+        self.assertEqual(texts, ["A worm is a bird's breakfast"])
+
+        texts, next_cursor = self.search(
+            "worm", before=decode_cursor(next_cursor), limit=1)
+
+        self.assertEqual(texts, ["The early bird catches the worm"])
+        self.assertIsNone(next_cursor)
+
+    def test_delete_unindexes(self):
+        """Does deleting a message drop it from the index?"""
+
+        msg = Message.query.filter(Message.text.like("Warblers%")).one()
+        self.client.post(f"/messages/{msg.id}/delete")
+
+        texts, _ = self.search("warblers")
+        self.assertEqual(texts, [])
+        self.assertEqual(
+            MessageTerm.query.filter_by(message_id=msg.id).count(), 0)
+
+    def test_reindex(self):
+        """Can the index be rebuilt from messages, live (dropping stale
+        terms too) and offline?"""
+
+        msg = Message.query.filter(Message.text.like("A worm%")).one()
+
+        MessageTerm.query.delete()
+        db.session.add(MessageTerm(term="stale", message_id=msg.id))
+        db.session.commit()
+
+        with app.app_context():
+            reindex_messages()
+
+        texts, _ = self.search("breakfast")
+        self.assertEqual(texts, ["A worm is a bird's breakfast"])
+        self.assertEqual(MessageTerm.query.filter_by(term="stale").count(), 0)
+
+        terms = sorted((t.term, t.message_id) for t in MessageTerm.query)
+
+        with app.app_context():
+            reindex_messages(offline=True)
+            db.session.commit()
+
+        self.assertEqual(sorted((t.term, t.message_id)
+                                for t in MessageTerm.query), terms)
+
+    def test_search_view(self):
+        """Does the search page and its JSON variant work?"""
+
+        resp = self.client.get("/messages/search?q=breakfast")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("bird&#39;s breakfast", resp.get_data(as_text=True))
+
+        resp = self.client.get("/messages/search?q=worm&format=json")
+        self.assertEqual(len(resp.get_json()['messages']), 2)
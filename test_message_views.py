@@ -16,7 +16,7 @@ from models import db, connect_db, Message, User
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, QueryBudgetExceeded
 
 
 db.create_all()
@@ -25,6 +25,12 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request that runs more SQL than its route's budget (app.py);
+# TESTING lets the exception reach the test instead of becoming a 500
+
+app.config['TESTING'] = True
+app.config['SQL_QUERY_BUDGET_ENFORCED'] = True
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -64,3 +70,159 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+
+    def test_message_counters(self):
+        """Do posting, liking and deleting keep the profile counts right?"""
+
+        liker = User.signup(username="liker",
+                            email="liker@test.com",
+                            password="password",
+                            image_url=None)
+        db.session.commit()
+        liker_id = liker.id
+        author_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post("/messages/new", data={"text": "Count me"})
+            msg_id = Message.query.one().id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+
+            c.post(f"/messages/{msg_id}/like")
+
+            # A second like (double click) is ignored
+            resp = c.post(f"/messages/{msg_id}/like")
+            self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(User.query.get(author_id).message_count, 1)
+            self.assertEqual(User.query.get(liker_id).like_count, 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post(f"/messages/{msg_id}/delete")
+
+            self.assertEqual(User.query.get(author_id).message_count, 0)
+            self.assertEqual(User.query.get(liker_id).like_count, 0)
+
+    def test_homepage_query_count_is_flat(self):
+        """Does the timeline cost the same number of queries for more
+        messages (no N+1 on msg.user)?"""
+
+        counts = []
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            for i in range(3):
+                author = User.signup(username=f"author{i}",
+                                     email=f"author{i}@test.com",
+                                     password="password",
+                                     image_url=None)
+                db.session.commit()
+                author_id = author.id
+
+                c.post(f"/users/follow/{author_id}")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = author_id
+
+                c.post("/messages/new", data={"text": f"From {i}"})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.get("/")
+                counts.append(int(resp.headers['X-SQL-Queries']))
+
+        self.assertEqual(len(set(counts)), 1)
+
+    def test_query_budget_enforced(self):
+        """Does going over a route's SQL budget fail loudly?"""
+
+        budgets = app.config['SQL_QUERY_BUDGETS']
+        budgets['homepage'], old_budget = 0, budgets['homepage']
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                with self.assertRaises(QueryBudgetExceeded):
+                    c.get("/")
+        finally:
+            budgets['homepage'] = old_budget
+
+    def test_like_state_is_the_viewers(self):
+        """Do like buttons show the viewer's likes, not the author's?"""
+
+        liker = User.signup(username="liker",
+                            email="liker@test.com",
+                            password="password",
+                            image_url=None)
+        db.session.commit()
+        liker_id = liker.id
+        author_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post("/messages/new", data={"text": "Like me"})
+            msg_id = Message.query.one().id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+
+            c.post(f"/messages/{msg_id}/like")
+
+            for path in [f"/users/{author_id}", f"/messages/{msg_id}"]:
+                html = c.get(path).get_data(as_text=True)
+                self.assertIn(f"/messages/{msg_id}/unlike", html)
+
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+
+            for path in [f"/users/{author_id}", f"/messages/{msg_id}"]:
+                html = c.get(path).get_data(as_text=True)
+                self.assertNotIn(f"/messages/{msg_id}/like", html)
+                self.assertNotIn(f"/messages/{msg_id}/unlike", html)
+
+    def test_like_json(self):
+        """Do the JSON like/unlike endpoints answer with the new state,
+        without rendering anything?"""
+
+        user_id = self.testuser.id
+        msg = Message(text="Like me", user_id=user_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        resp = self.client.post(f"/messages/{msg_id}/like?format=json")
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        for _ in range(2):
+            resp = self.client.post(f"/messages/{msg_id}/like?format=json")
+            self.assertEqual(resp.get_json(),
+                             {"message_id": msg_id, "liked": True})
+
+        self.assertLessEqual(int(resp.headers['X-SQL-Queries']), 4)
+        self.assertEqual(User.query.get(user_id).like_count, 1)
+
+        for _ in range(2):
+            resp = self.client.post(f"/messages/{msg_id}/unlike?format=json")
+            self.assertEqual(resp.get_json(),
+                             {"message_id": msg_id, "liked": False})
+
+        self.assertEqual(User.query.get(user_id).like_count, 0)
+
+        resp = self.client.post("/messages/0/like?format=json")
+        self.assertEqual(resp.status_code, 404)
@@ -0,0 +1,182 @@
+"""Schema migration and query plan check tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from message_search import search_messages
+from migrations import SchemaMigration, migrate, pending_migrations
+from query_plans import check_query_plans, route_queries, seq_scans
+
+
+db.create_all()
+
+
+class MigrationTestCase(TestCase):
+    """Test applying migrations."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        return super().tearDown()
+
+    def index_exists(self, name):
+        return db.session.execute(
+            "SELECT 1 FROM pg_indexes WHERE indexname = :name",
+            {'name': name}).scalar() is not None
+
+    def test_migrate_is_idempotent(self):
+        """Can migrations run on a create_all() database, and only once?"""
+
+        migrate(log=lambda message: None)
+
+        self.assertEqual(pending_migrations(), [])
+        self.assertEqual(migrate(log=lambda message: None), [])
+
+    def test_unique_likes(self):
+        """Are duplicate likes removed, counts fixed and the unique index
+        built?"""
+
+        user = User(username="liker", email="liker@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.flush()
+        msg = Message(text="like me", user_id=user.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        migrate(log=lambda message: None)
+
+        # Undo 0002 and make a mess for it to clean up
+        db.session.execute("DROP INDEX uq_likes_user_message")
+        SchemaMigration.query.filter_by(version='0002_unique_likes').delete()
+        db.session.add_all([Likes(user_id=user.id, message_id=msg.id)
+                            for _ in range(3)])
+        user.like_count = 3
+        db.session.commit()
+
+        self.assertEqual(migrate(log=lambda message: None),
+                         ['0002_unique_likes'])
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(User.query.get(user.id).like_count, 1)
+        self.assertTrue(self.index_exists('uq_likes_user_message'))
+
+
+# What the series added to the original schema
+BASELINE_DDL = [
+    "DROP TABLE timeline_entries, message_terms, recommendations, "
+    "account_purges, schema_migrations",
+    "DROP INDEX ix_messages_user_timestamp, ix_follows_following_followed, "
+    "uq_likes_user_message, ix_likes_message, ix_likes_user_id",
+    "ALTER TABLE users DROP COLUMN message_count, DROP COLUMN like_count, "
+    "DROP COLUMN following_count, DROP COLUMN follower_count, "
+    "DROP COLUMN version, DROP COLUMN updated_at, DROP COLUMN deleted_at, "
+    "DROP COLUMN profile_version",
+]
+
+
+class BaselineMigrationTestCase(TestCase):
+    """Test migrating a database from before any of the migrations."""
+
+    def setUp(self):
+        db.session.commit()
+        db.drop_all()
+        db.create_all()
+
+        for statement in BASELINE_DDL:
+            db.session.execute(statement)
+
+        # (The ORM models have columns these tables don't have yet)
+        for user_id in (1, 2):
+            db.session.execute(
+                "INSERT INTO users (id, email, username, password) "
+                "VALUES (:id, :email, :username, 'HASHED_PASSWORD')",
+                dict(id=user_id, email=f"user{user_id}@test.com",
+                     username=f"user{user_id}"))
+        db.session.execute(
+            "INSERT INTO messages (id, text, timestamp, user_id) "
+            "VALUES (1, 'hello warblers', '2020-01-01', 2)")
+        db.session.execute(
+            "INSERT INTO follows (user_following_id, user_being_followed_id) "
+            "VALUES (1, 2)")
+        # Liked twice (0002 removes the copy)
+        for _ in range(2):
+            db.session.execute(
+                "INSERT INTO likes (user_id, message_id) VALUES (1, 1)")
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        return super().tearDown()
+
+    def test_migrate_to_head(self):
+        """Do the migrations add the counters and derived tables, and fill
+        them in?"""
+
+        with app.app_context():
+            migrate(log=lambda message: None)
+            self.assertEqual(pending_migrations(), [])
+
+            follower, author = User.query.get(1), User.query.get(2)
+            self.assertEqual((follower.following_count, follower.like_count),
+                             (1, 1))
+            self.assertEqual((author.follower_count, author.message_count),
+                             (1, 1))
+            self.assertEqual(Likes.query.count(), 1)
+
+            self.assertEqual(
+                [(entry.user_id, entry.message_id)
+                 for entry in TimelineEntry.query], [(1, 1)])
+
+            messages, _ = search_messages("warblers")
+            self.assertEqual([msg.id for msg in messages], [1])
+
+
+class QueryPlanTestCase(TestCase):
+    """Test the sequential scan check."""
+
+    def test_seq_scans(self):
+        """Are only sequential scans of big tables reported?"""
+
+        plan = ["Nested Loop  (cost=0.71..17.36 rows=1 width=4)",
+                "  ->  Seq Scan on likes  (cost=0.00..1.01 rows=1)",
+                "  ->  Seq Scan on users  (cost=0.00..1.01 rows=1)",
+                "  ->  Index Scan using messages_pkey on messages"]
+        sizes = {'likes': 50000, 'users': 20, 'messages': 50000}
+
+        self.assertEqual(seq_scans(plan, sizes, 10000), ['likes'])
+
+    def test_records_ctes(self):
+        """Are queries that start with a CTE checked too?"""
+
+        queries = route_queries(app, ['/messages/search?q=bi*'], None)
+
+        self.assertTrue(any(statement.lstrip().startswith('WITH')
+                            for statement, _ in
+                            queries['/messages/search?q=bi*']))
+
+    def test_check_runs(self):
+        """Does the check get through every route on a tiny database?"""
+
+        # Everything is "small" here, so nothing should be reported
+        self.assertEqual(check_query_plans(app, min_rows=10 ** 9), [])
@@ -0,0 +1,142 @@
+"""Keyset pagination tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_pagination.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Likes
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from pagination import (PAGE_SIZE, InvalidCursor, decode_cursor,
+                        decode_id_cursor, encode_cursor, encode_id_cursor)
+
+
+db.create_all()
+
+
+class CursorTestCase(TestCase):
+    """Test cursor encoding."""
+
+    def test_round_trip(self):
+        """Does a cursor decode to what it was made from?"""
+
+        when = datetime(2020, 1, 2, 3, 4, 5, 678)
+        self.assertEqual(decode_cursor(encode_cursor(when, 42)), (when, 42))
+
+    def test_garbage_cursor(self):
+        """Are cursors we didn't make rejected?"""
+
+        with self.assertRaises(InvalidCursor):
+            decode_cursor("not-a-cursor")
+
+        with self.assertRaises(InvalidCursor):
+            decode_id_cursor("not-a-cursor")
+
+    def test_id_round_trip(self):
+        """Does an id cursor decode to its id?"""
+
+        self.assertEqual(decode_id_cursor(encode_id_cursor(42)), 42)
+
+
+class MessagePaginationTestCase(TestCase):
+    """Test paging through message lists."""
+
+    def setUp(self):
+        """Create test client, add one more message than fits on a page."""
+
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        user = User.signup("pager", "pager@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        # Same timestamp on a couple of rows makes sure ties break on id
+        start = datetime(2020, 1, 1)
+        db.session.bulk_insert_mappings(Message, [
+            dict(text=f"msg {i}",
+                 timestamp=start + timedelta(minutes=i // 2),
+                 user_id=user.id)
+            for i in range(PAGE_SIZE + 1)
+        ])
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        db.session.rollback()
+        return super().tearDown()
+
+    def test_pages_cover_every_message_once(self):
+        """Do the first page and its next page cover everything, in order?"""
+
+        resp = self.client.get(f"/users/{self.user_id}?format=json")
+        first = resp.get_json()
+
+        self.assertEqual(len(first['messages']), PAGE_SIZE)
+        self.assertIsNotNone(first['next'])
+
+        resp = self.client.get(
+            f"/users/{self.user_id}?format=json&before={first['next']}")
+        second = resp.get_json()
+
+        self.assertEqual(len(second['messages']), 1)
+        self.assertIsNone(second['next'])
+
+        ids = [m['id'] for m in first['messages'] + second['messages']]
+        self.assertEqual(len(set(ids)), PAGE_SIZE + 1)
+        self.assertEqual(second['messages'][0]['text'], "msg 0")
+
+    def test_load_older_link(self):
+        """Does the HTML page link to the next page?"""
+
+        resp = self.client.get(f"/users/{self.user_id}")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Load older", html)
+
+    def test_bad_cursor(self):
+        """Is a mangled cursor a 400 rather than a 500?"""
+
+        resp = self.client.get(f"/users/{self.user_id}?before=nope")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_likes_pages_by_like(self):
+        """Are likes paged most recently liked first, by like id?"""
+
+        # Liked oldest message last, so like order isn't message order
+        messages = Message.query.order_by(Message.id.desc()).all()
+        db.session.add_all([Likes(user_id=self.user_id, message_id=msg.id)
+                            for msg in messages])
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.user_id}/likes?format=json")
+        first = resp.get_json()
+
+        self.assertEqual(len(first['messages']), PAGE_SIZE)
+        self.assertEqual(first['messages'][0]['text'], "msg 0")
+
+        resp = self.client.get(
+            f"/users/{self.user_id}/likes?format=json&before={first['next']}")
+        second = resp.get_json()
+
+        self.assertEqual([m['id'] for m in second['messages']],
+                         [messages[0].id])
+        self.assertIsNone(second['next'])
+
+        resp = self.client.get(f"/users/{self.user_id}/likes?before=nope")
+        self.assertEqual(resp.status_code, 400)
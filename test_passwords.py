@@ -0,0 +1,219 @@
+"""Password pool tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_passwords.py
+
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from flask import Flask
+
+from models import db, User, Message, Follows
+from passwords import PasswordPool, PasswordPoolFull, bcrypt, password_pool
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def make_pool(**config):
+    """A fresh pool configured from `config`."""
+
+    pool_app = Flask(__name__)
+    pool_app.config.update(config)
+
+    return PasswordPool(pool_app)
+
+
+class PasswordPoolTestCase(TestCase):
+    """Test hashing on the bounded pool."""
+
+    def setUp(self):
+        self.pool = make_pool(BCRYPT_LOG_ROUNDS=4)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_hash_and_check(self):
+        """Does a hash check against its password and nothing else?"""
+
+        hashed = self.pool.hash("password")
+
+        self.assertTrue(hashed.startswith("$2b$04$"))
+        self.assertTrue(self.pool.check(hashed, "password"))
+        self.assertFalse(self.pool.check(hashed, "wrong"))
+        self.assertEqual(self.pool.stats()['completed'], 3)
+        self.assertEqual(self.pool.stats()['pending'], 0)
+
+    def test_needs_rehash(self):
+        """Are hashes with a different cost flagged?"""
+
+        self.assertFalse(self.pool.needs_rehash(self.pool.hash("password")))
+        self.assertTrue(self.pool.needs_rehash(
+            bcrypt.generate_password_hash("password", 5).decode('UTF-8')))
+        self.assertTrue(self.pool.needs_rehash("not a hash"))
+
+    def test_full_pool_rejects(self):
+        """Past the pending cap, do new jobs fail fast?"""
+
+        pool = make_pool(BCRYPT_LOG_ROUNDS=4,
+                         PASSWORD_HASH_WORKERS=1,
+                         PASSWORD_HASH_MAX_PENDING=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        worker = threading.Thread(target=pool._run, args=(block,))
+        worker.start()
+        started.wait(5)
+
+        try:
+            with self.assertRaises(PasswordPoolFull):
+                pool.hash("password")
+            self.assertEqual(pool.stats()['rejected'], 1)
+            self.assertEqual(pool.stats()['pending'], 1)
+        finally:
+            release.set()
+            worker.join()
+            pool.shutdown()
+
+
+    def test_cap_leaves_request_threads(self):
+        """Is the default cap kept below the request thread count?"""
+
+        pool = make_pool(REQUEST_THREADS=8, PASSWORD_HASH_WORKERS=16)
+        self.assertEqual(pool.max_pending, 6)
+
+        pool = make_pool(REQUEST_THREADS=2)
+        self.assertEqual(pool.max_pending, 1)
+
+
+class LoginBurstTestCase(TestCase):
+    """Test that a burst of logins leaves request threads for cheap
+    routes."""
+
+    THREADS = 4
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        db.session.add(User(username="burst",
+                            email="burst@test.com",
+                            password=bcrypt.generate_password_hash(
+                                "password", 4).decode('UTF-8')))
+        db.session.commit()
+
+        self.config = dict(app.config)
+        app.config.update(REQUEST_THREADS=self.THREADS,
+                          PASSWORD_HASH_WORKERS=2)
+        app.config.pop('PASSWORD_HASH_MAX_PENDING', None)
+        password_pool.init_app(app)
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config.clear()
+        app.config.update(self.config)
+        password_pool.init_app(app)
+        return super().tearDown()
+
+    def test_cheap_route_still_answers(self):
+        """With bcrypt stuck, do extra logins fail fast and the login page
+        still get a thread?"""
+
+        release = threading.Event()
+        started = threading.Barrier(3)
+
+        def stuck():
+            started.wait(5)
+            release.wait(10)
+
+        # Both bcrypt workers are busy for as long as we like
+        blockers = [threading.Thread(target=password_pool._run,
+                                     args=(stuck,))
+                    for _ in range(2)]
+        for blocker in blockers:
+            blocker.start()
+        started.wait(5)
+
+        def login():
+            return app.test_client().post(
+                "/login", data={"username": "burst", "password": "password"}
+            ).status_code
+
+        def login_page():
+            return app.test_client().get("/login").status_code
+
+        # One executor thread per request thread
+        requests = ThreadPoolExecutor(max_workers=self.THREADS)
+
+        try:
+            logins = [requests.submit(login)
+                      for _ in range(self.THREADS * 2)]
+
+            begun = time.perf_counter()
+            self.assertEqual(requests.submit(login_page).result(timeout=5),
+                             200)
+            self.assertLess(time.perf_counter() - begun, 2)
+
+            release.set()
+            statuses = [future.result(timeout=10) for future in logins]
+            self.assertIn(503, statuses)
+
+        finally:
+            release.set()
+            for blocker in blockers:
+                blocker.join()
+            requests.shutdown()
+
+
+class RehashOnLoginTestCase(TestCase):
+    """Test that old hashes are upgraded at login."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        old_hash = bcrypt.generate_password_hash("password", 4)
+        db.session.add(User(username="oldhash",
+                            email="oldhash@test.com",
+                            password=old_hash.decode('UTF-8')))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        return super().tearDown()
+
+    def test_login_rehashes(self):
+        """Does logging in re-hash the password with the current cost?"""
+
+        resp = self.client.post("/login", data={"username": "oldhash",
+                                                "password": "password"})
+        self.assertEqual(resp.status_code, 302)
+
+        db.session.expire_all()
+        user = User.query.filter_by(username="oldhash").one()
+        rounds = app.config['BCRYPT_LOG_ROUNDS']
+
+        self.assertTrue(user.password.startswith(f"$2b${rounds:02d}$"))
+        self.assertTrue(User.authenticate("oldhash", "password"))
@@ -0,0 +1,124 @@
+"""'Who to follow' recommendation tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase, skipIf
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from recommendations import (Recommendation, build_recommendations,
+                             recommended_users, sparse)
+
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+@skipIf(sparse is None, "needs numpy and scipy")
+class RecommendationsTestCase(TestCase):
+    """Test the batch job and the home page sidebar."""
+
+    def setUp(self):
+        Recommendation.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password",
+                             None)
+                 for i in range(5)]
+        db.session.flush()
+        self.ids = [user.id for user in users]
+
+        # a follows b and c; both follow d, b also follows e. e and a like
+        # the same message.
+        a, b, c, d, e = self.ids
+        for follower_id, followed_id in ((a, b), (a, c), (b, d), (c, d),
+                                         (b, e)):
+            db.session.add(Follows(user_following_id=follower_id,
+                                   user_being_followed_id=followed_id))
+
+        msg = Message(text="warble", user_id=c)
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add_all([Likes(user_id=a, message_id=msg.id),
+                            Likes(user_id=e, message_id=msg.id)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        return super().tearDown()
+
+    def build(self, **kwargs):
+        return build_recommendations(log=lambda msg: None, **kwargs)
+
+    def test_scores(self):
+        """Are friends of friends and co-likers ranked, and followees and
+        the user themselves left out?"""
+
+        a, b, c, d, e = self.ids
+
+        self.build(chunk_size=2)
+
+        # d: followed by both of a's followees (2); e: one followee (1)
+        # plus a co-liked message (0.5)
+        self.assertEqual([(r.candidate_id, r.score) for r in
+                          Recommendation.query.filter_by(user_id=a)
+                          .order_by(Recommendation.rank)],
+                         [(d, 2.0), (e, 1.5)])
+
+        # e only gets a back, through the like
+        self.assertEqual([u.id for u in recommended_users(e)], [a])
+
+        # Rebuilding replaces rows rather than adding to them
+        saved = self.build(top_n=1)
+        self.assertEqual(Recommendation.query.count(), saved)
+        self.assertEqual([u.id for u in recommended_users(a)], [d])
+
+    def test_deleted_users(self):
+        """Are deleted accounts never suggested?"""
+
+        a, b, c, d, e = self.ids
+
+        self.build()
+        User.mark_deleted(d)
+        db.session.commit()
+
+        # Hidden from the sidebar at once...
+        self.assertEqual([u.id for u in recommended_users(a)], [e])
+
+        # ...and not scored next time
+        self.build()
+        self.assertEqual(
+            Recommendation.query.filter_by(candidate_id=d).count(), 0)
+
+    def test_sidebar(self):
+        """Does the home page list suggestions, and drop one when it's
+        followed?"""
+
+        a, b, c, d, e = self.ids
+        self.build()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = a
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("Who to follow", html)
+        self.assertIn("@user3", html)
+
+        self.client.post(f"/users/follow/{d}")
+
+        self.assertEqual([u.id for u in recommended_users(a)], [e])
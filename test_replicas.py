@@ -0,0 +1,120 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_replicas.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import g
+
+from models import db, add_replicas, User, Message, Follows
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, PRIMARY_UNTIL_KEY
+
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaTestCase(TestCase):
+    """Test sending reads to a replica.
+
+    The "replica" is a separate SQLite database, so we can tell which
+    database answered by what's in it.
+    """
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        db.session.commit()
+
+        fd, self.replica_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+        add_replicas(app, [f'sqlite:///{self.replica_path}'])
+        self.bind = app.config['SQLALCHEMY_REPLICA_BINDS'][-1]
+        self.replica = db.get_engine(app, bind=self.bind)
+        db.Model.metadata.create_all(self.replica)
+
+        # Only on the replica
+        self.replica.execute(User.__table__.insert(),
+                             id=424242, username="on_replica",
+                             email="replica@test.com",
+                             password="HASHED_PASSWORD")
+
+        db.session.remove()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+
+        app.config['SQLALCHEMY_REPLICA_BINDS'].remove(self.bind)
+        del app.config['SQLALCHEMY_BINDS'][self.bind]
+        self.replica.dispose()
+        os.remove(self.replica_path)
+
+        return super().tearDown()
+
+    def test_reads_from_replica(self):
+        """Do listed GET routes read from the replica, and others not?"""
+
+        resp = self.client.get("/users/424242")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@on_replica", resp.get_data(as_text=True))
+        self.assertIn(f"{self.bind}=", resp.headers['X-SQL-Engines'])
+
+        endpoints = app.config['REPLICA_READ_ENDPOINTS']
+        app.config['REPLICA_READ_ENDPOINTS'] = endpoints - {'users_show'}
+
+        try:
+            resp = self.client.get("/users/424242")
+        finally:
+            app.config['REPLICA_READ_ENDPOINTS'] = endpoints
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertNotIn(self.bind, resp.headers['X-SQL-Engines'])
+
+    def test_read_your_writes(self):
+        """After a write, are reads pinned to the primary for a while?"""
+
+        self.client.post("/login", data={"username": "nobody",
+                                          "password": "password"})
+
+        resp = self.client.get("/users/424242")
+        self.assertEqual(resp.status_code, 404)
+        self.assertNotIn(self.bind, resp.headers['X-SQL-Engines'])
+
+        with self.client.session_transaction() as sess:
+            sess[PRIMARY_UNTIL_KEY] = 0
+
+        self.assertEqual(self.client.get("/users/424242").status_code, 200)
+
+    def test_writes_go_to_primary(self):
+        """Do flushes go to the primary, and later reads follow them?"""
+
+        with app.test_request_context():
+            g.db_replica = self.bind
+
+            self.assertEqual(User.query.count(), 1)
+
+            db.session.add(User(username="on_primary",
+                                email="primary@test.com",
+                                password="HASHED_PASSWORD"))
+            db.session.flush()
+
+            self.assertEqual(
+                [u.username for u in User.query.order_by(User.username)],
+                ["on_primary"])
+
+            db.session.rollback()
@@ -0,0 +1,134 @@
+"""User search tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_search.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import search
+from search import SEARCH_MAX_PAGES, SEARCH_PAGE_SIZE, search_users
+
+
+db.create_all()
+
+
+class UserSearchTestCase(TestCase):
+    """Test ranked user search."""
+
+    def setUp(self):
+        """Create test client, add sample users."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        for username, bio, location in [
+                ("birdwatcher", "I like birds", "Paris"),
+                ("coder", "tabs over spaces", "Berlin"),
+                ("traveller", "bird songs", "Lima")]:
+            db.session.add(User(username=username,
+                                email=f"{username}@test.com",
+                                password="HASHED_PASSWORD",
+                                bio=bio,
+                                location=location))
+
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        return super().tearDown()
+
+    def test_search_bio_and_location(self):
+        """Are bio and location searched, not just username?"""
+
+        with app.app_context():
+            users, has_more = search_users("bird")
+            self.assertIn("traveller", [u.username for u in users])
+            self.assertNotIn("coder", [u.username for u in users])
+            self.assertFalse(has_more)
+
+            users, has_more = search_users("Berlin")
+            self.assertEqual([u.username for u in users], ["coder"])
+
+    def test_exact_username_survives_limit(self):
+        """Does an exact username hit make it past the candidate limit
+        when lots of others match too?"""
+
+        for i in range(5):
+            db.session.add(User(username=f"fan{i}",
+                                email=f"fan{i}@test.com",
+                                password="HASHED_PASSWORD",
+                                bio="bird bird bird"))
+        db.session.add(User(username="bird", email="bird@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        limit = search.SEARCH_CANDIDATE_LIMIT
+        search.SEARCH_CANDIDATE_LIMIT = 2
+        try:
+            users, _ = search_users("bird")
+        finally:
+            search.SEARCH_CANDIDATE_LIMIT = limit
+
+        self.assertEqual(users[0].username, "bird")
+
+    def test_no_match(self):
+        """Does a search with no matches come back empty?"""
+
+        with app.app_context():
+            self.assertEqual(search_users("nobody"), ([], False))
+
+    def test_pages_are_capped(self):
+        """Do result pages stop at the hard limit?"""
+
+        db.session.add_all([User(username=f"many{i}",
+                                 email=f"many{i}@test.com",
+                                 password="HASHED_PASSWORD",
+                                 location="Oslo")
+                            for i in range(SEARCH_PAGE_SIZE + 1)])
+        db.session.commit()
+
+        with app.app_context():
+            users, has_more = search_users("Oslo")
+            self.assertEqual(len(users), SEARCH_PAGE_SIZE)
+            self.assertTrue(has_more)
+
+            users, has_more = search_users("Oslo", page=2)
+            self.assertEqual(len(users), 1)
+            self.assertFalse(has_more)
+
+            users, has_more = search_users("Oslo", page=SEARCH_MAX_PAGES + 5)
+            self.assertEqual(users, [])
+
+    def test_search_view(self):
+        """Does /users?q= render the ranked results?"""
+
+        resp = self.client.get("/users?q=Lima")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@traveller", html)
+        self.assertNotIn("@coder", html)
+
+    def test_browse_without_query(self):
+        """Does /users without a query page through everyone?"""
+
+        resp = self.client.get("/users")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@coder", html)
+        self.assertNotIn("More users", html)
@@ -0,0 +1,307 @@
+"""Home timeline tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_timelines.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows, TimelineEntry
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from pagination import PAGE_SIZE, page
+import timelines
+from timelines import home_timeline, rebuild_all_timelines, rebuild_timeline
+
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out-on-write timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        TimelineEntry.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+        self.client.post(f"/users/follow/{self.author_id}")
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config.pop('TIMELINE_FANOUT_LIMIT', None)
+        app.config.pop('TIMELINE_ENGINE', None)
+        return super().tearDown()
+
+    def post_as_author(self, text):
+        """Post a message through the view, logged in as the author."""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+
+        self.client.post("/messages/new", data={"text": text})
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def test_post_fans_out(self):
+        """Does posting write to followers' timelines?"""
+
+        self.post_as_author("fanned out")
+
+        entries = TimelineEntry.query.filter_by(user_id=self.reader_id).all()
+        self.assertEqual(len(entries), 1)
+
+        resp = self.client.get("/")
+        self.assertIn("fanned out", resp.get_data(as_text=True))
+
+    def test_unfollow_removes_entries(self):
+        """Does unfollowing drop the author's messages from the timeline?"""
+
+        self.post_as_author("soon gone")
+        self.client.post(f"/users/stop-following/{self.author_id}")
+
+        with app.app_context():
+            self.assertEqual(home_timeline(self.reader_id), [])
+
+    def test_exempt_author_merged_at_read(self):
+        """Are messages from very popular authors merged at read time?"""
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 0
+
+        self.post_as_author("too popular")
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.reader_id).count(), 0)
+        with app.app_context():
+            timeline = home_timeline(self.reader_id)
+
+        self.assertEqual([m.text for m in timeline], ["too popular"])
+
+    def test_back_under_limit(self):
+        """Do messages posted while an author was exempt stay in timelines
+        once unfollows bring them back under the limit?"""
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+
+        fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.commit()
+        fan_id = fan.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = fan_id
+        self.client.post(f"/users/follow/{self.author_id}")
+
+        self.post_as_author("posted while exempt")
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.reader_id).count(), 0)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = fan_id
+        self.client.post(f"/users/stop-following/{self.author_id}")
+
+        with app.app_context():
+            timeline = home_timeline(self.reader_id)
+
+        self.assertEqual([m.text for m in timeline], ["posted while exempt"])
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.reader_id).count(), 1)
+
+    def test_backfills_bounded(self):
+        """Do follows and restored authors copy only their newest
+        TIMELINE_LENGTH messages?"""
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+
+        fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.commit()
+        fan_id = fan.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = fan_id
+        self.client.post(f"/users/follow/{self.author_id}")
+
+        for i in range(3):
+            self.post_as_author(f"exempt {i}")
+
+        with patch.object(timelines, 'TIMELINE_LENGTH', 2):
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = fan_id
+            self.client.post(f"/users/stop-following/{self.author_id}")
+
+            # Room for the fan to follow again without going over
+            app.config['TIMELINE_FANOUT_LIMIT'] = 2
+            self.client.post(f"/users/follow/{self.author_id}")
+
+        for user_id in (self.reader_id, fan_id):
+            self.assertEqual(
+                sorted(entry.message_id for entry in
+                       TimelineEntry.query.filter_by(user_id=user_id)),
+                sorted(msg.id for msg in
+                       Message.query.filter_by(user_id=self.author_id)
+                       .order_by(Message.timestamp.desc()).limit(2)))
+
+    def test_rebuild_timeline(self):
+        """Can a timeline be recreated from messages and follows?"""
+
+        self.post_as_author("first")
+        self.post_as_author("second")
+
+        TimelineEntry.query.delete()
+
+        with app.app_context():
+            rebuild_timeline(self.reader_id)
+            db.session.commit()
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.reader_id).count(), 2)
+
+    def test_rebuild_all_timelines(self):
+        """Do the live and offline rebuilds both fix missing and stale
+        entries?"""
+
+        self.post_as_author("kept")
+        self.post_as_author("lost")
+
+        kept, lost = (Message.query.filter_by(text=text).one().id
+                      for text in ("kept", "lost"))
+
+        # One entry gone, and one for an author the reader doesn't follow
+        TimelineEntry.query.filter_by(message_id=lost).delete()
+        db.session.add(TimelineEntry(user_id=self.author_id,
+                                     message_id=kept,
+                                     author_id=self.author_id,
+                                     timestamp=datetime(2020, 1, 1)))
+        db.session.commit()
+
+        expected = sorted([(self.reader_id, kept), (self.reader_id, lost)])
+
+        with app.app_context():
+            # A batch per user
+            with patch.object(timelines, 'REBUILD_CHUNK_USERS', 1):
+                rebuild_all_timelines()
+
+            self.assertEqual(sorted((entry.user_id, entry.message_id)
+                                    for entry in TimelineEntry.query),
+                             expected)
+
+            rebuild_all_timelines(offline=True)
+            db.session.commit()
+
+            self.assertEqual(sorted((entry.user_id, entry.message_id)
+                                    for entry in TimelineEntry.query),
+                             expected)
+
+    def test_engines_agree(self):
+        """Do the query and merge engines page through the same timeline
+        as the precomputed one?"""
+
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        other_id = other.id
+
+        self.client.post(f"/users/follow/{other_id}")
+
+        # Mostly one author, so the merge engine has to go back for more
+        for i in range(7):
+            self.post_as_author(f"author {i}")
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = other_id
+        self.client.post("/messages/new", data={"text": "other"})
+
+        def pages(engine):
+            app.config['TIMELINE_ENGINE'] = engine
+            ids, cursor = [], None
+
+            with app.app_context():
+                while True:
+                    messages, cursor = page(home_timeline(self.reader_id,
+                                                          before=cursor,
+                                                          limit=4), 3)
+                    ids.append([msg.id for msg in messages])
+                    if cursor is None:
+                        return ids
+                    cursor = (messages[-1].timestamp, messages[-1].id)
+
+        fanout = pages('fanout')
+
+        self.assertEqual([len(ids) for ids in fanout], [3, 3, 2])
+        self.assertEqual(pages('query'), fanout)
+        self.assertEqual(pages('merge'), fanout)
+
+    def test_merge_refills_in_one_query(self):
+        """Does the home page stay within its query budget when several
+        followees' batches all come back for more?"""
+
+        authors = [User.signup(f"prolific{i}", f"prolific{i}@test.com",
+                               "password", None)
+                   for i in range(4)]
+        db.session.commit()
+        author_ids = [author.id for author in authors]
+
+        for author_id in author_ids:
+            self.client.post(f"/users/follow/{author_id}")
+
+        # Following plenty of quiet accounts too keeps each batch small
+        quiet = [User(username=f"quiet{i}", email=f"quiet{i}@test.com",
+                      password="HASHED_PASSWORD")
+                 for i in range(50)]
+        db.session.add_all(quiet)
+        db.session.flush()
+        db.session.add_all([Follows(user_following_id=self.reader_id,
+                                    user_being_followed_id=user.id)
+                            for user in quiet])
+        User.reconcile_counts([self.reader_id])
+
+        # Interleaved, so each of them fills its whole batch in the first
+        # round and has more that belong on the page
+        start = datetime(2020, 1, 1)
+        db.session.add_all([
+            Message(text=f"warble {n}", user_id=author_ids[n % 4],
+                    timestamp=start + timedelta(minutes=n))
+            for n in range(4 * PAGE_SIZE)])
+        db.session.commit()
+
+        with app.app_context():
+            rebuild_timeline(self.reader_id)
+            db.session.commit()
+
+        def homepage(engine):
+            app.config['TIMELINE_ENGINE'] = engine
+            resp = self.client.get("/?format=json")
+            return (resp.get_json()['messages'],
+                    int(resp.headers['X-SQL-Queries']))
+
+        fanout, _ = homepage('fanout')
+        merged, queries = homepage('merge')
+
+        self.assertEqual(len(merged), PAGE_SIZE)
+        self.assertEqual(merged, fanout)
+        self.assertLessEqual(queries,
+                             app.config['SQL_QUERY_BUDGETS']['homepage'])
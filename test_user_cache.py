@@ -0,0 +1,113 @@
+"""Current-user cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_user_cache.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, we need to set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from user_cache import UserCache
+
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class UserCacheTestCase(TestCase):
+    """Test caching the logged-in user."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        user = User.signup("cached", "cached@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.cache = UserCache()
+        self.cache.init_app(app)
+
+    def tearDown(self):
+        db.session.rollback()
+        return super().tearDown()
+
+    def test_hit_and_miss(self):
+        """Is the second lookup served from the cache?"""
+
+        with app.app_context():
+            self.assertEqual(self.cache.get(self.user_id).username, "cached")
+            self.assertEqual(self.cache.get(self.user_id).username, "cached")
+            self.assertIsNone(self.cache.get(-1))
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_lazy_model(self):
+        """Are uncached attributes read from the full user?"""
+
+        with app.app_context():
+            self.cache.get(self.user_id)
+            current = self.cache.get(self.user_id)
+
+            self.assertIsNone(current._model)
+            self.assertFalse(current.is_following(current))
+            self.assertEqual(current.following_ids_among([self.user_id]),
+                             set())
+            self.assertIsNone(current._model)
+
+            self.assertEqual(current.email, "cached@test.com")
+            self.assertEqual(current.model.id, self.user_id)
+
+            with self.assertRaises(AttributeError):
+                current.bio = "read only"
+
+    def test_expiry_and_eviction(self):
+        """Are entries dropped after their TTL or when the cache is full?"""
+
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+
+        with app.app_context():
+            self.cache.ttl = 0
+            self.cache.get(self.user_id)
+            self.cache.get(self.user_id)
+            self.assertEqual(self.cache.stats()['hits'], 0)
+
+            self.cache.ttl = 60
+            self.cache.max_size = 1
+            self.cache.get(self.user_id)
+            self.cache.get(other.id)
+            self.assertEqual(self.cache.stats()['size'], 1)
+            self.assertIn(other.id, self.cache._entries)
+
+    def test_profile_edit_invalidates(self):
+        """Does editing your profile show up on the next request?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.client.get("/users/profile")
+
+        resp = self.client.post("/users/profile",
+                                data={"username": "renamed",
+                                      "email": "cached@test.com",
+                                      "bio": "new bio",
+                                      "password": "password"})
+        self.assertEqual(resp.status_code, 302)
+
+        resp = self.client.get("/")
+        self.assertIn("@renamed", resp.get_data(as_text=True))
@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 from sqlalchemy import exc
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
 
 # BEFORE we import our app, we need to set an environmental variable
 # to use a different database for tests
@@ -130,3 +130,64 @@ class UserModelTestCase(TestCase):
         self.assertEqual(res2, False)
 
 
+
+    def test_reconcile_counts(self):
+        """ tests that drifted profile counters get recomputed"""
+
+        test_user1 = User.query.get(self.user1_id)
+        test_user2 = User.query.get(self.user2_id)
+
+        # Appending straight to the relationship skips the counters
+        test_user1.following.append(test_user2)
+        db.session.add(Message(text="uncounted", user_id=self.user1_id))
+        db.session.commit()
+
+        fixed = User.reconcile_counts()
+        db.session.commit()
+
+        self.assertEqual(sorted(fixed), sorted([self.user1_id, self.user2_id]))
+
+        test_user1 = User.query.get(self.user1_id)
+        test_user2 = User.query.get(self.user2_id)
+
+        self.assertEqual(test_user1.message_count, 1)
+        self.assertEqual(test_user1.following_count, 1)
+        self.assertEqual(test_user2.follower_count, 1)
+        self.assertEqual(User.reconcile_counts(), [])
+
+    def test_following_ids_among(self):
+        """ tests the one-query follow-state lookup for a page of users"""
+
+        test_user1 = User.query.get(self.user1_id)
+        test_user2 = User.query.get(self.user2_id)
+
+        test_user1.following.append(test_user2)
+        db.session.commit()
+
+        self.assertTrue(test_user1.is_following(test_user2))
+        self.assertFalse(test_user2.is_following(test_user1))
+        self.assertTrue(test_user2.is_followed_by(test_user1))
+
+        self.assertEqual(
+            test_user1.following_ids_among([self.user1_id, self.user2_id]),
+            {self.user2_id})
+        self.assertEqual(test_user2.following_ids_among([self.user1_id]), set())
+        self.assertEqual(test_user1.following_ids_among([]), set())
+
+    def test_liked_ids_among(self):
+        """ tests the one-query liked-state lookup for a page of messages"""
+
+        msgs = [Message(text=f"msg {i}", user_id=self.user2_id)
+                for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.user1_id, message_id=msgs[1].id))
+        db.session.commit()
+
+        test_user1 = User.query.get(self.user1_id)
+        page_ids = [msg.id for msg in msgs]
+
+        self.assertEqual(test_user1.liked_ids_among(page_ids), {msgs[1].id})
+        self.assertEqual(test_user1.liked_ids_among([msgs[0].id]), set())
+        self.assertEqual(test_user1.liked_ids_among([]), set())
@@ -6,10 +6,12 @@
 
 
 import os
+import re
+from datetime import datetime
 from unittest import TestCase
 from flask import session
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Follows
 
 # BEFORE we import our app, we need to set an environmental variable
 # to use a different database for tests
@@ -25,6 +27,12 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request that runs more SQL than its route's budget (app.py);
+# TESTING lets the exception reach the test instead of becoming a 500
+
+app.config['TESTING'] = True
+app.config['SQL_QUERY_BUDGET_ENFORCED'] = True
+
 
 class UserViewTestCase(TestCase):
     """Test views for Users."""
@@ -140,3 +148,178 @@ class UserViewTestCase(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(user1.messages[0].text, "here's a test")
 
+
+    def test_conditional_get(self):
+
+        """is an unchanged profile answered with a 304, and a changed one
+        rendered again?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user1id
+
+        resp = self.client.get(f"/users/{self.user2id}")
+        etag = resp.headers['ETag']
+
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get(f"/users/{self.user2id}",
+                               headers={'If-None-Match': etag})
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.get_data(), b"")
+        self.assertLessEqual(int(resp.headers['X-SQL-Queries']), 1)
+
+        # Following user2 changes both users' counts
+        self.client.post(f"/users/follow/{self.user2id}")
+
+        resp = self.client.get(f"/users/{self.user2id}",
+                               headers={'If-None-Match': etag})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        etag = resp.headers['ETag']
+
+        # Someone else sees a different page (their own follow buttons)
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user2id
+
+        resp = self.client.get(f"/users/{self.user2id}",
+                               headers={'If-None-Match': etag})
+
+        self.assertEqual(resp.status_code, 200)
+
+    def test_if_modified_since(self):
+
+        """is Last-Modified rounded up, left off until its second is over,
+        and ignored when there's an ETag to go by?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user1id
+
+        # Both users last changed just now
+        resp = self.client.get(f"/users/{self.user2id}")
+        self.assertNotIn('Last-Modified', resp.headers)
+
+        User.query.update({User.updated_at: datetime(2020, 1, 1, 12, 0, 0,
+                                                     500000)})
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.user2id}")
+        last_modified = resp.headers['Last-Modified']
+        self.assertEqual(last_modified, "Wed, 01 Jan 2020 12:00:01 GMT")
+
+        resp = self.client.get(f"/users/{self.user2id}",
+                               headers={'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, 304)
+
+        # A stale ETag wins over a current date
+        resp = self.client.get(f"/users/{self.user2id}",
+                               headers={'If-Modified-Since': last_modified,
+                                        'If-None-Match': '"stale"'})
+        self.assertEqual(resp.status_code, 200)
+
+        # A change later in the same second as the client's copy
+        User.query.filter_by(id=self.user2id).update(
+            {User.updated_at: datetime(2020, 1, 1, 12, 0, 0, 900000),
+             User.version: User.version + 1})
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.user2id}",
+                               headers={'If-Modified-Since':
+                                        "Wed, 01 Jan 2020 12:00:00 GMT"})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_likes_page_shows_owner(self):
+
+        """does someone else's likes page show their profile, not the
+        viewer's?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user1id
+
+        resp = self.client.get(f"/users/{self.user2id}/likes")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('<h4 id="sidebar-username">@testuser2</h4>', html)
+        self.assertLessEqual(int(resp.headers['X-SQL-Queries']),
+                             app.config['SQL_QUERY_BUDGETS']['likes_page'])
+
+    def test_follow_json(self):
+
+        """do the JSON follow/unfollow endpoints answer with the new state
+        and keep the counts right?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user1id
+
+        for _ in range(2):
+            resp = self.client.post(f"/users/follow/{self.user2id}?format=json")
+            self.assertEqual(resp.get_json(),
+                             {"user_id": self.user2id, "following": True})
+
+        self.assertEqual(User.query.get(self.user1id).following_count, 1)
+        self.assertEqual(User.query.get(self.user2id).follower_count, 1)
+
+        for _ in range(2):
+            resp = self.client.post(
+                f"/users/stop-following/{self.user2id}?format=json")
+            self.assertEqual(resp.get_json(),
+                             {"user_id": self.user2id, "following": False})
+
+        self.assertEqual(User.query.get(self.user1id).following_count, 0)
+        self.assertEqual(User.query.get(self.user2id).follower_count, 0)
+
+        resp = self.client.post("/users/follow/0?format=json")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_follow_pages_paginate(self):
+
+        """are following/followers pages keyset-paged, streamed or not?"""
+
+        fans = [User.signup(f"fan{i}", f"fan{i}@test.com", "password", None)
+                for i in range(5)]
+        db.session.flush()
+        fan_ids = sorted(fan.id for fan in fans)
+
+        for fan_id in fan_ids:
+            db.session.add(Follows(user_following_id=fan_id,
+                                   user_being_followed_id=self.user1id))
+            db.session.add(Follows(user_following_id=self.user1id,
+                                   user_being_followed_id=fan_id))
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user2id
+
+        app.config['FOLLOW_PAGE_SIZE'] = 2
+
+        try:
+            for stream in (False, True):
+                app.config['STREAM_FOLLOW_PAGES'] = stream
+
+                for page in ('followers', 'following'):
+                    url = f"/users/{self.user1id}/{page}"
+                    seen = []
+
+                    while url:
+                        resp = self.client.get(url)
+                        self.assertEqual(resp.status_code, 200)
+                        # (a streamed page has no length up front)
+                        self.assertEqual('Content-Length' in resp.headers,
+                                         not stream)
+
+                        html = resp.get_data(as_text=True)
+                        seen += [int(id) for id in re.findall(
+                            r'<a href="/users/(\d+)" class="card-link">',
+                            html)]
+
+                        more = re.search(r'<a href="([^"]+)" class="btn '
+                                         r'btn-outline-secondary', html)
+                        url = more and more.group(1).replace('&amp;', '&')
+
+                    # Highest id first, each user once
+                    self.assertEqual(seen, fan_ids[::-1])
+        finally:
+            app.config['FOLLOW_PAGE_SIZE'] = 60
+            app.config['STREAM_FOLLOW_PAGES'] = False
@@ -0,0 +1,543 @@
+"""Precomputed home timelines (hybrid fan-out-on-write).
+
+When a message is posted we copy a pointer to it into the timeline of every
+follower of the author, so building a home page is one indexed range scan
+over `timeline_entries` instead of an `IN (...)` over everyone a user follows.
+
+Accounts with more than TIMELINE_FANOUT_LIMIT followers are *not* fanned
+out -- writing one row per follower would make posting too expensive.
+Their messages are merged into the timeline at read time instead. When
+unfollows bring one back under the limit, restore_fanout() copies their
+newest messages into their followers' timelines.
+
+Backfills (a new follow, or an author back under the limit) copy at most
+TIMELINE_LENGTH messages per follower, so a follow or unfollow request
+writes a bounded number of rows; further down the timeline, that author's
+older messages are left out.
+
+TIMELINE_ENGINE picks how home_timeline() reads, so the approaches can be
+benchmarked against each other on the same data (benchmarks/timeline_engines.py):
+
+- 'fanout' (default): the precomputed timeline, as above.
+- 'query': one query over messages with `user_id IN (followees)`, sorted
+  by the database -- what the home page did before timelines.
+- 'merge': seek each followee's newest messages on
+  ix_messages_user_timestamp (index-only) and k-way merge them here,
+  stopping once the page is full. See merge_timeline().
+"""
+
+import heapq
+
+from flask import current_app
+from sqlalchemy import and_, exists, literal, or_, select, true, tuple_
+from sqlalchemy.dialects.postgresql import insert as postgres_insert
+
+from bulk_load import indexes_deferred, truncate
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import keyset
+
+TIMELINE_LENGTH = 100
+DEFAULT_FANOUT_LIMIT = 10000
+
+TIMELINE_ENGINES = ('fanout', 'query', 'merge')
+DEFAULT_TIMELINE_ENGINE = 'fanout'
+
+# The merge engine's first round reads about this many times the page
+# length across all followees, and at least MERGE_MIN_BATCH from each
+MERGE_OVERFETCH = 2
+MERGE_MIN_BATCH = 4
+
+# Users whose timelines rebuild_all_timelines() brings up to date per
+# transaction
+REBUILD_CHUNK_USERS = 1000
+
+
+def fanout_limit():
+    """Follower count above which an author's messages aren't fanned out."""
+
+    return current_app.config.get('TIMELINE_FANOUT_LIMIT', DEFAULT_FANOUT_LIMIT)
+
+
+def is_fanout_exempt(user_id):
+    """Are this user's messages merged at read time instead of fanned out?"""
+
+    (follower_count,) = (db.session
+                         .query(User.follower_count)
+                         .filter(User.id == user_id)
+                         .one())
+
+    return follower_count > fanout_limit()
+
+
+def exempt_followee_ids(user_id):
+    """Ids of the accounts `user_id` follows that are read-time merged."""
+
+    rows = (db.session
+            .query(Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    User.follower_count > fanout_limit())
+            .all())
+
+    return [followee_id for (followee_id,) in rows]
+
+
+def _exempt_author_ids():
+    """Subquery of every author currently over the fan-out limit."""
+
+    return (db.session
+            .query(User.id)
+            .filter(User.follower_count > fanout_limit())
+            .subquery())
+
+
+def fan_out_message(msg):
+    """Copy a newly posted (and flushed) message into its author's
+    followers' timelines.
+
+    Does nothing for fan-out-exempt authors; does not commit.
+    """
+
+    if is_fanout_exempt(msg.user_id):
+        return
+
+    followers = select([
+        Follows.user_following_id,
+        literal(msg.id),
+        literal(msg.user_id),
+        literal(msg.timestamp),
+    ]).where(Follows.user_being_followed_id == msg.user_id)
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'], followers))
+
+
+def add_followee(user_id, followee_id):
+    """Backfill `user_id`'s timeline with the newest TIMELINE_LENGTH
+    messages of a newly followed user (any more would only show up far
+    down the timeline, and cost a row each on the follow request)."""
+
+    if is_fanout_exempt(followee_id):
+        return
+
+    newest = _seek(followee_id, None, TIMELINE_LENGTH).alias('newest')
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            select([literal(user_id), newest.c.id, literal(followee_id),
+                    newest.c.timestamp])))
+
+
+def restore_fanout(lost_followers):
+    """Fan out the messages authors posted while over the limit, for those
+    that just dropped back under it.
+
+    `lost_followers` maps author ids to how many followers each just lost
+    (their follower_count already lowered). Authors under the limit are no
+    longer merged at read time, so without this, what they posted while
+    exempt would vanish from their followers' timelines. Like
+    add_followee(), only their newest TIMELINE_LENGTH messages are copied,
+    so an unfollow writes at most that many rows per follower. Returns the
+    ids of the authors backfilled; does not commit.
+    """
+
+    limit = fanout_limit()
+
+    crossed = [author_id for author_id, follower_count in (
+               db.session
+               .query(User.id, User.follower_count)
+               .filter(User.id.in_(list(lost_followers))))
+               if follower_count <= limit
+               < follower_count + lost_followers[author_id]]
+
+    for author_id in crossed:
+        newest = _seek(author_id, None, TIMELINE_LENGTH).alias('newest')
+
+        # Those that aren't in a follower's timeline yet
+        missing = (select([
+            Follows.user_following_id,
+            newest.c.id,
+            literal(author_id),
+            newest.c.timestamp,
+        ])
+            .select_from(Follows.__table__.join(newest, true()))
+            .where(Follows.user_being_followed_id == author_id)
+            .where(~exists().where(and_(
+                TimelineEntry.user_id == Follows.user_following_id,
+                TimelineEntry.message_id == newest.c.id))))
+
+        db.session.execute(
+            TimelineEntry.__table__.insert().from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                missing))
+
+    return crossed
+
+
+def remove_followee(user_id, followee_id):
+    """Drop an unfollowed user's messages from `user_id`'s timeline."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == user_id,
+             TimelineEntry.author_id == followee_id)
+     .delete(synchronize_session=False))
+
+
+def timeline_engine():
+    """The configured TIMELINE_ENGINE."""
+
+    engine = current_app.config.get('TIMELINE_ENGINE',
+                                    DEFAULT_TIMELINE_ENGINE)
+
+    if engine not in TIMELINE_ENGINES:
+        raise ValueError(f"Unknown TIMELINE_ENGINE {engine!r}; expected one "
+                         f"of {', '.join(TIMELINE_ENGINES)}")
+
+    return engine
+
+
+def home_timeline(user_id, before=None, limit=TIMELINE_LENGTH,
+                  following_count=None):
+    """Most recent `limit` messages from the accounts `user_id` follows,
+    older than the (timestamp, id) cursor `before` if given.
+
+    Every engine returns the same messages, newest first by (timestamp,
+    id), so pagination.page() works on any of them. `following_count`, if
+    known, saves the merge engine looking it up.
+    """
+
+    engine = timeline_engine()
+
+    if engine == 'query':
+        return query_timeline(user_id, before, limit)
+
+    if engine == 'merge':
+        return merge_timeline(user_id, before, limit, following_count)
+
+    return fanout_timeline(user_id, before, limit)
+
+
+def fanout_timeline(user_id, before=None, limit=TIMELINE_LENGTH):
+    """Reads the precomputed timeline and merges in the newest messages of
+    any fan-out-exempt followees."""
+
+    messages = (keyset(Message
+                       .query
+                       .options(db.joinedload(Message.user))
+                       .join(TimelineEntry,
+                             TimelineEntry.message_id == Message.id)
+                       .filter(TimelineEntry.user_id == user_id,
+                               Message.visible()),
+                       TimelineEntry.timestamp,
+                       TimelineEntry.message_id,
+                       before)
+                .limit(limit)
+                .all())
+
+    exempt_ids = exempt_followee_ids(user_id)
+
+    if not exempt_ids:
+        return messages
+
+    merged_in = (keyset(Message
+                        .query
+                        .options(db.joinedload(Message.user))
+                        .filter(Message.user_id.in_(exempt_ids),
+                                Message.visible()),
+                        Message.timestamp,
+                        Message.id,
+                        before)
+                 .limit(limit)
+                 .all())
+
+    # An author who recently crossed the limit can show up in both lists
+    seen = set()
+    timeline = []
+
+    for msg in heapq.merge(messages, merged_in,
+                           key=lambda m: (m.timestamp, m.id), reverse=True):
+        if msg.id not in seen:
+            seen.add(msg.id)
+            timeline.append(msg)
+        if len(timeline) == limit:
+            break
+
+    return timeline
+
+
+def query_timeline(user_id, before=None, limit=TIMELINE_LENGTH):
+    """One query over every followee's messages, sorted by the database."""
+
+    followees = (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == user_id))
+
+    return (keyset(Message
+                   .query
+                   .options(db.joinedload(Message.user))
+                   .filter(Message.user_id.in_(followees),
+                           Message.visible()),
+                   Message.timestamp,
+                   Message.id,
+                   before)
+            .limit(limit)
+            .all())
+
+
+def merge_timeline(user_id, before=None, limit=TIMELINE_LENGTH,
+                   following_count=None):
+    """K-way merge of each followee's newest messages.
+
+    Reads (timestamp, id) keys only, from the (user_id, timestamp, id)
+    index. The first round takes a small batch from every followee (one
+    LATERAL query on PostgreSQL) and keeps the newest `limit` of those.
+
+    A followee whose whole batch made that cut may have more that belong
+    on the page: anything newer than the oldest key kept. One second
+    round reads those for all such followees at once, so a page takes at
+    most two key queries however many followees come back for more. The
+    chosen messages are loaded at the end.
+    """
+
+    if following_count is None:
+        following_count = (db.session
+                           .query(User.following_count)
+                           .filter(User.id == user_id)
+                           .scalar()) or 0
+
+    # Enough that most pages fill from the first round
+    batch = min(limit, max(MERGE_MIN_BATCH,
+                           -(-limit * MERGE_OVERFETCH
+                             // max(following_count, 1))))
+
+    keys = set()
+    oldest = {}
+    full = set()
+
+    for author_id, timestamp, message_id, position in _newest_keys(
+            user_id, before, batch, limit):
+        keys.add((timestamp, message_id))
+        oldest[author_id] = (timestamp, message_id)
+        if position == batch:
+            full.add(author_id)
+
+    # Once the page is full, only keys newer than its last one count
+    after = min(keys) if len(keys) == limit else None
+    refill = [author_id for author_id in full
+              if after is None or oldest[author_id] > after]
+
+    if refill:
+        keys.update((timestamp, message_id)
+                    for _, timestamp, message_id, _ in _newest_keys(
+                        user_id, before, limit, limit, after=after,
+                        author_ids=refill))
+
+    taken = heapq.nlargest(limit, keys)
+
+    if not taken:
+        return []
+
+    ids = [message_id for _, message_id in taken]
+
+    messages = {msg.id: msg
+                for msg in (Message
+                            .query
+                            .options(db.joinedload(Message.user))
+                            .filter(Message.id.in_(ids)))}
+
+    # (a message deleted since its key was read just drops out)
+    return [messages[message_id] for message_id in ids
+            if message_id in messages]
+
+
+def _seek(author_id, before, limit, after=None):
+    """(timestamp, id) select of an author's newest `limit` messages
+    (older than `before` and newer than `after`, if given)."""
+
+    seek = (select([Message.timestamp, Message.id])
+            .where(Message.user_id == author_id))
+
+    if before:
+        seek = seek.where(tuple_(Message.timestamp, Message.id)
+                          < tuple_(*before))
+
+    if after:
+        seek = seek.where(tuple_(Message.timestamp, Message.id)
+                          > tuple_(*after))
+
+    return (seek
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit))
+
+
+def _author_keys(author_id, before, limit, after=None):
+    return [tuple(row) for row in
+            db.session.execute(_seek(author_id, before, limit, after))]
+
+
+def _newest_keys(user_id, before, batch, limit, after=None,
+                 author_ids=None):
+    """The newest `limit` of the first `batch` messages of each (not
+    deleted) followee of `user_id` -- or just of `author_ids` -- as
+    (author id, timestamp, id, position in the author's batch) rows,
+    newest first."""
+
+    author_id = Follows.user_being_followed_id
+    followee_ids = (db.session
+                    .query(author_id)
+                    .filter(Follows.user_following_id == user_id,
+                            ~User.is_deleted(author_id)))
+
+    if author_ids is not None:
+        followee_ids = followee_ids.filter(author_id.in_(author_ids))
+
+    if db.engine.dialect.name != 'postgresql':
+        # No LATERAL: one seek per followee
+        rows = [(followee_id, timestamp, message_id, position)
+                for (followee_id,) in followee_ids.all()
+                for position, (timestamp, message_id) in enumerate(
+                    _author_keys(followee_id, before, batch, after), 1)]
+
+        return heapq.nlargest(limit, rows, key=lambda row: row[1:3])
+
+    position = (db.func.row_number()
+                .over(order_by=[Message.timestamp.desc(), Message.id.desc()])
+                .label('position'))
+    newest = (_seek(author_id, before, batch, after)
+              .column(position)
+              .lateral('newest'))
+
+    keys = (select([author_id, newest.c.timestamp, newest.c.id,
+                    newest.c.position])
+            .select_from(Follows.__table__.join(newest, true()))
+            .where(Follows.user_following_id == user_id)
+            .where(~User.is_deleted(author_id)))
+
+    if author_ids is not None:
+        keys = keys.where(author_id.in_(author_ids))
+
+    return db.session.execute(
+        keys
+        .order_by(newest.c.timestamp.desc(), newest.c.id.desc())
+        .limit(limit)).fetchall()
+
+
+def rebuild_timeline(user_id):
+    """Recreate `user_id`'s timeline from `messages` and `follows`.
+
+    Does not commit.
+    """
+
+    TimelineEntry.query.filter_by(user_id=user_id).delete()
+
+    exempt_ids = exempt_followee_ids(user_id)
+
+    messages = (select([
+        Follows.user_following_id,
+        Message.id,
+        Message.user_id,
+        Message.timestamp,
+    ])
+        .select_from(Follows.__table__.join(
+            Message.__table__,
+            Message.user_id == Follows.user_being_followed_id))
+        .where(Follows.user_following_id == user_id))
+
+    if exempt_ids:
+        messages = messages.where(~Message.user_id.in_(exempt_ids))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'], messages))
+
+
+def rebuild_all_timelines(offline=False):
+    """Recreate every user's timeline, a batch of REBUILD_CHUNK_USERS
+    users at a time.
+
+    Each batch adds the entries that are missing and deletes those that
+    shouldn't be there (unfollowed or fan-out-exempt authors) in its own
+    short transaction, so home pages and posts carry on meanwhile, and a
+    timeline is never seen half rebuilt. Commits after each batch.
+
+    With `offline` (seed.py: nothing else is using the database), it
+    instead empties the table and refills it in one statement, with the
+    indexes dropped until the end. That's far faster, but locks the table
+    until the caller commits.
+    """
+
+    if offline:
+        _refill_all_timelines()
+        return
+
+    max_id = db.session.query(db.func.max(User.id)).scalar() or 0
+
+    for low in range(0, max_id + 1, REBUILD_CHUNK_USERS):
+        _sync_timelines(low, low + REBUILD_CHUNK_USERS)
+        db.session.commit()
+
+
+def _timeline_rows():
+    """Select of every timeline entry there should be."""
+
+    return (select([
+        Follows.user_following_id,
+        Message.id,
+        Message.user_id,
+        Message.timestamp,
+    ])
+        .select_from(Follows.__table__.join(
+            Message.__table__,
+            Message.user_id == Follows.user_being_followed_id))
+        .where(~Message.user_id.in_(select([_exempt_author_ids()]))))
+
+
+def _sync_timelines(low, high):
+    """Bring the timelines of users low..high-1 up to date."""
+
+    missing = (_timeline_rows()
+               .where(Follows.user_following_id >= low)
+               .where(Follows.user_following_id < high)
+               .where(~exists().where(and_(
+                   TimelineEntry.user_id == Follows.user_following_id,
+                   TimelineEntry.message_id == Message.id))))
+
+    if db.engine.dialect.name == 'postgresql':
+        # (A message posted meanwhile may have fanned out already)
+        insert = (postgres_insert(TimelineEntry.__table__)
+                  .from_select(['user_id', 'message_id', 'author_id',
+                                'timestamp'], missing)
+                  .on_conflict_do_nothing())
+    else:
+        insert = TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'], missing)
+
+    db.session.execute(insert)
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id >= low, TimelineEntry.user_id < high)
+     .filter(or_(
+         TimelineEntry.author_id.in_(select([_exempt_author_ids()])),
+         ~exists().where(and_(
+             Follows.user_following_id == TimelineEntry.user_id,
+             Follows.user_being_followed_id == TimelineEntry.author_id))))
+     .delete(synchronize_session=False))
+
+
+def _refill_all_timelines():
+    """rebuild_all_timelines(offline=True). Does not commit."""
+
+    connection = db.session.connection()
+    table = TimelineEntry.__tablename__
+
+    truncate(connection, table)
+
+    with indexes_deferred(connection, table, primary_key=True):
+        connection.execute(
+            TimelineEntry.__table__.insert().from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                _timeline_rows()))
@@ -0,0 +1,173 @@
+"""Process-local cache of the logged-in user.
+
+add_user_to_g() runs before every request, so loading the current user
+from the database each time costs a query even on pages that only show
+their name and picture. Instead, we keep the handful of fields the views
+use in a small LRU cache with a TTL, and put a CurrentUser in g.user.
+Anything else (counts, relationships) loads the full User on first use.
+
+The cache is per process: an edit made in one gunicorn worker is only
+invalidated there, so other workers can show old values for up to
+USER_CACHE_TTL seconds.
+
+Settings (read by init_app):
+
+- USER_CACHE_SIZE: most users kept (default 1024); 0 turns caching off.
+- USER_CACHE_TTL: seconds an entry is trusted (default 60).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from follow_graph import follow_graph
+from models import User
+
+DEFAULT_SIZE = 1024
+DEFAULT_TTL = 60
+
+CACHED_FIELDS = ('id', 'username', 'image_url', 'header_image_url',
+                 'bio', 'location')
+
+
+class CurrentUser:
+    """The logged-in user: cached fields, plus the full User on demand.
+
+    Reading any other attribute loads the User. Writes have to go
+    through `.model` (and then invalidate the cache).
+    """
+
+    def __init__(self, fields):
+        object.__setattr__(self, '_fields', fields)
+        object.__setattr__(self, '_model', None)
+
+    @property
+    def model(self):
+        """The full User, loaded on first use."""
+
+        if self._model is None:
+            object.__setattr__(self, '_model', User.query.get(self.id))
+
+        return self._model
+
+    def __getattr__(self, name):
+        # Only called for attributes not found the normal way
+        fields = self._fields
+
+        if name in fields:
+            return fields[name]
+
+        return getattr(self.model, name)
+
+    # These only need our id, so don't load the full User for them (and
+    # the follow checks don't need the database either, once the follow
+    # graph is loaded)
+    liked_ids_among = User.liked_ids_among
+
+    def is_following(self, other_user):
+        if follow_graph.ready:
+            return follow_graph.is_following(self.id, other_user.id)
+        return User.is_following(self, other_user)
+
+    def is_followed_by(self, other_user):
+        if follow_graph.ready:
+            return follow_graph.is_following(other_user.id, self.id)
+        return User.is_followed_by(self, other_user)
+
+    def following_ids_among(self, user_ids):
+        if follow_graph.ready:
+            return follow_graph.following_among(self.id, user_ids)
+        return User.following_ids_among(self, user_ids)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            f"can't set {name} on the cached user; use g.user.model")
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+class UserCache:
+    """LRU + TTL cache of CACHED_FIELDS, by user id."""
+
+    def __init__(self, app=None):
+        self.max_size = DEFAULT_SIZE
+        self.ttl = DEFAULT_TTL
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings from `app.config`."""
+
+        self.max_size = app.config.get('USER_CACHE_SIZE', DEFAULT_SIZE)
+        self.ttl = app.config.get('USER_CACHE_TTL', DEFAULT_TTL)
+        self.clear()
+
+    def get(self, user_id):
+        """CurrentUser for `user_id`, or None if there's no such user."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return CurrentUser(entry[1])
+
+            self.misses += 1
+
+        user = User.query.get(user_id)
+
+        if user is None or user.deleted_at is not None:
+            return None
+
+        fields = {field: getattr(user, field) for field in CACHED_FIELDS}
+        self._store(user_id, fields, now)
+
+        current = CurrentUser(fields)
+        object.__setattr__(current, '_model', user)
+
+        return current
+
+    def _store(self, user_id, fields, now):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl, fields)
+            self._entries.move_to_end(user_id)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Forget `user_id` (after editing or deleting them)."""
+
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Size and lifetime hit/miss counts."""
+
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+user_cache = UserCache()